@@ -0,0 +1,179 @@
+"""Admission control for routes that call Stripe on behalf of a client
+
+Requests to /checkout and the subscription cancel form are admitted by a
+token bucket per client IP and one per Origin, and rejected with a 429
+before any work is done otherwise. Outbound Stripe calls are separately
+capped by a `ConcurrencyLimit`, so that a burst that gets through can't
+take every connection (and Stripe's rate limit) from webhooks and donors.
+"""
+import asyncio
+import threading
+from urllib.parse import urlsplit
+
+from ratelimit import KeyedTokenBuckets, SlidingWindowCounter
+
+__all__ = ["AdmissionControl", "ConcurrencyLimit", "Rejected", "origin_key"]
+
+# Longer header values are truncated before being used as a bucket key
+MAX_KEY_LENGTH = 200
+
+
+def origin_key(origin, referer=None):
+    """The bucket key for a request's Origin header, or its Referer's origin
+
+    >>> origin_key('https://Donate.MissionBit.org')
+    'https://donate.missionbit.org'
+    >>> origin_key(None, 'https://gala.missionbit.org/250/?frequency=monthly')
+    'https://gala.missionbit.org'
+    >>> origin_key(None), origin_key('null')
+    ('none', 'none')
+    """
+    if origin and origin != "null":
+        return origin[:MAX_KEY_LENGTH].lower()
+    if referer:
+        parts = urlsplit(referer[:MAX_KEY_LENGTH])
+        if parts.scheme and parts.netloc:
+            return f"{parts.scheme}://{parts.netloc}".lower()
+    return "none"
+
+
+class Rejected:
+    __slots__ = ("reason", "retry_after")
+
+    def __init__(self, reason: str, retry_after: float):
+        self.reason = reason
+        self.retry_after = retry_after
+
+    def __repr__(self):
+        return f"Rejected({self.reason!r}, {self.retry_after!r})"
+
+
+class AdmissionControl:
+    """Per client IP and per origin token buckets
+
+    >>> now = [0.0]
+    >>> admission = AdmissionControl(ip_rate=1, ip_burst=2, origin_rate=10,
+    ...                              origin_burst=3, clock=lambda: now[0])
+    >>> [admission.check('10.0.0.1', 'none') for _ in range(3)]
+    [None, None, Rejected('ip', 1.0)]
+    >>> admission.check('10.0.0.2', 'none'), admission.check('10.0.0.3', 'none')
+    (None, Rejected('origin', 0.1))
+    >>> stats = admission.stats()
+    >>> stats['admitted'], stats['rejected']
+    (3, {'ip': 1, 'origin': 1})
+    """
+
+    REASONS = ("ip", "origin")
+
+    def __init__(
+        self,
+        ip_rate: float,
+        ip_burst: float,
+        origin_rate: float,
+        origin_burst: float,
+        max_keys: int = 10000,
+        **kw,
+    ):
+        self.limits = {
+            "ip": KeyedTokenBuckets(ip_rate, ip_burst, max_keys, **kw),
+            "origin": KeyedTokenBuckets(origin_rate, origin_burst, max_keys, **kw),
+        }
+        self._lock = threading.Lock()
+        self.admitted = 0
+        self.rejected = {reason: 0 for reason in self.REASONS}
+        self.recent = {
+            reason: SlidingWindowCounter(60.0, **kw) for reason in self.REASONS
+        }
+
+    def check(self, ip: str, origin: str):
+        """None if the request may proceed, otherwise a `Rejected`"""
+        for reason, key in (("ip", ip or "unknown"), ("origin", origin)):
+            delay = self.limits[reason].take(key)
+            if delay:
+                with self._lock:
+                    self.rejected[reason] += 1
+                self.recent[reason].add()
+                return Rejected(reason, delay)
+        with self._lock:
+            self.admitted += 1
+        return None
+
+    def stats(self) -> dict:
+        with self._lock:
+            rval = {"admitted": self.admitted, "rejected": dict(self.rejected)}
+        rval["rejected_last_minute"] = {
+            reason: round(counter.count(), 1) for reason, counter in self.recent.items()
+        }
+        rval["tracked_keys"] = {
+            reason: len(buckets) for reason, buckets in self.limits.items()
+        }
+        return rval
+
+
+class ConcurrencyLimit:
+    """Lets at most `limit` callers in at once
+
+    A caller that doesn't get in within the timeout it passes to `acquire`
+    (or `acquire_async` on an event loop) is counted as rejected.
+
+    >>> limit = ConcurrencyLimit("stripe", 1)
+    >>> limit.acquire(), limit.acquire(timeout=0)
+    (True, False)
+    >>> asyncio.new_event_loop().run_until_complete(limit.acquire_async(0.02))
+    False
+    >>> limit.release()
+    >>> stats = limit.stats()
+    >>> stats['in_flight'], stats['max_in_flight'], stats['rejected']
+    (0, 1, 2)
+    """
+
+    def __init__(self, name: str, limit: int):
+        self.name = name
+        self.limit = limit
+        self._semaphore = threading.BoundedSemaphore(limit)
+        self._lock = threading.Lock()
+        self.in_flight = 0
+        self.max_in_flight = 0
+        self.rejected = 0
+
+    def acquire(self, timeout: float = None) -> bool:
+        if timeout is not None and timeout <= 0:
+            acquired = self._semaphore.acquire(blocking=False)
+        else:
+            acquired = self._semaphore.acquire(timeout=timeout)
+        return self._admit(acquired)
+
+    async def acquire_async(self, timeout: float, poll: float = 0.01) -> bool:
+        """`acquire` without blocking the event loop, by polling the
+        semaphore every `poll` seconds
+        """
+        loop = asyncio.get_event_loop()
+        deadline = loop.time() + timeout
+        acquired = self._semaphore.acquire(blocking=False)
+        while not acquired and loop.time() < deadline:
+            await asyncio.sleep(min(poll, deadline - loop.time()))
+            acquired = self._semaphore.acquire(blocking=False)
+        return self._admit(acquired)
+
+    def _admit(self, acquired: bool) -> bool:
+        with self._lock:
+            if not acquired:
+                self.rejected += 1
+                return False
+            self.in_flight += 1
+            self.max_in_flight = max(self.max_in_flight, self.in_flight)
+        return True
+
+    def release(self) -> None:
+        with self._lock:
+            self.in_flight -= 1
+        self._semaphore.release()
+
+    def stats(self) -> dict:
+        with self._lock:
+            return {
+                "limit": self.limit,
+                "in_flight": self.in_flight,
+                "max_in_flight": self.max_in_flight,
+                "rejected": self.rejected,
+            }
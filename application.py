@@ -1,30 +1,59 @@
+import atexit
+import functools
+import hmac
 import os
-import re
 import sys
 import time
 import traceback
 import logging
-import hashlib
+import json
+import math
+import mimetypes
 from urllib.parse import urlsplit, urlunsplit
-from datetime import datetime
-from dateutil import tz
 from flask import (
     Flask,
-    render_template,
+    g,
+    render_template as flask_render_template,
     request,
     redirect,
-    url_for,
     send_from_directory,
     jsonify,
     abort,
 )
 from werkzeug.middleware.proxy_fix import ProxyFix
 import stripe
-import sendgrid
-from jsonschema import validate
-from parse_cents import parse_cents
+from parse_cents import format_cents, parse_cents
+from webhook_queue import WebhookQueue
+from cache_backends import backend_from_url
+from event_ledger import EventLedger
+from receipt_log import DONATION_EVENT, FAILURE_NOTICE, RECEIPT, SKIPPED, ReceiptLog
+from donation_store import DonationStore, donation_host
+from live_totals import LiveTotals
+from redirects import RedirectTable
+from receipts import (
+    ChargeView,
+    local_tz,
+    long_date,
+    payment_method_label,
+    sendgrid_safe_name,
+    template_data,
+)
+from email_batcher import EmailBatcher
+from stripe_cache import StripeCache
+from page_cache import PageCache
+from assets import AssetManifest, CompressedAssets, IMMUTABLE_CACHE_CONTROL
+from http_pool import (
+    ConnectionPool,
+    PooledSendGridAPIClient,
+    PooledStripeClient,
+    StripeBusy,
+    default_ssl_context,
+)
+from admission import AdmissionControl, ConcurrencyLimit, origin_key
+from instrumentation import Metrics
+from resilience import CircuitBreaker, clear_budget, set_budget
+from telemetry import TelemetrySink
 from python_http_client import exceptions
-from applicationinsights.flask.ext import AppInsights
 
 try:
     if "WEBSITE_SITE_NAME" in os.environ:
@@ -36,6 +65,7 @@ except OSError:
 
 TEST_ENVIRONMENT = os.path.basename(sys.argv[0]) == "pytest"
 REDIRECT_TO_WWW = os.environ.get("REDIRECT_TO_WWW") != "false"
+WWW_DONATE_URL = "https://www.missionbit.org/donate"
 
 
 def require_env(k: str) -> str:
@@ -53,7 +83,7 @@ FAILURE_TEMPLATE_ID = "d-570b4b8b20e74ec5a9c55be7e07e2665"
 SENDGRID_API_KEY = require_env("SENDGRID_API_KEY")
 DONATE_EMAIL = "donate@missionbit.org"
 MONTHLY_PLAN_ID = "mb-monthly-001"
-LOCAL_TZ = tz.gettz("America/Los_Angeles")
+SENDER = {"name": "Mission Bit", "email": DONATE_EMAIL}
 
 stripe_keys = {
     "secret_key": require_env("SECRET_KEY"),
@@ -63,23 +93,129 @@ stripe_keys = {
 
 stripe.api_key = stripe_keys["secret_key"]
 
+# Latency histograms for requests and their Stripe, SendGrid and Jinja spans
+metrics = Metrics()
+METRICS_FORWARD_INTERVAL = float(os.environ.get("METRICS_FORWARD_INTERVAL", "60"))
+# Bearer token for /internal/stats and /metrics, without it they only answer
+# loopback clients
+INTERNAL_TOKEN = os.environ.get("INTERNAL_TOKEN")
+
+# Calls fail fast while an upstream keeps failing instead of every request
+# waiting out its timeout
+stripe_breaker = CircuitBreaker(
+    "stripe",
+    failure_threshold=int(os.environ.get("BREAKER_FAILURES", "5")),
+    reset_timeout=float(os.environ.get("BREAKER_RESET_TIMEOUT", "30")),
+)
+sendgrid_breaker = CircuitBreaker(
+    "sendgrid",
+    failure_threshold=int(os.environ.get("BREAKER_FAILURES", "5")),
+    reset_timeout=float(os.environ.get("BREAKER_RESET_TIMEOUT", "30")),
+)
+# Total time a page request may spend waiting on upstream calls
+REQUEST_BUDGET = float(os.environ.get("REQUEST_BUDGET", "10"))
+
+# Keep-alive connections to api.stripe.com and api.sendgrid.com are shared
+# by every request and webhook worker thread
+http_pool = ConnectionPool(
+    maxsize=int(os.environ.get("HTTP_POOL_SIZE", "10")),
+    timeout=float(os.environ.get("HTTP_TIMEOUT", "30")),
+)
+# Stripe calls in flight from this process, callers wait at most
+# STRIPE_CONCURRENCY_WAIT seconds for a slot before getting a 429
+stripe_concurrency = ConcurrencyLimit(
+    "stripe", int(os.environ.get("STRIPE_CONCURRENCY", "16"))
+)
+STRIPE_CONCURRENCY_WAIT = float(os.environ.get("STRIPE_CONCURRENCY_WAIT", "0.25"))
+stripe.default_http_client = PooledStripeClient(
+    http_pool,
+    timeout=float(os.environ.get("STRIPE_TIMEOUT", "30")),
+    metrics=metrics,
+    breaker=stripe_breaker,
+    limit=stripe_concurrency,
+    limit_wait=STRIPE_CONCURRENCY_WAIT,
+)
+# Checkouts and cancellations per client IP and per Origin, so that card
+# testing bots are turned away before they reach Stripe
+admission = AdmissionControl(
+    ip_rate=float(os.environ.get("ADMISSION_IP_RATE", "0.1")),
+    ip_burst=float(os.environ.get("ADMISSION_IP_BURST", "10")),
+    origin_rate=float(os.environ.get("ADMISSION_ORIGIN_RATE", "10")),
+    origin_burst=float(os.environ.get("ADMISSION_ORIGIN_BURST", "50")),
+    max_keys=int(os.environ.get("ADMISSION_MAX_KEYS", "10000")),
+)
+sendgrid_client = PooledSendGridAPIClient(
+    SENDGRID_API_KEY,
+    http_pool,
+    timeout=float(os.environ.get("SENDGRID_TIMEOUT", "10")),
+    metrics=metrics,
+    breaker=sendgrid_breaker,
+)
+# CACHE_URL (mmap:<path> for the workers of one machine, redis://host:port/db
+# for every instance) shares Stripe objects, compressed static assets and
+# webhook dedup, otherwise each worker has its own
+shared_cache = backend_from_url(os.environ.get("CACHE_URL"))
+# Expanded retrieves are reused across page refreshes and webhook retries until
+# a webhook event for the same object arrives
+stripe_cache = StripeCache(
+    maxsize=int(os.environ.get("STRIPE_CACHE_SIZE", "1024")),
+    ttl=float(os.environ.get("STRIPE_CACHE_TTL", "300")),
+    shared=shared_cache,
+    local_ttl=float(os.environ.get("STRIPE_CACHE_LOCAL_TTL", "10")),
+)
+# The donation page only depends on amount, frequency and query string metadata
+index_cache = PageCache(maxsize=int(os.environ.get("INDEX_CACHE_SIZE", "512")))
+# Receipts from concurrent webhook workers are merged into one SendGrid request
+email_batcher = EmailBatcher(
+    sendgrid_client,
+    max_size=int(os.environ.get("EMAIL_BATCH_SIZE", "1000")),
+    max_delay=float(os.environ.get("EMAIL_BATCH_DELAY", "0.5")),
+)
+
 CANONICAL_HOSTS = os.environ.get("CANONICAL_HOST", "").split()
 
 CHECKOUT_SCHEMA = {
     "type": "object",
     "description": "Start the Stripe checkout flow",
-    "required": ["amount"],
+    "required": ["amount", "frequency"],
     "properties": {
         "amount": {
             "type": "integer",
             "description": "USD cents of donation",
             "minimum": 100,
         },
+        "frequency": {
+            "type": "string",
+            "description": "Donation frequency",
+            "enum": ["once", "monthly"],
+        },
         "metadata": {"type": "object"},
     },
 }
 
 
+# jsonschema, dateutil.tz and applicationinsights are only imported once they
+# are needed, which takes a good part off the time to import this module.
+# warm_up() loads them all, e.g. before a preforking server starts workers.
+@functools.lru_cache(maxsize=None)
+def checkout_validator():
+    # Built once, jsonschema.validate would recreate the validator on every call
+    from jsonschema import Draft7Validator
+
+    Draft7Validator.check_schema(CHECKOUT_SCHEMA)
+    return Draft7Validator(CHECKOUT_SCHEMA)
+
+
+class InvalidCheckout(ValueError):
+    """A /checkout body that doesn't match CHECKOUT_SCHEMA, `body` is the
+    JSON error response
+    """
+
+    def __init__(self, body):
+        super().__init__(body["error"])
+        self.body = body
+
+
 def verizonProxyHostFixer(app):
     """Azure's Verizon Premium CDN uses the header X-Host instead of X-Forwarded-Host
     """
@@ -94,7 +230,12 @@ def verizonProxyHostFixer(app):
 
 
 app = Flask(__name__)
-appinsights = AppInsights(app)
+if os.environ.get("APPINSIGHTS_INSTRUMENTATIONKEY"):
+    from applicationinsights.flask.ext import AppInsights
+
+    appinsights = AppInsights(app)
+else:
+    appinsights = None
 if CANONICAL_HOSTS:
     # Azure's Verizon Premium CDN uses the header X-Host instead of X-Forwarded-Host
     app.wsgi_app = verizonProxyHostFixer(ProxyFix(app.wsgi_app, x_host=1))
@@ -103,13 +244,48 @@ app.logger.addHandler(streamHandler)
 app.logger.setLevel(logging.DEBUG)
 
 
+def render_template(template_name, **context):
+    with metrics.span("jinja", template=template_name):
+        return flask_render_template(template_name, **context)
+
+
+@app.before_request
+def start_request_timer():
+    g.request_start = time.perf_counter()
+    set_budget(REQUEST_BUDGET)
+
+
+@app.teardown_request
+def record_request_latency(exc=None):
+    clear_budget()
+    start = g.pop("request_start", None)
+    if start is not None:
+        metrics.observe(
+            "request",
+            time.perf_counter() - start,
+            method=request.method,
+            endpoint=request.endpoint or "unmatched",
+        )
+
+
 def get_telemetry_client():
-    requests_middleware = appinsights._requests_middleware
+    requests_middleware = appinsights and appinsights._requests_middleware
     return requests_middleware.client if requests_middleware else None
 
 
+# Custom events are sent from a background thread so that a slow or failing
+# telemetry endpoint never holds up a webhook
+telemetry = TelemetrySink(
+    get_telemetry_client,
+    capacity=int(os.environ.get("TELEMETRY_BUFFER_SIZE", "10000")),
+    batch_size=int(os.environ.get("TELEMETRY_BATCH_SIZE", "100")),
+    flush_interval=float(os.environ.get("TELEMETRY_FLUSH_INTERVAL", "5")),
+)
+atexit.register(telemetry.stop, timeout=10)
+
+
 def set_default_app_context():
-    requests_middleware = appinsights._requests_middleware
+    requests_middleware = appinsights and appinsights._requests_middleware
     if requests_middleware:
         envs = ["WEBSITE_SITE_NAME", "GIT_VERSION"]
         for k in envs:
@@ -129,35 +305,61 @@ def merge_dicts(*dicts):
     return rval
 
 
+asset_manifest = AssetManifest.from_static_folder(
+    app.static_folder, app.static_url_path, cache=shared_cache
+)
+
+
 @app.template_filter("asset_url")
-def asset_url(path, CACHE={}):
-    abspath = os.path.abspath(app.root_path + path)
-    # Avoid directory traversal mistakes
-    if not abspath.startswith(app.static_folder):
-        return path
-    try:
-        # Check that the file exists and use its
-        # size and creation time as a cache key to avoid
-        # computing a digest on every request
-        stat = os.stat(abspath)
-        key = stat.st_size, stat.st_mtime
-        cached = CACHE.get(path)
-        if cached is not None and cached[0] == key:
-            return cached[1]
-        # Get a SHA1 digest of the file contents
-        h = hashlib.sha1()
-        with open(abspath, "rb") as f:
-            for chunk in iter(lambda: f.read(4096), b""):
-                h.update(chunk)
-        # Use the prefix of the digest in the URL to ensure
-        # the browser will receive the latest version
-        rval = "{}?v={}".format(path, h.hexdigest()[:8])
-        CACHE[path] = (key, rval)
-        return rval
-    except OSError:
-        # This will catch any FileNotFoundError or similar
-        # issues with stat, open, or read.
-        return path
+def asset_url(path):
+    if app.debug:
+        # Pick up edits to static files while developing
+        global asset_manifest
+        asset_manifest = AssetManifest.build(app.static_folder, app.static_url_path)
+    return asset_manifest.url(path)
+
+
+compressed_assets = CompressedAssets.build(
+    app.static_folder, asset_manifest.files, cache=shared_cache
+)
+
+
+def send_asset(filename, mimetype=None):
+    """Serve a static file, precompressed when the client allows it
+
+    Fingerprinted asset URLs are served with a far future expiry. Files that
+    are not compressed (e.g. images) are passed to the server's
+    wsgi.file_wrapper so they can be sent with sendfile.
+    """
+    original = asset_manifest.resolve(filename)
+    name = original or filename
+    encoding, body = (None, None)
+    if not app.debug:
+        encoding, body = compressed_assets.negotiate(name, request.accept_encodings)
+    if encoding is None:
+        response = send_from_directory(app.static_folder, name, mimetype=mimetype)
+        compressed_assets.record("identity", response.content_length or 0)
+    else:
+        response = app.response_class(
+            body,
+            mimetype=mimetype
+            or mimetypes.guess_type(name)[0]
+            or "application/octet-stream",
+        )
+        response.headers["Content-Encoding"] = encoding
+        response.set_etag(f"{asset_manifest.files.get(name, name)}.{encoding}")
+        response.cache_control.public = True
+        response.cache_control.max_age = app.get_send_file_max_age(name)
+        response = response.make_conditional(request)
+        compressed_assets.record(encoding, response.content_length or 0)
+    if compressed_assets.has_variants(name):
+        response.vary.add("Accept-Encoding")
+    if original is not None:
+        response.headers["Cache-Control"] = IMMUTABLE_CACHE_CONTROL
+    return response
+
+
+app.view_functions["static"] = send_asset
 
 
 @app.after_request
@@ -171,72 +373,21 @@ def add_cache_control_header(response):
 
 @app.route("/favicon.ico")
 def favicon():
-    return send_from_directory(
-        os.path.join(app.root_path, "static"),
-        "favicon.ico",
-        mimetype="image/vnd.microsoft.icon",
-    )
+    return send_asset("favicon.ico", mimetype="image/vnd.microsoft.icon")
 
 
 @app.route("/robots.txt")
 def robots():
-    return send_from_directory(
-        os.path.join(app.root_path, "static"), "robots.txt", mimetype="text/plain"
-    )
+    return send_asset("robots.txt", mimetype="text/plain")
 
 
 @app.route("/.well-known/apple-developer-merchantid-domain-association")
 def apple_pay_domain_association():
-    return send_from_directory(
-        os.path.join(app.root_path, "static"),
-        "apple-developer-merchantid-domain-association",
-        mimetype="text/plain",
+    return send_asset(
+        "apple-developer-merchantid-domain-association", mimetype="text/plain"
     )
 
 
-def format_identifier(s):
-    """
-    >>> format_identifier('apple_pay')
-    'Apple Pay'
-    """
-    return " ".join(map(lambda s: s.capitalize(), s.split("_")))
-
-
-CARD_BRANDS = {
-    "amex": "American Express",
-    "diners": "Diners Club",
-    "discover": "Discover",
-    "jcb": "JCB",
-    "mastercard": "Mastercard",
-    "unionpay": "UnionPay",
-    "visa": "Visa",
-}
-
-
-def format_payment_method_details_source(payment_method_details):
-    payment_type = payment_method_details.type
-    if payment_type in ("card", "card_present"):
-        details = payment_method_details[payment_type]
-        parts = []
-        brand = CARD_BRANDS.get(details.brand)
-        if brand:
-            parts.append(brand)
-        if details.funding != "unknown":
-            parts.append(details.funding)
-        parts.append("card")
-        if details.wallet:
-            parts.append("({})".format(format_identifier(details.wallet.type)))
-        return " ".join(parts)
-    else:
-        return format_identifier(payment_type)
-
-
-def sendgrid_safe_name(name):
-    """The to.name, cc.name, and bcc.name personalizations cannot include either the ; or , characters.
-    """
-    return re.sub(r"([,;]\s*)+", " ", name)
-
-
 @app.route("/cancel")
 def cancel():
     return render_template("cancel.html", donate_email=DONATE_EMAIL)
@@ -247,8 +398,11 @@ def success():
     session_id = request.args.get("session_id")
     if not session_id:
         return redirect("/")
-    session = stripe.checkout.Session.retrieve(
-        session_id, expand=["payment_intent", "subscription.default_payment_method"]
+    session = stripe_cache.retrieve(
+        stripe.checkout.Session,
+        session_id,
+        expand=["payment_intent", "subscription.default_payment_method"],
+        allow_stale=True,
     )
     return render_template(
         "success.html", donate_email=DONATE_EMAIL, **session_info(session)
@@ -264,7 +418,7 @@ def session_info(session):
                 "id": subscription.id,
                 "frequency": "monthly",
                 "amount": subscription.plan.amount * subscription.quantity,
-                "payment_method": format_payment_method_details_source(pm),
+                "payment_method": payment_method_label(pm),
             },
             billing_details_to(pm.billing_details),
         )
@@ -275,9 +429,7 @@ def session_info(session):
                 "id": charge.id,
                 "frequency": "one-time",
                 "amount": charge.amount,
-                "payment_method": format_payment_method_details_source(
-                    charge.payment_method_details
-                ),
+                "payment_method": payment_method_label(charge.payment_method_details),
             },
             billing_details_to(charge.billing_details),
         )
@@ -310,18 +462,20 @@ def session_kw(amount, frequency, metadata):
         }
 
 
-@app.route("/checkout", methods=["POST"])
-def checkout():
-    body = request.json
-    validate(body, CHECKOUT_SCHEMA)
+def checkout_session_params(body, origin):
+    """Validate a /checkout request body and build the Session.create arguments
+    """
+    from jsonschema import ValidationError
+
+    try:
+        checkout_validator().validate(body)
+    except ValidationError as e:
+        raise InvalidCheckout(validation_error_body(e)) from e
     amount = body["amount"]
     frequency = body["frequency"]
-    o = urlsplit(request.url)
-    metadata = merge_dicts(
-        body.get("metadata", {}),
-        {"origin": urlunsplit((o.scheme, o.netloc, "", "", ""))},
-    )
-    session = stripe.checkout.Session.create(
+    o = urlsplit(origin)
+    metadata = merge_dicts(body.get("metadata", {}), {"origin": origin})
+    return dict(
         payment_method_types=["card"],
         success_url=urlunsplit(
             (o.scheme, o.netloc, "/success", "session_id={CHECKOUT_SESSION_ID}", "")
@@ -329,12 +483,87 @@ def checkout():
         cancel_url=urlunsplit((o.scheme, o.netloc, "/cancel", "", "")),
         **session_kw(amount=amount, frequency=frequency, metadata=metadata),
     )
+
+
+def too_many_requests(retry_after):
+    headers = {"Retry-After": str(max(1, math.ceil(retry_after)))}
+    message = "Too many requests, please try again shortly"
+    if request.is_json:
+        return jsonify(error=message), 429, headers
+    return message, 429, headers
+
+
+def admission_controlled(view):
+    """Reject the request with a 429 unless `admission` lets it through"""
+
+    @functools.wraps(view)
+    def admitted_view(*args, **kw):
+        rejected = admission.check(
+            request.remote_addr,
+            origin_key(request.headers.get("Origin"), request.headers.get("Referer")),
+        )
+        if rejected is not None:
+            return too_many_requests(rejected.retry_after)
+        return view(*args, **kw)
+
+    return admitted_view
+
+
+@app.route("/checkout", methods=["POST"])
+@admission_controlled
+def checkout():
+    body = request.get_json(silent=True)
+    o = urlsplit(request.url)
+    session = stripe.checkout.Session.create(
+        **checkout_session_params(body, urlunsplit((o.scheme, o.netloc, "", "", "")))
+    )
     return jsonify(sessionId=session.id)
 
 
+def validation_error_body(e):
+    """A JSON-friendly description of a ValidationError for 400 responses
+
+    >>> from jsonschema import ValidationError
+    >>> try:
+    ...     checkout_validator().validate({"amount": 50, "frequency": "once"})
+    ... except ValidationError as e:
+    ...     validation_error_body(e)
+    {'error': '50 is less than the minimum of 100', 'path': ['amount'], 'validator': 'minimum'}
+    """
+    return {
+        "error": e.message,
+        "path": list(e.absolute_path),
+        "validator": e.validator,
+    }
+
+
+@app.errorhandler(InvalidCheckout)
+def handle_validation_error(e):
+    return jsonify(e.body), 400
+
+
+@app.errorhandler(StripeBusy)
+def handle_stripe_busy(e):
+    return too_many_requests(1)
+
+
+@app.errorhandler(stripe.error.APIConnectionError)
+@app.errorhandler(stripe.error.APIError)
+def handle_stripe_unavailable(e):
+    app.logger.error(f"Stripe unavailable: {e!r}")
+    headers = {"Retry-After": str(int(stripe_breaker.reset_timeout))}
+    if request.is_json:
+        return jsonify(error="Stripe is unavailable, please try again"), 503, headers
+    return (
+        render_template("unavailable.html", donate_email=DONATE_EMAIL),
+        503,
+        headers,
+    )
+
+
 def billing_details_to(billing_details):
     return {
-        "name": sendgrid_safe_name(billing_details.name),
+        "name": billing_details.name and sendgrid_safe_name(billing_details.name),
         "email": billing_details.email,
     }
 
@@ -346,12 +575,19 @@ def donor_name(billing_details):
         return billing_details.email
 
 
+def webhook_stage(stage):
+    """Time one stage of webhook handling (verify, retrieve, email, telemetry)"""
+    return metrics.span("webhook", stage=stage)
+
+
 def stripe_checkout_session_completed(session):
     # Subscription receipts are handled by invoice payments
     if session.mode == "payment":
-        return stripe_checkout_session_completed_payment(
-            stripe.checkout.Session.retrieve(session.id, expand=["payment_intent"])
-        )
+        with webhook_stage("retrieve"):
+            session = stripe_cache.retrieve(
+                stripe.checkout.Session, session.id, expand=["payment_intent"]
+            )
+        return stripe_checkout_session_completed_payment(session)
 
 
 def get_origin(metadata):
@@ -362,123 +598,141 @@ def get_origin(metadata):
 
 
 def stripe_invoice_payment_succeeded(invoice):
-    invoice = stripe.Invoice.retrieve(
-        invoice.id, expand=["subscription", "payment_intent"]
-    )
+    with webhook_stage("retrieve"):
+        invoice = stripe_cache.retrieve(
+            stripe.Invoice, invoice.id, expand=["subscription", "payment_intent"]
+        )
     subscription = invoice.subscription
     charge = invoice.payment_intent.charges.data[0]
     if is_from_new_app(subscription.metadata):
         print(f"Skipping subscription email from new app: {charge.id}")
+        log_receipt(SKIPPED, charge)
         return
-    next_dt = datetime.fromtimestamp(subscription.current_period_end, LOCAL_TZ)
-    sg = sendgrid.SendGridAPIClient(SENDGRID_API_KEY)
-    try:
-        response = sg.send(
-            email_template_data(
-                template_id=RECEIPT_TEMPLATE_ID,
-                charge=charge,
-                frequency="monthly",
-                monthly={
-                    "next": f"{next_dt.strftime('%b')} {next_dt.day}, {next_dt.year}",
-                    "url": f"{get_origin(subscription.metadata)}/subscriptions/{subscription.id}",
-                },
-            )
-        )
-        if not (200 <= response.status_code < 300):
-            return abort(400)
-    except exceptions.BadRequestsError:
+    if not already_logged(RECEIPT, charge):
+        try:
+            with webhook_stage("email"):
+                response = yield email_batcher.submit(
+                    receipt_message(charge, subscription)
+                )
+            if not (200 <= response.status_code < 300):
+                return abort(400)
+        except exceptions.BadRequestsError:
 
-        return abort(400)
+            return abort(400)
+        log_receipt(RECEIPT, charge)
     track_donation(metadata=subscription.metadata, frequency="monthly", charge=charge)
 
 
+def receipt_message(charge, subscription=None):
+    """The receipt for a one-time charge or a charge of `subscription`"""
+    if subscription is None:
+        return email_template_data(
+            template_id=RECEIPT_TEMPLATE_ID, charge=charge, frequency="one-time"
+        )
+    return email_template_data(
+        template_id=RECEIPT_TEMPLATE_ID,
+        charge=charge,
+        frequency="monthly",
+        monthly={
+            "next": long_date(subscription.current_period_end),
+            "url": f"{get_origin(subscription.metadata)}/subscriptions/{subscription.id}",
+        },
+    )
+
+
 def email_template_data(template_id, charge, frequency, **kw):
-    payment_method = format_payment_method_details_source(charge.payment_method_details)
-    return {
-        "template_id": template_id,
-        "from": {"name": "Mission Bit", "email": DONATE_EMAIL},
-        "personalizations": [
-            {
-                "to": [billing_details_to(charge.billing_details)],
-                "dynamic_template_data": merge_dicts(
-                    {
-                        "transaction_id": charge.id,
-                        "frequency": frequency,
-                        "total": "${:,.2f}".format(charge.amount * 0.01),
-                        "date": datetime.fromtimestamp(
-                            charge.created, LOCAL_TZ
-                        ).strftime("%x"),
-                        "payment_method": payment_method,
-                        "donor": donor_name(charge.billing_details),
-                    },
-                    kw,
-                ),
-            }
-        ],
-    }
+    return template_data(
+        template_id, SENDER, ChargeView.from_charge(charge), frequency, **kw
+    )
 
 
 def track_invoice_failure(metadata, frequency, charge):
     client = get_telemetry_client()
     if client is None:
         return
-    payment_method = format_payment_method_details_source(charge.payment_method_details)
-    client.track_event(
-        "DonationFailed",
-        merge_dicts(
-            metadata,
-            billing_details_to(charge.billing_details),
-            {"id": charge.id, "frequency": frequency, "payment_method": payment_method},
-        ),
-        {"amount": charge.amount},
-    )
+    with webhook_stage("telemetry"):
+        payment_method = payment_method_label(charge.payment_method_details)
+        telemetry.track_event(
+            "DonationFailed",
+            merge_dicts(
+                metadata,
+                billing_details_to(charge.billing_details),
+                {
+                    "id": charge.id,
+                    "frequency": frequency,
+                    "payment_method": payment_method,
+                },
+            ),
+            {"amount": charge.amount},
+        )
 
 
 def track_donation(metadata, frequency, charge):
+    host = donation_host(metadata)
+    if donation_store.record(charge.id, host, frequency, charge.amount, charge.created):
+        live_totals.publish(host)
     client = get_telemetry_client()
-    if client is None:
+    if client is None or already_logged(DONATION_EVENT, charge):
         return
-    payment_method = format_payment_method_details_source(charge.payment_method_details)
-    client.track_event(
-        "Donation",
-        merge_dicts(
-            metadata,
-            billing_details_to(charge.billing_details),
-            {"id": charge.id, "frequency": frequency, "payment_method": payment_method},
-        ),
-        {"amount": charge.amount},
-    )
+    with webhook_stage("telemetry"):
+        payment_method = payment_method_label(charge.payment_method_details)
+        telemetry.track_event(
+            "Donation",
+            merge_dicts(
+                metadata,
+                billing_details_to(charge.billing_details),
+                {
+                    "id": charge.id,
+                    "frequency": frequency,
+                    "payment_method": payment_method,
+                },
+            ),
+            {"amount": charge.amount},
+            # Only a flushed event counts as sent, so reconcile.py still
+            # reports donations whose telemetry was dropped or failed.
+            on_sent=lambda: log_receipt(DONATION_EVENT, charge),
+        )
+
+
+def log_receipt(kind, charge):
+    receipt_log.record(charge.id, kind, charge.amount, charge.created)
+
+
+def already_logged(kind, charge):
+    """Whether an earlier attempt at this event already did the step that logs
+    `kind`, so that a retry doesn't repeat it (e.g. email the receipt twice)
+    """
+    return kind in receipt_log.kinds(charge.id)
 
 
 def stripe_checkout_session_completed_payment(session):
     payment_intent = session.payment_intent
     charge = payment_intent.charges.data[0]
-    payment_method = format_payment_method_details_source(charge.payment_method_details)
     if is_from_new_app(payment_intent.metadata):
         print(f"Skipping charge email from new app: {charge.id}")
+        log_receipt(SKIPPED, charge)
         return
-    sg = sendgrid.SendGridAPIClient(SENDGRID_API_KEY)
-    try:
-        response = sg.send(
-            email_template_data(
-                template_id=RECEIPT_TEMPLATE_ID, charge=charge, frequency="one-time"
-            )
-        )
-        if not (200 <= response.status_code < 300):
-            print(repr(response))
+    if not already_logged(RECEIPT, charge):
+        try:
+            with webhook_stage("email"):
+                response = yield email_batcher.submit(receipt_message(charge))
+            if not (200 <= response.status_code < 300):
+                print(repr(response))
+                return abort(400)
+        except exceptions.BadRequestsError:
+            traceback.print_tb(sys.last_traceback)
             return abort(400)
-    except exceptions.BadRequestsError:
-        traceback.print_tb(sys.last_traceback)
-        return abort(400)
+        log_receipt(RECEIPT, charge)
     track_donation(
         metadata=payment_intent.metadata, frequency="one-time", charge=charge
     )
 
 
 def stripe_invoice_payment_failed(invoice):
-    invoice = stripe.Invoice.retrieve(
-        invoice.id, expand=["subscription", "payment_intent"]
-    )
+    with webhook_stage("retrieve"):
+        invoice = stripe_cache.retrieve(
+            stripe.Invoice, invoice.id, expand=["subscription", "payment_intent"]
+        )
     if invoice.billing_reason != "subscription_cycle":
         # No email unless it's a renewal, they got an error in the
         # Stripe Checkout UX for new subscriptions.
@@ -488,47 +742,153 @@ def stripe_invoice_payment_failed(invoice):
     if is_from_new_app(subscription.metadata):
         print(f"Skipping subscription failure email from new app: {charge.id}")
         return
-    sg = sendgrid.SendGridAPIClient(SENDGRID_API_KEY)
     origin = get_origin(subscription.metadata)
-    try:
-        response = sg.send(
-            email_template_data(
-                template_id=FAILURE_TEMPLATE_ID,
-                charge=charge,
-                frequency="monthly",
-                failure_message=charge.failure_message,
-                renew_url=f"{origin}/{'${:,.2f}'.format(charge.amount * 0.01)}/?frequency=monthly",
-                subscription_id=subscription.id,
-                subscription_url=f"{origin}/subscriptions/{subscription.id}",
-            )
-        )
-        if not (200 <= response.status_code < 300):
+    renew_url = f"{origin}/{format_cents(charge.amount)}/?frequency=monthly"
+    if not already_logged(FAILURE_NOTICE, charge):
+        try:
+            with webhook_stage("email"):
+                response = yield email_batcher.submit(
+                    email_template_data(
+                        template_id=FAILURE_TEMPLATE_ID,
+                        charge=charge,
+                        frequency="monthly",
+                        failure_message=charge.failure_message,
+                        renew_url=renew_url,
+                        subscription_id=subscription.id,
+                        subscription_url=f"{origin}/subscriptions/{subscription.id}",
+                    )
+                )
+            if not (200 <= response.status_code < 300):
+                return abort(400)
+        except exceptions.BadRequestsError:
             return abort(400)
-    except exceptions.BadRequestsError:
-        return abort(400)
+        log_receipt(FAILURE_NOTICE, charge)
     # Cancel the subscription to avoid future charges
     if subscription.status != "canceled":
-        stripe.Subscription.delete(subscription.id)
+        with webhook_stage("cancel"):
+            stripe.Subscription.delete(subscription.id)
+        stripe_cache.invalidate_event_object(subscription)
+        stripe_cache.invalidate_event_object(invoice)
     track_invoice_failure(
         metadata=subscription.metadata, frequency="monthly", charge=charge
     )
 
+
 def is_from_new_app(metadata):
     """Events created by the new www.missionbit.org donation portal should be ignored
     """
     return metadata.get("app") == "www.missionbit.org"
 
+
+WEBHOOK_HANDLERS = {
+    "checkout.session.completed": stripe_checkout_session_completed,
+    "invoice.payment_succeeded": stripe_invoice_payment_succeeded,
+    "invoice.payment_failed": stripe_invoice_payment_failed,
+}
+
+
+def process_webhook_event(event_type, payload):
+    """Run the handler for a verified event payload, called from the webhook queue
+    """
+    event = stripe.Event.construct_from(json.loads(payload), stripe.api_key)
+    obj = event["data"]["object"]
+    print(f"handling {event['type']} id: {obj.id}")
+    # Handlers that send email are generators, see WebhookQueue
+    return WEBHOOK_HANDLERS[event_type](obj)
+
+
+WEBHOOK_QUEUE_PATH = os.environ.get(
+    "WEBHOOK_QUEUE_PATH", os.path.join(app.instance_path, "webhooks.sqlite3")
+)
+webhook_queue = WebhookQueue(
+    WEBHOOK_QUEUE_PATH,
+    process_webhook_event,
+    workers=int(os.environ.get("WEBHOOK_WORKERS", "4")),
+    max_attempts=int(os.environ.get("WEBHOOK_MAX_ATTEMPTS", "25")),
+    retry_base=float(os.environ.get("WEBHOOK_RETRY_BASE", "60")),
+    retry_cap=float(os.environ.get("WEBHOOK_RETRY_CAP", "21600")),
+    logger=app.logger,
+    # Events waiting for their email's batch don't hold a worker
+    max_suspended=email_batcher.max_size,
+    # So that a dead event can be resent from the Stripe dashboard
+    on_dead=lambda event_id: event_ledger.discard(event_id),
+)
+event_ledger = EventLedger(WEBHOOK_QUEUE_PATH, shared=shared_cache)
+# What was sent for each charge, checked against Stripe by reconcile.py
+receipt_log = ReceiptLog(WEBHOOK_QUEUE_PATH)
+# Running donation totals per host for /stats, in their own file so that
+# donation writes don't wait on the queue's lock and compaction or snapshots
+# never touch the queue
+DONATION_STORE_PATH = os.environ.get(
+    "DONATION_STORE_PATH", os.path.join(app.instance_path, "donations.sqlite3")
+)
+donation_store = DonationStore(DONATION_STORE_PATH)
+
+
+def donation_totals(host, since=None):
+    """The /stats body for `host`"""
+    frequencies = donation_store.totals(host, since)
+    amount = sum(t["amount"] for t in frequencies.values())
+    return {
+        "host": host,
+        "since": since,
+        "frequencies": frequencies,
+        "count": sum(t["count"] for t in frequencies.values()),
+        "amount": amount,
+        "total": format_cents(amount),
+    }
+
+
+# Pushes changed totals to /stats/live streams, which only asgi.py serves
+live_totals = LiveTotals(
+    donation_totals,
+    coalesce=float(os.environ.get("LIVE_TOTALS_COALESCE", "0.25")),
+    poll_interval=float(os.environ.get("LIVE_TOTALS_POLL_INTERVAL", "5")),
+    max_subscribers=int(os.environ.get("LIVE_TOTALS_MAX_CLIENTS", "10000")),
+    observe=metrics.observe,
+    logger=app.logger,
+)
+
+
+def warm_up():
+    """Do the work that is otherwise deferred to the first request that needs
+    it, so that a preforking server's workers inherit it
+    """
+    checkout_validator()
+    local_tz()
+    default_ssl_context()
+    for name in app.jinja_env.list_templates(extensions=["html"]):
+        app.jinja_env.get_template(name)
+
+
+def shutdown(timeout=None):
+    """Finish in-flight webhook jobs, then send pending emails and telemetry
+    """
+    webhook_queue.stop(timeout)
+    email_batcher.stop(timeout)
+    telemetry.stop(timeout)
+
+
+@app.before_first_request
+def start_webhook_workers():
+    webhook_queue.start()
+    metrics.start_forwarding(
+        get_telemetry_client, METRICS_FORWARD_INTERVAL, logger=app.logger
+    )
+
+
 @app.route("/hooks", methods=["POST"])
 def stripe_webhook():
     payload = request.data.decode("utf-8")
     sig_header = request.headers.get("Stripe-Signature", None)
     event = None
     try:
-        event = stripe.Webhook.construct_event(
-            payload=payload,
-            sig_header=sig_header,
-            secret=stripe_keys["endpoint_secret"],
-        )
+        with webhook_stage("verify"):
+            event = stripe.Webhook.construct_event(
+                payload=payload,
+                sig_header=sig_header,
+                secret=stripe_keys["endpoint_secret"],
+            )
     except ValueError as e:
         # Invalid payload
         print("Invalid hook payload")
@@ -537,21 +897,175 @@ def stripe_webhook():
         # Invalid signature
         print("Invalid hook signature")
         return "Invalid signature", 400
-    handlers = {
-        "checkout.session.completed": stripe_checkout_session_completed,
-        "invoice.payment_succeeded": stripe_invoice_payment_succeeded,
-        "invoice.payment_failed": stripe_invoice_payment_failed,
-    }
-    handler = handlers.get(event["type"])
-    if handler is not None:
-        obj = event["data"]["object"]
-        print(f"handling {event['type']} id: {obj.id}")
-        handler(obj)
-    else:
+    stripe_cache.invalidate_event_object(event["data"]["object"])
+    if event["type"] not in WEBHOOK_HANDLERS:
         print(f"{event['type']} not handled")
+    elif not event_ledger.add(event["id"]):
+        print(f"skipping duplicate {event['type']} event: {event['id']}")
+        return jsonify({"status": "duplicate"})
+    else:
+        # Acknowledge right away, the handlers run on the webhook queue workers
+        try:
+            webhook_queue.enqueue(event["id"], event["type"], payload)
+        except Exception:
+            event_ledger.discard(event["id"])
+            raise
     return jsonify({"status": "success"})
 
 
+def internal_request_allowed(authorization, remote_addr, token):
+    """Whether a request may see internal stats or metrics
+
+    >>> internal_request_allowed("Bearer s3cret", "203.0.113.7", "s3cret")
+    True
+    >>> internal_request_allowed("Bearer guess", "127.0.0.1", "s3cret")
+    False
+    >>> internal_request_allowed(None, "127.0.0.1", None)
+    True
+    >>> internal_request_allowed(None, "203.0.113.7", None)
+    False
+    """
+    if token:
+        return hmac.compare_digest(
+            (authorization or "").encode("utf-8"), f"Bearer {token}".encode("utf-8")
+        )
+    return remote_addr in ("127.0.0.1", "::1")
+
+
+def internal_only(view):
+    """404 unless `internal_request_allowed`"""
+
+    @functools.wraps(view)
+    def internal_view(*args, **kw):
+        # The socket's address, X-Forwarded-For could be sent by anyone
+        remote_addr = request.environ.get(
+            "werkzeug.proxy_fix.orig_remote_addr", request.remote_addr
+        )
+        if not internal_request_allowed(
+            request.headers.get("Authorization"), remote_addr, INTERNAL_TOKEN
+        ):
+            abort(404)
+        return view(*args, **kw)
+
+    return internal_view
+
+
+@app.route("/internal/stats")
+@internal_only
+def internal_stats():
+    return jsonify(
+        {
+            "webhooks": merge_dicts(
+                webhook_queue.stats(), {"ledger": event_ledger.stats()}
+            ),
+            "email": email_batcher.stats(),
+            "http": http_pool.stats(),
+            "stripe_cache": stripe_cache.stats(),
+            "shared_cache": shared_cache and shared_cache.stats(),
+            "index_cache": index_cache.stats(),
+            "static": compressed_assets.stats(),
+            "telemetry": telemetry.stats(),
+            "breakers": {
+                b.name: b.stats() for b in (stripe_breaker, sendgrid_breaker)
+            },
+            "admission": merge_dicts(
+                admission.stats(), {"stripe_concurrency": stripe_concurrency.stats()}
+            ),
+            "redirects": redirect_table and redirect_table.stats(),
+            "donations": merge_dicts(
+                donation_store.stats(), {"live": live_totals.stats()}
+            ),
+            "latency": metrics.summary(),
+        }
+    )
+
+
+@app.route("/metrics")
+@internal_only
+def prometheus_metrics():
+    gauges = [
+        ("webhook_jobs", {"state": state}, n)
+        for state, n in webhook_queue.depth().items()
+    ]
+    gauges.append(("email_pending", {}, email_batcher.stats()["pending"]))
+    for breaker in (stripe_breaker, sendgrid_breaker):
+        stats = breaker.stats()
+        labels = {"upstream": breaker.name}
+        gauges.append(("breaker_open", labels, int(stats["state"] != "closed")))
+        gauges.append(("breaker_trips", labels, stats["trips"]))
+    gauges.extend(
+        ("telemetry_events", {"state": state}, n)
+        for state, n in telemetry.stats().items()
+    )
+    gauges.extend(
+        ("http_idle_connections", {"origin": origin}, s["idle"])
+        for origin, s in http_pool.stats().items()
+    )
+    admission_stats = admission.stats()
+    concurrency = stripe_concurrency.stats()
+    rejected = merge_dicts(
+        admission_stats["rejected"], {"stripe": concurrency["rejected"]}
+    )
+    gauges.extend(
+        ("admission_rejected", {"reason": reason}, n)
+        for reason, n in rejected.items()
+    )
+    gauges.extend(
+        ("admission_rejected_last_minute", {"reason": reason}, n)
+        for reason, n in admission_stats["rejected_last_minute"].items()
+    )
+    gauges.append(("admission_admitted", {}, admission_stats["admitted"]))
+    gauges.append(("stripe_in_flight", {}, concurrency["in_flight"]))
+    cache_stats = stripe_cache.stats()
+    for tier, stats in cache_stats["tiers"].items():
+        labels = {"tier": tier}
+        gauges.append(("stripe_cache_hits", labels, stats["hits"]))
+        gauges.append(("stripe_cache_misses", labels, stats["misses"]))
+    gauges.append(("stripe_cache_mean_age_seconds", {}, cache_stats["mean_age"]))
+    gauges.append(("stripe_cache_max_age_seconds", {}, cache_stats["max_age"]))
+    ledger = event_ledger.stats()
+    gauges.extend(
+        ("webhook_duplicates", {"tier": tier}, ledger[f"{tier}_hits"])
+        for tier in ("front", "shared", "store")
+    )
+    donations = donation_store.totals()
+    gauges.extend(
+        ("donations", {"frequency": frequency}, t["count"])
+        for frequency, t in donations.items()
+    )
+    gauges.extend(
+        ("donation_cents", {"frequency": frequency}, t["amount"])
+        for frequency, t in donations.items()
+    )
+    if redirect_table is not None:
+        gauges.extend(
+            ("redirects", {"rule": rule}, n)
+            for rule, n in redirect_table.stats().items()
+        )
+    live = live_totals.stats()
+    gauges.append(("live_totals_subscribers", {}, live["subscribers"]))
+    gauges.append(("live_totals_superseded", {}, live["superseded"]))
+    return (
+        metrics.prometheus(gauges),
+        200,
+        {"Content-Type": "text/plain; version=0.0.4; charset=utf-8"},
+    )
+
+
+@app.route("/stats")
+def donation_stats():
+    host = request.args.get("host", urlsplit(request.url).netloc)
+    since = request.args.get("since")
+    if since is not None:
+        try:
+            since = int(since)
+        except ValueError:
+            return jsonify({"error": "since must be a unix timestamp"}), 400
+    response = jsonify(donation_totals(host, since))
+    response.headers["Cache-Control"] = "no-cache"
+    return response
+
+
 def host_default_amount(host):
     if host.startswith("gala."):
         return "$250"
@@ -562,15 +1076,17 @@ def host_default_amount(host):
 @app.route("/subscriptions/<subscription_id>")
 def subscription(subscription_id):
     if REDIRECT_TO_WWW:
-        return redirect(f"https://www.missionbit.org/donate/subscriptions/{subscription_id}")
+        return redirect(f"{WWW_DONATE_URL}/subscriptions/{subscription_id}")
     try:
-        subscription = stripe.Subscription.retrieve(
-            subscription_id, expand=["default_payment_method"]
+        subscription = stripe_cache.retrieve(
+            stripe.Subscription,
+            subscription_id,
+            expand=["default_payment_method"],
+            allow_stale=True,
         )
     except stripe.error.InvalidRequestError:
         return redirect("/")
     pm = subscription.default_payment_method
-    next_dt = datetime.fromtimestamp(subscription.current_period_end, LOCAL_TZ)
     return render_template(
         "subscription.html",
         donate_email=DONATE_EMAIL,
@@ -578,18 +1094,20 @@ def subscription(subscription_id):
         id=subscription.id,
         frequency="monthly",
         amount=subscription.plan.amount * subscription.quantity,
-        payment_method=format_payment_method_details_source(pm),
-        next_cycle=f"{next_dt.strftime('%b')} {next_dt.day}, {next_dt.year}",
+        payment_method=payment_method_label(pm),
+        next_cycle=long_date(subscription.current_period_end),
         **billing_details_to(pm.billing_details),
     )
 
 
 @app.route("/subscriptions/<subscription_id>", methods=["POST"])
+@admission_controlled
 def delete_subscription(subscription_id):
     try:
         stripe.Subscription.delete(subscription_id)
     except stripe.error.InvalidRequestError:
         return redirect(f"/subscriptions/{subscription_id}")
+    stripe_cache.invalidate("subscription", subscription_id)
     return redirect(f"/subscriptions/{subscription_id}")
 
 
@@ -598,21 +1116,30 @@ def delete_subscription(subscription_id):
 @app.route("/<dollars>/")
 def index(dollars=""):
     if REDIRECT_TO_WWW:
-        return redirect("https://www.missionbit.org/donate")
+        return redirect(WWW_DONATE_URL)
     host = urlsplit(request.url).netloc
     frequency = (
         "monthly" if request.args.get("frequency", "once") == "monthly" else "once"
     )
     amount = parse_cents(dollars) or parse_cents(host_default_amount(host))
-    return render_template(
-        "index.html",
-        key=stripe_keys["publishable_key"],
-        metadata=merge_dicts(request.args, {"host": host}),
-        frequency=frequency,
-        formatted_dollar_amount="{:.2f}".format(amount * 0.01)
-        if amount % 100
-        else f"{amount // 100}",
+    metadata = merge_dicts(request.args, {"host": host})
+    page = index_cache.get(
+        (amount, frequency, tuple(sorted(metadata.items()))),
+        lambda: render_template(
+            "index.html",
+            key=stripe_keys["publishable_key"],
+            metadata=metadata,
+            frequency=frequency,
+            formatted_dollar_amount="{:.2f}".format(amount * 0.01)
+            if amount % 100
+            else f"{amount // 100}",
+        ),
     )
+    response = app.response_class(page.body, mimetype="text/html")
+    response.set_etag(page.etag)
+    # Allow browsers and the CDN to revalidate with If-None-Match
+    response.headers["Cache-Control"] = "no-cache"
+    return response.make_conditional(request)
 
 
 if CANONICAL_HOSTS:
@@ -630,5 +1157,35 @@ if CANONICAL_HOSTS:
         return redirect(url, code=302)
 
 
+def www_redirects():
+    """RedirectTable rules for the routes that redirect with REDIRECT_TO_WWW"""
+    return dict(
+        page_redirects={"/": WWW_DONATE_URL},
+        # /<dollars> and /<dollars>/, unless another GET route has the path
+        segment_redirect=WWW_DONATE_URL,
+        reserved=[
+            rule.rule
+            for rule in app.url_map.iter_rules()
+            if not rule.arguments and "GET" in rule.methods
+        ],
+        prefix_redirects={"subscriptions": f"{WWW_DONATE_URL}/subscriptions/"},
+    )
+
+
+# Redirects to www and to the CDN are answered before the proxy fixers and
+# Flask, which most requests would otherwise go through only to be redirected.
+# The views and redirect_to_cdn still give the same Location, after the
+# trailing slash redirect werkzeug sends first for /<dollars>.
+if REDIRECT_TO_WWW or CANONICAL_HOSTS:
+    redirect_table = RedirectTable(
+        app.wsgi_app,
+        canonical_hosts=CANONICAL_HOSTS,
+        **(www_redirects() if REDIRECT_TO_WWW else {}),
+    )
+    app.wsgi_app = redirect_table
+else:
+    redirect_table = None
+
+
 if __name__ == "__main__":
     app.run(debug=True)
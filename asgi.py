@@ -0,0 +1,446 @@
+"""ASGI entry point with a non-blocking /checkout and live donation totals
+
+POST /checkout is handled on the event loop and awaits Stripe through an
+asyncio connection pool, so a single process can hold hundreds of in-flight
+checkouts. GET /stats/live streams a host's donation totals as server-sent
+events, thousands of idle streams at a time. Every other request is passed
+to the WSGI app from application.py on a thread pool. Run it with any ASGI
+server, e.g.
+
+    $ uvicorn asgi:app
+"""
+import asyncio
+import http.client
+import io
+import json
+import math
+import os
+import sys
+from concurrent.futures import ThreadPoolExecutor
+from urllib.parse import parse_qs, urlencode
+
+import stripe
+from stripe.api_requestor import APIRequestor
+
+import application
+from http_pool import (
+    AsyncConnectionPool,
+    CircuitOpen,
+    StripeBusy,
+    check_breaker,
+    record_outcome,
+    upstream_span,
+)
+
+__all__ = ["app", "create_checkout_session", "live_totals_stream", "WSGIBridge"]
+
+CHECKOUT_CONCURRENCY = int(os.environ.get("CHECKOUT_CONCURRENCY", "500"))
+# Seconds between comments on an idle /stats/live stream, so that proxies
+# keep it open
+LIVE_TOTALS_HEARTBEAT = float(os.environ.get("LIVE_TOTALS_HEARTBEAT", "15"))
+# A stream whose client hasn't accepted an event in this many seconds is
+# closed
+LIVE_TOTALS_SEND_TIMEOUT = float(os.environ.get("LIVE_TOTALS_SEND_TIMEOUT", "30"))
+# Seconds to finish webhook jobs and send pending receipts and telemetry on
+# shutdown, as gunicorn.conf.py does
+GRACEFUL_TIMEOUT = float(os.environ.get("GRACEFUL_TIMEOUT", "30"))
+
+stripe_pool = AsyncConnectionPool(
+    maxsize=CHECKOUT_CONCURRENCY, timeout=float(os.environ.get("STRIPE_TIMEOUT", "30"))
+)
+
+
+def form_encode(params, prefix=None):
+    """(key, value) pairs for Stripe's form encoding of nested `params`, as
+    stripe-python encodes them (without using its private helper)
+
+    >>> list(form_encode({'line_items': [{'amount': 500, 'currency': 'usd'}],
+    ...                   'metadata': {'host': 'gala'}, 'customer': None}))
+    [('line_items[0][amount]', '500'), ('line_items[0][currency]', 'usd'), ('metadata[host]', 'gala')]
+    """
+    items = enumerate(params) if isinstance(params, (list, tuple)) else params.items()
+    for key, value in items:
+        key = key if prefix is None else f"{prefix}[{key}]"
+        if value is None:
+            continue
+        if hasattr(value, "stripe_id"):
+            yield key, str(value.stripe_id)
+        elif isinstance(value, (dict, list, tuple)):
+            yield from form_encode(value, key)
+        else:
+            yield key, str(value)
+
+
+async def stripe_post(path, params):
+    """POST to the Stripe API on the event loop, returning a StripeObject
+
+    Takes one of application.stripe_concurrency's slots, like every Stripe
+    call from the WSGI app, and raises StripeBusy without one.
+    """
+    requestor = APIRequestor()
+    post_data = urlencode(list(form_encode(params)))
+    post_data = post_data.replace("%5B", "[").replace("%5D", "]")
+    headers = requestor.request_headers(stripe.api_key, "post")
+    url = f"{requestor.api_base}{path}"
+    breaker = application.stripe_breaker
+    limit = application.stripe_concurrency
+    if not await limit.acquire_async(application.STRIPE_CONCURRENCY_WAIT):
+        raise StripeBusy("Too many Stripe requests in flight, try again shortly")
+    try:
+        try:
+            check_breaker(breaker, "Stripe")
+        except CircuitOpen as e:
+            raise stripe.error.APIConnectionError(f"Stripe is unavailable ({e})")
+        try:
+            with upstream_span(application.metrics, "stripe", "POST", url):
+                response = await stripe_pool.request(
+                    "POST", url, body=post_data, headers=headers
+                )
+        except (OSError, asyncio.TimeoutError, http.client.HTTPException) as e:
+            record_outcome(breaker, 599)
+            raise stripe.error.APIConnectionError(
+                f"Unexpected error communicating with Stripe. (Network error: {e!r})"
+            )
+        except BaseException:
+            # e.g. the request was cancelled, which must not leave a half
+            # open breaker waiting for its probe
+            record_outcome(breaker, 599)
+            raise
+    finally:
+        limit.release()
+    record_outcome(breaker, response.status)
+    rheaders = {k.lower(): v for k, v in response.headers.items()}
+    resp = requestor.interpret_response(response.body, response.status, rheaders)
+    return stripe.util.convert_to_stripe_object(resp, stripe.api_key)
+
+
+async def create_checkout_session(**params):
+    return await stripe_post("/v1/checkout/sessions", params)
+
+
+def header_dict(scope):
+    rval = {}
+    for name, value in scope.get("headers", []):
+        name = name.decode("latin-1").lower()
+        value = value.decode("latin-1")
+        rval[name] = f"{rval[name]},{value}" if name in rval else value
+    return rval
+
+
+def request_origin(scope, headers):
+    """(scheme, host) as application.app would see them behind its proxy fixers
+    """
+    scheme = scope.get("scheme", "http")
+    host = headers.get("host", "")
+    if application.CANONICAL_HOSTS:
+        x_host = headers.get("x-host")
+        forwarded_host = (
+            x_host if x_host in application.CANONICAL_HOSTS else None
+        ) or headers.get("x-forwarded-host")
+        if forwarded_host:
+            host = forwarded_host.split(",")[-1].strip()
+        forwarded_proto = headers.get("x-forwarded-proto")
+        if forwarded_proto:
+            scheme = forwarded_proto.split(",")[-1].strip()
+    return scheme, host
+
+
+def client_ip(scope, headers):
+    """The client address as application.app would see it behind ProxyFix"""
+    if application.CANONICAL_HOSTS:
+        forwarded_for = headers.get("x-forwarded-for")
+        if forwarded_for:
+            return forwarded_for.split(",")[-1].strip()
+    client = scope.get("client")
+    return client[0] if client else None
+
+
+async def read_body(receive):
+    chunks = []
+    while True:
+        message = await receive()
+        chunks.append(message.get("body", b""))
+        if not message.get("more_body"):
+            return b"".join(chunks)
+
+
+async def send_json(send, status, obj, headers=()):
+    body = json.dumps(obj).encode("utf-8")
+    await send(
+        {
+            "type": "http.response.start",
+            "status": status,
+            "headers": [
+                (b"content-type", b"application/json"),
+                (b"content-length", str(len(body)).encode("latin-1")),
+                (b"cache-control", b"no-cache, no-store, must-revalidate"),
+                *headers,
+            ],
+        }
+    )
+    await send({"type": "http.response.body", "body": body})
+
+
+async def too_many_requests(send, retry_after):
+    """application.too_many_requests for a JSON request"""
+    retry_after = str(max(1, math.ceil(retry_after)))
+    await send_json(
+        send,
+        429,
+        {"error": "Too many requests, please try again shortly"},
+        [(b"retry-after", retry_after.encode("latin-1"))],
+    )
+
+
+async def stripe_unavailable(send, e):
+    """application.handle_stripe_unavailable for a JSON request"""
+    application.app.logger.error(f"Stripe unavailable: {e!r}")
+    retry_after = str(int(application.stripe_breaker.reset_timeout))
+    await send_json(
+        send,
+        503,
+        {"error": "Stripe is unavailable, please try again"},
+        [(b"retry-after", retry_after.encode("latin-1"))],
+    )
+
+
+class CheckoutLimiter:
+    """Bounds concurrent Stripe session creations and tracks in-flight counts"""
+
+    def __init__(self, limit):
+        self.limit = limit
+        self.in_flight = 0
+        self.max_in_flight = 0
+        self.completed = 0
+        self._semaphore = None
+
+    async def __aenter__(self):
+        if self._semaphore is None:
+            # Created lazily so that it belongs to the server's event loop
+            self._semaphore = asyncio.Semaphore(self.limit)
+        await self._semaphore.acquire()
+        self.in_flight += 1
+        self.max_in_flight = max(self.max_in_flight, self.in_flight)
+
+    async def __aexit__(self, *exc_info):
+        self.in_flight -= 1
+        self.completed += 1
+        self._semaphore.release()
+
+
+checkout_limiter = CheckoutLimiter(CHECKOUT_CONCURRENCY)
+
+
+async def checkout(scope, receive, send, origin, headers):
+    rejected = application.admission.check(
+        client_ip(scope, headers),
+        application.origin_key(headers.get("origin"), headers.get("referer")),
+    )
+    if rejected is not None:
+        return await too_many_requests(send, rejected.retry_after)
+    body = await read_body(receive)
+    try:
+        data = json.loads(body)
+    except ValueError:
+        data = None
+    try:
+        params = application.checkout_session_params(data, origin)
+    except application.InvalidCheckout as e:
+        return await send_json(send, 400, e.body)
+    try:
+        async with checkout_limiter:
+            session = await create_checkout_session(**params)
+    except StripeBusy:
+        return await too_many_requests(send, 1)
+    except (stripe.error.APIConnectionError, stripe.error.APIError) as e:
+        return await stripe_unavailable(send, e)
+    except stripe.error.StripeError as e:
+        application.app.logger.error(f"checkout failed: {e!r}")
+        return await send_json(send, 502, {"error": e.user_message})
+    await send_json(send, 200, {"sessionId": session.id})
+
+
+async def live_totals_stream(
+    scope, receive, send, host, send_timeout=LIVE_TOTALS_SEND_TIMEOUT
+):
+    """Stream `host`'s totals until the client disconnects
+
+    A client that doesn't accept an event within `send_timeout` seconds has
+    its response aborted and its slot freed, even though the send never
+    returns.
+
+    >>> async def never(message):
+    ...     if message.get("more_body"):
+    ...         await asyncio.get_event_loop().create_future()
+    >>> async def connected():
+    ...     await asyncio.get_event_loop().create_future()
+    >>> async def demo():
+    ...     scope = {"query_string": b""}
+    ...     await live_totals_stream(scope, connected, never, "doctest", 0.01)
+    ...     # Let the fan-out task finish cancelling
+    ...     await asyncio.sleep(0.01)
+    ...     return application.live_totals.stats()["subscribers"]
+    >>> asyncio.new_event_loop().run_until_complete(demo())
+    0
+    """
+    query = parse_qs(scope.get("query_string", b"").decode("latin-1"))
+    host = query.get("host", [host])[0]
+    live = application.live_totals
+    subscriber = live.subscribe(host)
+    if subscriber is None:
+        return await send_json(
+            send,
+            503,
+            {"error": "Too many live streams, poll /stats instead"},
+            [(b"retry-after", b"30")],
+        )
+
+    async def wait_for_disconnect():
+        while (await receive())["type"] != "http.disconnect":
+            pass
+        subscriber.close()
+
+    watcher = asyncio.ensure_future(wait_for_disconnect())
+    try:
+        await send(
+            {
+                "type": "http.response.start",
+                "status": 200,
+                "headers": [
+                    (b"content-type", b"text/event-stream"),
+                    (b"cache-control", b"no-cache, no-store, must-revalidate"),
+                    # Don't let nginx buffer the stream
+                    (b"x-accel-buffering", b"no"),
+                ],
+            }
+        )
+        while not subscriber.closed:
+            event = await subscriber.get(LIVE_TOTALS_HEARTBEAT)
+            if subscriber.closed:
+                break
+            body = b": heartbeat\n\n" if event is None else event[0]
+            # Cancels a send to a client that stopped reading. Returning
+            # without finishing the response makes the server drop the
+            # connection.
+            await asyncio.wait_for(
+                send({"type": "http.response.body", "body": body, "more_body": True}),
+                send_timeout,
+            )
+            if event is not None:
+                live.delivered(event[1])
+    except (OSError, asyncio.TimeoutError):
+        pass
+    finally:
+        live.unsubscribe(subscriber)
+        watcher.cancel()
+
+
+class WSGIBridge:
+    """Run a WSGI app on a thread pool for requests the ASGI app doesn't handle"""
+
+    def __init__(self, wsgi_app, max_workers=None):
+        self.wsgi_app = wsgi_app
+        self.executor = ThreadPoolExecutor(
+            max_workers=max_workers, thread_name_prefix="wsgi"
+        )
+
+    def environ(self, scope, body):
+        server = scope.get("server") or ("localhost", 80)
+        client = scope.get("client") or ("", 0)
+        environ = {
+            "REQUEST_METHOD": scope["method"],
+            "SCRIPT_NAME": scope.get("root_path", ""),
+            "PATH_INFO": scope["path"].encode("utf-8").decode("latin-1"),
+            "QUERY_STRING": scope.get("query_string", b"").decode("latin-1"),
+            "SERVER_NAME": server[0],
+            "SERVER_PORT": str(server[1]),
+            "SERVER_PROTOCOL": f"HTTP/{scope.get('http_version', '1.1')}",
+            "REMOTE_ADDR": client[0],
+            "wsgi.version": (1, 0),
+            "wsgi.url_scheme": scope.get("scheme", "http"),
+            "wsgi.input": io.BytesIO(body),
+            "wsgi.errors": sys.stderr,
+            "wsgi.multithread": True,
+            "wsgi.multiprocess": True,
+            "wsgi.run_once": False,
+        }
+        for name, value in header_dict(scope).items():
+            if name == "content-type":
+                environ["CONTENT_TYPE"] = value
+            elif name == "content-length":
+                environ["CONTENT_LENGTH"] = value
+            else:
+                environ["HTTP_" + name.upper().replace("-", "_")] = value
+        return environ
+
+    def run(self, environ):
+        response = {}
+
+        def start_response(status, headers, exc_info=None):
+            response["status"] = int(status.split(" ", 1)[0])
+            response["headers"] = [
+                (k.lower().encode("latin-1"), v.encode("latin-1")) for k, v in headers
+            ]
+            return chunks.append
+
+        chunks = []
+        result = self.wsgi_app(environ, start_response)
+        try:
+            chunks.extend(result)
+        finally:
+            if hasattr(result, "close"):
+                result.close()
+        return response["status"], response["headers"], b"".join(chunks)
+
+    async def __call__(self, scope, receive, send, body=None):
+        if body is None:
+            body = await read_body(receive)
+        loop = asyncio.get_running_loop()
+        status, headers, content = await loop.run_in_executor(
+            self.executor, self.run, self.environ(scope, body)
+        )
+        await send(
+            {"type": "http.response.start", "status": status, "headers": headers}
+        )
+        await send({"type": "http.response.body", "body": content})
+
+
+wsgi = WSGIBridge(application.app)
+
+
+async def lifespan(scope, receive, send):
+    loop = asyncio.get_event_loop()
+    while True:
+        message = await receive()
+        if message["type"] == "lifespan.startup":
+            # Pick up queued webhooks right away instead of on the first request
+            application.start_webhook_workers()
+            await send({"type": "lifespan.startup.complete"})
+        elif message["type"] == "lifespan.shutdown":
+            await loop.run_in_executor(None, application.shutdown, GRACEFUL_TIMEOUT)
+            await send({"type": "lifespan.shutdown.complete"})
+            return
+
+
+async def app(scope, receive, send):
+    if scope["type"] == "lifespan":
+        return await lifespan(scope, receive, send)
+    if scope["type"] == "websocket":
+        # There are no websocket routes, refuse the handshake with a 403
+        return await send({"type": "websocket.close"})
+    if scope["type"] != "http":
+        return
+    if scope["method"] == "POST" and scope["path"] == "/checkout":
+        headers = header_dict(scope)
+        scheme, host = request_origin(scope, headers)
+        canonical = scheme == "https" and host in application.CANONICAL_HOSTS
+        if canonical or not application.CANONICAL_HOSTS:
+            return await checkout(scope, receive, send, f"{scheme}://{host}", headers)
+    if scope["method"] == "GET" and scope["path"] == "/stats/live":
+        headers = header_dict(scope)
+        scheme, host = request_origin(scope, headers)
+        canonical = scheme == "https" and host in application.CANONICAL_HOSTS
+        if canonical or not application.CANONICAL_HOSTS:
+            return await live_totals_stream(scope, receive, send, host)
+    # Anything else, including canonical host redirects, is up to Flask
+    return await wsgi(scope, receive, send)
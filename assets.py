@@ -0,0 +1,330 @@
+"""Content-hashed static asset manifest
+
+The manifest maps every file under static/ to a fingerprinted URL that
+includes a prefix of its SHA1 digest, e.g. /static/css/style.css becomes
+/static/css/style.1a2b3c4d.css. It is built once at startup (or loaded from
+a prebuilt JSON file) so that looking up an asset URL is a dict lookup.
+
+Text assets are also compressed once (gzip, plus brotli when the optional
+brotli package is installed) and kept in memory so that responses only need
+to pick the best encoding the client accepts.
+
+Without a prebuilt manifest, the manifest and compressed copies can be
+shared through a cache backend (see cache_backends), so that only the first
+worker or instance of a deployment hashes and compresses the files.
+
+To prebuild the manifest during deployment:
+
+    $ python assets.py static/manifest.json
+"""
+import hashlib
+import json
+import os
+import posixpath
+import sys
+import threading
+import zlib
+
+from cache_backends import CacheError
+
+try:
+    import brotli
+except ImportError:
+    brotli = None
+
+__all__ = [
+    "AssetManifest",
+    "CompressedAssets",
+    "fingerprint_name",
+    "IMMUTABLE_CACHE_CONTROL",
+    "pack_variants",
+    "unpack_variants",
+]
+
+HASH_LENGTH = 8
+IMMUTABLE_CACHE_CONTROL = "public, max-age=31536000, immutable"
+MANIFEST_NAME = "manifest.json"
+COMPRESSIBLE_EXTENSIONS = {".css", ".js", ".svg", ".txt", ".json", ".html", ".ico"}
+# Not worth a Content-Encoding header below this size or ratio
+MIN_COMPRESS_SIZE = 256
+MAX_COMPRESS_RATIO = 0.9
+# Instances with and without brotli cache different variants
+ENCODERS = "gzip+br" if brotli is not None else "gzip"
+
+
+def fingerprint_name(filename: str, digest: str) -> str:
+    """Insert the digest before the file extension
+
+    >>> fingerprint_name('css/style.css', '1a2b3c4d')
+    'css/style.1a2b3c4d.css'
+    >>> fingerprint_name('apple-developer-merchantid-domain-association', '1a2b3c4d')
+    'apple-developer-merchantid-domain-association.1a2b3c4d'
+    """
+    root, ext = posixpath.splitext(filename)
+    return f"{root}.{digest[:HASH_LENGTH]}{ext}"
+
+
+def static_files(static_folder: str):
+    """(name relative to the static folder, path) of every static file"""
+    for dirpath, dirnames, filenames in os.walk(static_folder):
+        dirnames.sort()
+        for filename in sorted(filenames):
+            path = os.path.join(dirpath, filename)
+            name = os.path.relpath(path, static_folder).replace(os.sep, "/")
+            if name != MANIFEST_NAME:
+                yield name, path
+
+
+def static_signature(static_folder: str) -> str:
+    """Changes whenever a static file is added, removed, resized or touched"""
+    h = hashlib.sha1()
+    for name, path in static_files(static_folder):
+        st = os.stat(path)
+        h.update(f"{name}\0{st.st_size}\0{st.st_mtime_ns}\n".encode("utf-8"))
+    return h.hexdigest()
+
+
+def cache_get(cache, key):
+    try:
+        return cache.get(key)
+    except CacheError:
+        return None
+
+
+def cache_set(cache, key, value: bytes) -> None:
+    try:
+        cache.set(key, value)
+    except CacheError:
+        pass
+
+
+def file_digest(path: str) -> str:
+    h = hashlib.sha1()
+    with open(path, "rb") as f:
+        for chunk in iter(lambda: f.read(65536), b""):
+            h.update(chunk)
+    return h.hexdigest()
+
+
+class AssetManifest:
+    """Maps static file names (relative to the static folder) to fingerprinted names
+
+    >>> manifest = AssetManifest({'css/style.css': 'css/style.1a2b3c4d.css'})
+    >>> manifest.url('/static/css/style.css')
+    '/static/css/style.1a2b3c4d.css'
+    >>> manifest.url('/static/missing.css')
+    '/static/missing.css'
+    >>> manifest.resolve('css/style.1a2b3c4d.css')
+    'css/style.css'
+    """
+
+    def __init__(self, files: dict, url_path: str = "/static"):
+        self.files = files
+        self.url_path = url_path
+        self.urls = {
+            f"{url_path}/{name}": f"{url_path}/{fingerprinted}"
+            for name, fingerprinted in files.items()
+        }
+        self.originals = {fingerprinted: name for name, fingerprinted in files.items()}
+
+    @classmethod
+    def build(cls, static_folder: str, url_path: str = "/static"):
+        files = {}
+        for name, path in static_files(static_folder):
+            files[name] = fingerprint_name(name, file_digest(path))
+        return cls(files, url_path)
+
+    @classmethod
+    def load(cls, path: str, url_path: str = "/static"):
+        with open(path, "r") as f:
+            return cls(json.load(f), url_path)
+
+    @classmethod
+    def from_static_folder(
+        cls, static_folder: str, url_path: str = "/static", cache=None
+    ):
+        """Load a prebuilt manifest if one was deployed, otherwise build it,
+        or get it from `cache` if another process built it for the same files
+        """
+        path = os.path.join(static_folder, MANIFEST_NAME)
+        if os.path.exists(path):
+            return cls.load(path, url_path)
+        if cache is None:
+            return cls.build(static_folder, url_path)
+        key = f"asset-manifest:{static_signature(static_folder)}"
+        data = cache_get(cache, key)
+        if data is not None:
+            return cls(json.loads(data.decode("utf-8")), url_path)
+        manifest = cls.build(static_folder, url_path)
+        cache_set(cache, key, json.dumps(manifest.files).encode("utf-8"))
+        return manifest
+
+    def save(self, path: str) -> None:
+        with open(path, "w") as f:
+            json.dump(self.files, f, indent=2, sort_keys=True)
+            f.write("\n")
+
+    def url(self, path: str) -> str:
+        return self.urls.get(path, path)
+
+    def resolve(self, filename: str):
+        """The original name of a fingerprinted file name, or None"""
+        return self.originals.get(filename)
+
+
+def gzip_bytes(data: bytes) -> bytes:
+    """Deterministic (zero mtime) gzip at the highest compression level
+
+    >>> import gzip
+    >>> gzip.decompress(gzip_bytes(b'body { color: red }'))
+    b'body { color: red }'
+    """
+    compressor = zlib.compressobj(9, zlib.DEFLATED, 31)
+    return compressor.compress(data) + compressor.flush()
+
+
+def pack_variants(variants: dict) -> bytes:
+    """Serialize {encoding: body} for a cache backend
+
+    >>> unpack_variants(pack_variants({'gzip': b'gz', 'br': b'brotli'}))
+    {'gzip': b'gz', 'br': b'brotli'}
+    >>> unpack_variants(pack_variants({}))
+    {}
+    """
+    header = json.dumps([[k, len(v)] for k, v in variants.items()])
+    return header.encode("utf-8") + b"\n" + b"".join(variants.values())
+
+
+def unpack_variants(data: bytes) -> dict:
+    header, _, body = data.partition(b"\n")
+    variants = {}
+    offset = 0
+    for encoding, length in json.loads(header.decode("utf-8")):
+        variants[encoding] = body[offset : offset + length]
+        offset += length
+    return variants
+
+
+def compress_variants(data: bytes) -> dict:
+    variants = {}
+    if len(data) < MIN_COMPRESS_SIZE:
+        return variants
+    encoders = [("gzip", gzip_bytes)]
+    if brotli is not None:
+        encoders.append(("br", lambda b: brotli.compress(b, quality=11)))
+    for encoding, encode in encoders:
+        encoded = encode(data)
+        if len(encoded) <= MAX_COMPRESS_RATIO * len(data):
+            variants[encoding] = encoded
+    return variants
+
+
+class CompressedAssets:
+    """Precompressed copies of text assets, chosen by Accept-Encoding
+
+    >>> from werkzeug.http import parse_accept_header
+    >>> assets = CompressedAssets({'js/donate.js': {'gzip': b'gz', 'br': b'br'}})
+    >>> assets.negotiate('js/donate.js', parse_accept_header('gzip, deflate, br'))
+    ('br', b'br')
+    >>> assets.negotiate('js/donate.js', parse_accept_header('gzip, br;q=0'))
+    ('gzip', b'gz')
+    >>> assets.negotiate('js/donate.js', parse_accept_header(''))
+    (None, None)
+    >>> assets.negotiate('favicon.ico', parse_accept_header('gzip'))
+    (None, None)
+    """
+
+    # In order of preference
+    ENCODINGS = ("br", "gzip")
+
+    def __init__(
+        self, variants: dict, original_sizes: dict = None, cache_counters: dict = None
+    ):
+        self.variants = variants
+        self.original_sizes = original_sizes or {}
+        self.cache_counters = cache_counters or {"hits": 0, "misses": 0}
+        self._lock = threading.Lock()
+        self.bytes_sent = {}
+        self.responses = {}
+
+    @classmethod
+    def build(cls, static_folder: str, files: dict, cache=None):
+        """Compress the text files among `files` (an AssetManifest's files)
+
+        With a `cache`, compressed copies are looked up by fingerprinted name
+        before compressing them.
+        """
+        variants = {}
+        original_sizes = {}
+        cache_counters = {"hits": 0, "misses": 0}
+        for name in files:
+            if posixpath.splitext(name)[1] not in COMPRESSIBLE_EXTENSIONS:
+                continue
+            path = os.path.join(static_folder, name)
+            encoded = None
+            if cache is not None:
+                key = f"asset:{files[name]}:{ENCODERS}"
+                data = cache_get(cache, key)
+                if data is not None:
+                    cache_counters["hits"] += 1
+                    encoded = unpack_variants(data)
+                    size = os.path.getsize(path)
+                else:
+                    cache_counters["misses"] += 1
+            if encoded is None:
+                with open(path, "rb") as f:
+                    data = f.read()
+                encoded = compress_variants(data)
+                size = len(data)
+                if cache is not None:
+                    cache_set(cache, key, pack_variants(encoded))
+            if encoded:
+                variants[name] = encoded
+                original_sizes[name] = size
+        return cls(variants, original_sizes, cache_counters)
+
+    def has_variants(self, name: str) -> bool:
+        return name in self.variants
+
+    def negotiate(self, name: str, accept_encodings):
+        """The (encoding, body) to send for `name`, or (None, None) for identity"""
+        variants = self.variants.get(name)
+        if variants:
+            for encoding in self.ENCODINGS:
+                if encoding in variants and accept_encodings.quality(encoding) > 0:
+                    return encoding, variants[encoding]
+        return None, None
+
+    def record(self, encoding: str, nbytes: int) -> None:
+        with self._lock:
+            self.bytes_sent[encoding] = self.bytes_sent.get(encoding, 0) + nbytes
+            self.responses[encoding] = self.responses.get(encoding, 0) + 1
+
+    def stats(self) -> dict:
+        with self._lock:
+            served = {
+                encoding: {"responses": n, "bytes": self.bytes_sent[encoding]}
+                for encoding, n in self.responses.items()
+            }
+        return {
+            "served": served,
+            "cache": dict(self.cache_counters),
+            "files": {
+                name: dict(
+                    {k: len(v) for k, v in variants.items()},
+                    identity=self.original_sizes.get(name),
+                )
+                for name, variants in self.variants.items()
+            },
+        }
+
+
+if __name__ == "__main__":
+    static_folder = os.path.join(os.path.dirname(os.path.abspath(__file__)), "static")
+    output = sys.argv[1] if len(sys.argv) > 1 else None
+    manifest = AssetManifest.build(static_folder)
+    if output:
+        manifest.save(output)
+    else:
+        json.dump(manifest.files, sys.stdout, indent=2, sort_keys=True)
+        print()
@@ -0,0 +1,117 @@
+"""Per-request cost of admission control, and a card testing flood against it
+
+First times `admission.check` on its own: one client admitted over and over,
+one client being rejected, and a new IP every call (so the bucket table
+stays full and evicts on every call). Then it sends a flood of `--bot`
+checkouts from one IP, interleaved with `--donors` checkouts from distinct
+IPs, at `--rate` requests/s through the Flask app to a local Stripe
+stand-in. It reports latency of admitted and rejected requests, and how
+many of each reached Stripe.
+
+    $ python benchmarks/admission_control.py --bot 2000 --donors 200 --rate 100
+"""
+import argparse
+import itertools
+import json
+import sys
+import time
+
+from common import load_app, measure, percentile, report
+from fake_stripe import FakeStripe
+
+BODY = json.dumps({"amount": 5000, "frequency": "once", "metadata": {}})
+
+
+def check_overhead(admission_module, n):
+    admission = admission_module.AdmissionControl(
+        ip_rate=0.1, ip_burst=10, origin_rate=1e9, origin_burst=1e9, max_keys=10000
+    )
+    origin = "https://donate.missionbit.org"
+    for _ in range(20):
+        admission.check("192.0.2.1", origin)
+    ips = (f"10.{i >> 16 & 255}.{i >> 8 & 255}.{i & 255}" for i in itertools.count())
+    cases = [
+        ("check (admitted)", lambda: admission.check("192.0.2.2", origin)),
+        ("check (rejected)", lambda: admission.check("192.0.2.1", origin)),
+        ("check (new IP, evicting)", lambda: admission.check(next(ips), origin)),
+        (
+            "origin_key",
+            lambda: admission_module.origin_key(None, "https://gala.missionbit.org/"),
+        ),
+    ]
+    # Enough distinct IPs to fill the table before measuring evictions
+    for _ in range(10000):
+        admission.check(next(ips), origin)
+    for name, fn in cases:
+        rate, latencies = measure(fn, n)
+        report(name, rate, latencies)
+    print("buckets tracked: {}".format(admission.stats()["tracked_keys"]))
+
+
+def flood(application, bots, donors, rate):
+    client = application.app.test_client()
+    origin = {"Origin": "https://donate.missionbit.org"}
+    latencies = {200: [], 429: []}
+    statuses = {"bot": {}, "donor": {}}
+    requests = [("bot", "203.0.113.7")] * bots
+    step = max(1, bots // max(donors, 1))
+    for i in range(donors):
+        requests.insert(i * (step + 1), ("donor", f"198.51.{i >> 8 & 255}.{i & 255}"))
+    start = time.perf_counter()
+    for i, (who, ip) in enumerate(requests):
+        delay = start + i / rate - time.perf_counter()
+        if delay > 0:
+            time.sleep(delay)
+        t0 = time.perf_counter()
+        response = client.post(
+            "/checkout",
+            data=BODY,
+            content_type="application/json",
+            headers=origin,
+            environ_base={"REMOTE_ADDR": ip},
+        )
+        latencies.setdefault(response.status_code, []).append(time.perf_counter() - t0)
+        counts = statuses[who]
+        counts[response.status_code] = counts.get(response.status_code, 0) + 1
+    for status, values in sorted(latencies.items()):
+        if values:
+            print(
+                "HTTP {}: {:>6} responses  p50 {:>8.3f} ms  p99 {:>8.3f} ms".format(
+                    status,
+                    len(values),
+                    1000 * percentile(values, 50),
+                    1000 * percentile(values, 99),
+                )
+            )
+    print("by client: {}".format(statuses))
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description=__doc__.split("\n", 1)[0])
+    parser.add_argument("--checks", type=int, default=100000)
+    parser.add_argument("--bot", type=int, default=2000)
+    parser.add_argument("--donors", type=int, default=200)
+    parser.add_argument("--rate", type=float, default=100.0)
+    parser.add_argument("--stripe-latency", type=float, default=0.01)
+    args = parser.parse_args(argv)
+
+    # The production defaults rather than the other benchmarks' unlimited ones
+    application = load_app(
+        ADMISSION_IP_RATE="0.1",
+        ADMISSION_IP_BURST="10",
+        ADMISSION_ORIGIN_RATE="10",
+        ADMISSION_ORIGIN_BURST="50",
+    )
+    import admission
+
+    check_overhead(admission, args.checks)
+    fake = FakeStripe(latency=args.stripe_latency)
+    application.stripe.api_base = fake.start_in_thread()
+    flood(application, args.bot, args.donors, args.rate)
+    print("checkouts that reached Stripe: {}".format(fake.requests))
+    print("admission stats: {}".format(application.admission.stats()))
+    return 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
@@ -0,0 +1,115 @@
+"""Load test /checkout through the sync WSGI app and the asyncio ASGI app
+
+Both run against a local Stripe stand-in that answers after a fixed delay.
+The sync app is limited to one checkout per worker thread, while the ASGI
+app keeps every request in flight at once.
+
+    $ python benchmarks/async_checkout.py --requests 500 --latency 0.2
+"""
+import argparse
+import asyncio
+import json
+import time
+from concurrent.futures import ThreadPoolExecutor
+
+from common import load_app, percentile
+from fake_stripe import FakeStripe
+
+BODY = json.dumps(
+    {"amount": 5000, "frequency": "once", "metadata": {"host": "localhost"}}
+).encode("utf-8")
+
+
+def summarize(name, n, elapsed, latencies):
+    print(
+        "{:<8} {:>5} checkouts in {:>6.2f}s  {:>8.0f} req/s  "
+        "p50 {:>7.1f} ms  p99 {:>7.1f} ms".format(
+            name,
+            n,
+            elapsed,
+            n / elapsed,
+            1000 * percentile(latencies, 50),
+            1000 * percentile(latencies, 99),
+        )
+    )
+
+
+def run_sync(application, n, workers):
+    client = application.app.test_client()
+
+    def one(_):
+        t0 = time.perf_counter()
+        response = client.post("/checkout", data=BODY, content_type="application/json")
+        assert response.status_code == 200, response.data
+        return time.perf_counter() - t0
+
+    start = time.perf_counter()
+    with ThreadPoolExecutor(workers) as pool:
+        latencies = list(pool.map(one, range(n)))
+    summarize("wsgi", n, time.perf_counter() - start, latencies)
+
+
+async def asgi_request(app, body):
+    messages = []
+    sent = False
+
+    async def receive():
+        nonlocal sent
+        if sent:
+            await asyncio.sleep(3600)
+        sent = True
+        return {"type": "http.request", "body": body, "more_body": False}
+
+    async def send(message):
+        messages.append(message)
+
+    scope = {
+        "type": "http",
+        "http_version": "1.1",
+        "method": "POST",
+        "scheme": "http",
+        "path": "/checkout",
+        "query_string": b"",
+        "headers": [(b"host", b"localhost"), (b"content-type", b"application/json")],
+        "server": ("localhost", 80),
+        "client": ("127.0.0.1", 50000),
+    }
+    await app(scope, receive, send)
+    return messages[0]["status"], messages[1]["body"]
+
+
+async def run_async(asgi, n):
+    async def one():
+        t0 = time.perf_counter()
+        status, body = await asgi_request(asgi.app, BODY)
+        assert status == 200, body
+        return time.perf_counter() - t0
+
+    start = time.perf_counter()
+    latencies = await asyncio.gather(*(one() for _ in range(n)))
+    summarize("asgi", n, time.perf_counter() - start, latencies)
+    print(
+        "         max in-flight checkouts: {}".format(
+            asgi.checkout_limiter.max_in_flight
+        )
+    )
+
+
+def main(n=500, latency=0.2, workers=8):
+    application = load_app()
+    fake = FakeStripe(latency=latency)
+    application.stripe.api_base = fake.start_in_thread()
+    import asgi
+
+    run_sync(application, min(n, workers * 10), workers)
+    asyncio.get_event_loop().run_until_complete(run_async(asgi, n))
+    print("stripe stand-in max concurrent requests: {}".format(fake.max_in_flight))
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description=__doc__.split("\n", 1)[0])
+    parser.add_argument("--requests", type=int, default=500)
+    parser.add_argument("--latency", type=float, default=0.2, help="seconds")
+    parser.add_argument("--workers", type=int, default=8, help="sync threads")
+    args = parser.parse_args()
+    main(args.requests, args.latency, args.workers)
@@ -0,0 +1,35 @@
+"""Per-request cost of validating /checkout bodies against CHECKOUT_SCHEMA
+
+Compares jsonschema.validate, which builds a validator and checks the schema
+on every call, with application.checkout_validator(), which is built once.
+
+    $ python benchmarks/checkout_validation.py [iterations]
+"""
+import sys
+
+from jsonschema import validate
+
+from common import load_app, measure, report
+
+BODY = {
+    "amount": 5000,
+    "frequency": "monthly",
+    "metadata": {"host": "donate.missionbit.org", "utm_source": "gala"},
+}
+
+
+def main(n=20000):
+    application = load_app()
+    schema = application.CHECKOUT_SCHEMA
+    validator = application.checkout_validator()
+    for name, fn in (
+        ("jsonschema.validate", lambda: validate(BODY, schema)),
+        ("checkout_validator().validate", lambda: validator.validate(BODY)),
+        ("checkout_validator().is_valid", lambda: validator.is_valid(BODY)),
+    ):
+        rate, latencies = measure(fn, n)
+        report(name, rate, latencies)
+
+
+if __name__ == "__main__":
+    main(*map(int, sys.argv[1:]))
@@ -0,0 +1,136 @@
+"""Cold start cost of the app: import wall time, peak RSS and an import profile
+
+Every run imports application in a fresh interpreter, with placeholder
+credentials, the way a new worker or test run would.
+
+    $ python benchmarks/cold_start.py                # median of --runs
+    $ python benchmarks/cold_start.py --profile 15   # slowest direct imports
+    $ python benchmarks/cold_start.py --check        # exit 1 over budget
+
+`--check` fails when the median wall time or the peak RSS is over
+`--max-ms` / `--max-rss-mb`, CI runs it to catch imports that creep back
+into startup.
+"""
+import argparse
+import os
+import statistics
+import subprocess
+import sys
+import tempfile
+import time
+
+from common import BENCHMARK_ENV, ROOT
+
+# Generous for CI runners, a cold start here takes about half of this
+MAX_MS = 1000
+MAX_RSS_MB = 80
+
+
+def run_python(code, args=()):
+    """Returns (wall seconds, peak RSS bytes, stderr) of running `code` in a
+    new interpreter from the repository root
+    """
+    env = dict(os.environ, **BENCHMARK_ENV)
+    tmp = tempfile.mkdtemp(prefix="mb-cold-start-")
+    env["WEBHOOK_QUEUE_PATH"] = os.path.join(tmp, "webhooks.sqlite3")
+    env["DONATION_STORE_PATH"] = os.path.join(tmp, "donations.sqlite3")
+    start = time.perf_counter()
+    proc = subprocess.Popen(
+        [sys.executable, *args, "-c", code],
+        cwd=ROOT,
+        env=env,
+        stdout=subprocess.DEVNULL,
+        stderr=subprocess.PIPE,
+    )
+    stderr = proc.stderr.read().decode("utf-8")
+    _, status, rusage = os.wait4(proc.pid, 0)
+    elapsed = time.perf_counter() - start
+    proc.returncode = status
+    if status:
+        raise RuntimeError(f"importing the app failed:\n{stderr}")
+    # ru_maxrss is in kilobytes on Linux and bytes on macOS
+    scale = 1 if sys.platform == "darwin" else 1024
+    return elapsed, rusage.ru_maxrss * scale, stderr
+
+
+def parse_importtime(text):
+    """(depth, module, self µs, cumulative µs) from `python -X importtime`
+
+    >>> text = '''import time: self [us] | cumulative | imported package
+    ... import time:       120 |        120 |   json.decoder
+    ... import time:       300 |        420 | json
+    ... '''
+    >>> parse_importtime(text)
+    [(1, 'json.decoder', 120, 120), (0, 'json', 300, 420)]
+    """
+    rows = []
+    for line in text.splitlines():
+        if not line.startswith("import time:"):
+            continue
+        self_us, cumulative_us, name = line[len("import time:") :].split("|")
+        if not self_us.strip().isdigit():
+            continue
+        depth = (len(name) - len(name.lstrip()) - 1) // 2
+        rows.append((depth, name.strip(), int(self_us), int(cumulative_us)))
+    return rows
+
+
+def print_profile(rows, top):
+    """The modules imported by application, slowest first, and the time
+    spent running application's own module body
+    """
+    app = next(r for r in rows if r[1] == "application" and r[0] == 0)
+    # importtime lists a module after everything it imports
+    index = rows.index(app)
+    children = []
+    for depth, name, self_us, cumulative_us in reversed(rows[:index]):
+        if depth == 0:
+            break
+        if depth == 1:
+            children.append((cumulative_us, name))
+    print("{:<40} {:>10}".format("import", "ms"))
+    print("{:<40} {:>10.1f}".format("application (total)", app[3] / 1000))
+    print("{:<40} {:>10.1f}".format("application (module body)", app[2] / 1000))
+    for cumulative_us, name in sorted(children, reverse=True)[:top]:
+        print("{:<40} {:>10.1f}".format(name, cumulative_us / 1000))
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description=__doc__.split("\n", 1)[0])
+    parser.add_argument("--runs", type=int, default=5)
+    parser.add_argument("--profile", type=int, metavar="N", help="show N imports")
+    parser.add_argument("--check", action="store_true")
+    parser.add_argument("--max-ms", type=float, default=MAX_MS)
+    parser.add_argument("--max-rss-mb", type=float, default=MAX_RSS_MB)
+    args = parser.parse_args(argv)
+
+    baseline = [run_python("pass") for _ in range(args.runs)]
+    runs = [run_python("import application") for _ in range(args.runs)]
+    wall_ms = 1000 * statistics.median(t for t, _, _ in runs)
+    rss_mb = max(rss for _, rss, _ in runs) / 2 ** 20
+    print(
+        "import application: {:.0f} ms median wall time, {:.1f} MB peak RSS "
+        "(interpreter alone: {:.0f} ms, {:.1f} MB)".format(
+            wall_ms,
+            rss_mb,
+            1000 * statistics.median(t for t, _, _ in baseline),
+            max(rss for _, rss, _ in baseline) / 2 ** 20,
+        )
+    )
+    if args.profile:
+        _, _, stderr = run_python("import application", args=["-X", "importtime"])
+        print_profile(parse_importtime(stderr), args.profile)
+    if args.check:
+        problems = []
+        if wall_ms > args.max_ms:
+            problems.append(f"wall time {wall_ms:.0f} ms > {args.max_ms:.0f} ms")
+        if rss_mb > args.max_rss_mb:
+            problems.append(f"peak RSS {rss_mb:.1f} MB > {args.max_rss_mb:.1f} MB")
+        for problem in problems:
+            print(f"OVER BUDGET {problem}")
+        return 1 if problems else 0
+    return 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
@@ -0,0 +1,77 @@
+"""Cost of recording donations and of GET /stats as donations accumulate
+
+Records donations spread over `--hosts` hosts and a year of hourly
+buckets, and after each of `--sizes` total donations times GET /stats
+through the Flask app (all-time and last day) next to summing the raw
+donation rows, which is what the running totals replace.
+
+    $ python benchmarks/donation_totals.py --sizes 1000,10000,100000
+"""
+import argparse
+import random
+import sys
+import time
+
+from common import load_app, measure, report
+
+FREQUENCIES = ("one-time", "monthly")
+YEAR = 365 * 24 * 60 * 60
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description=__doc__.split("\n", 1)[0])
+    parser.add_argument("--sizes", default="1000,10000,100000")
+    parser.add_argument("--hosts", type=int, default=4)
+    parser.add_argument("-n", type=int, default=2000)
+    args = parser.parse_args(argv)
+
+    application = load_app()
+    store = application.donation_store
+    client = application.app.test_client()
+    rng = random.Random(0)
+    hosts = [f"host{i}.missionbit.org" for i in range(args.hosts)]
+    now = int(time.time())
+    recorded = 0
+    for size in (int(s) for s in args.sizes.split(",")):
+        start = time.perf_counter()
+        for i in range(recorded, size):
+            store.record(
+                f"ch_{i}",
+                rng.choice(hosts),
+                rng.choice(FREQUENCIES),
+                rng.randrange(500, 100000),
+                now - rng.randrange(YEAR),
+            )
+        if size > recorded:
+            elapsed = time.perf_counter() - start
+            print(
+                "recorded {} donations at {:.0f}/s".format(
+                    size - recorded, (size - recorded) / elapsed
+                )
+            )
+        recorded = size
+        conn = store._connection()
+        cases = [
+            ("GET /stats", lambda: client.get(f"/stats?host={hosts[0]}")),
+            (
+                "GET /stats?since=-1d",
+                lambda: client.get(f"/stats?host={hosts[0]}&since={now - 86400}"),
+            ),
+            (
+                "SUM(donation rows)",
+                lambda: conn.execute(
+                    "SELECT frequency, COUNT(*), SUM(amount) FROM donation_events"
+                    " WHERE host = ? GROUP BY frequency",
+                    (hosts[0],),
+                ).fetchall(),
+            ),
+        ]
+        for name, fn in cases:
+            rate, latencies = measure(fn, args.n)
+            report(f"{name} @{size}", rate, latencies)
+    print("store: {}".format(store.stats()))
+    return 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
@@ -0,0 +1,107 @@
+"""Base class for local stand-ins of the HTTP APIs the app calls
+
+Each request is answered after `latency` seconds, and with a 500 error for a
+random `error_rate` fraction of requests, so benchmarks can measure how the
+app behaves while waiting on (or failing to reach) an upstream.
+"""
+import asyncio
+import json
+import random
+import threading
+from urllib.parse import parse_qsl, urlsplit
+
+__all__ = ["FakeHTTPServer"]
+
+REASONS = {200: "OK", 202: "Accepted", 404: "Not Found", 500: "Internal Server Error"}
+
+
+class FakeHTTPServer:
+    name = "fake"
+
+    def __init__(self, latency=0.1, error_rate=0.0, seed=None):
+        self.latency = latency
+        self.error_rate = error_rate
+        self.random = random.Random(seed)
+        self.requests = 0
+        self.errors = 0
+        self.in_flight = 0
+        self.max_in_flight = 0
+        self.server = None
+        self.url = None
+
+    def respond(self, method, path, params, body):
+        """Return (status, JSON object or None) for a request"""
+        raise NotImplementedError
+
+    def error(self):
+        return 500, {"error": {"type": "api_error", "message": "injected error"}}
+
+    async def handle(self, reader, writer):
+        try:
+            while True:
+                request_line = await reader.readline()
+                if not request_line:
+                    break
+                method, target, _ = request_line.decode("latin-1").split(" ", 2)
+                headers = {}
+                while True:
+                    line = await reader.readline()
+                    if line in (b"\r\n", b"\n", b""):
+                        break
+                    name, _, value = line.decode("latin-1").partition(":")
+                    headers[name.strip().lower()] = value.strip()
+                length = int(headers.get("content-length", 0))
+                body = (await reader.readexactly(length)).decode("utf-8")
+                parts = urlsplit(target)
+                params = dict(parse_qsl(parts.query))
+                if headers.get("content-type", "").startswith(
+                    "application/x-www-form-urlencoded"
+                ):
+                    params.update(parse_qsl(body))
+                self.requests += 1
+                self.in_flight += 1
+                self.max_in_flight = max(self.max_in_flight, self.in_flight)
+                try:
+                    await asyncio.sleep(self.latency)
+                finally:
+                    self.in_flight -= 1
+                if self.error_rate and self.random.random() < self.error_rate:
+                    self.errors += 1
+                    status, obj = self.error()
+                else:
+                    status, obj = self.respond(method, parts.path, params, body)
+                payload = b"" if obj is None else json.dumps(obj).encode("utf-8")
+                writer.write(
+                    (
+                        f"HTTP/1.1 {status} {REASONS.get(status, 'Unknown')}\r\n"
+                        "Content-Type: application/json\r\n"
+                        f"Content-Length: {len(payload)}\r\n\r\n"
+                    ).encode("latin-1")
+                    + payload
+                )
+                await writer.drain()
+        except (ConnectionError, asyncio.IncompleteReadError):
+            pass
+        finally:
+            writer.close()
+
+    async def start(self, host="127.0.0.1", port=0):
+        self.server = await asyncio.start_server(self.handle, host, port, backlog=4096)
+        port = self.server.sockets[0].getsockname()[1]
+        self.url = f"http://{host}:{port}"
+        return self.url
+
+    def start_in_thread(self):
+        """Serve from a background event loop, returning the base URL"""
+        loop = asyncio.new_event_loop()
+        ready = threading.Event()
+
+        def run():
+            asyncio.set_event_loop(loop)
+            loop.run_until_complete(self.start())
+            ready.set()
+            loop.run_forever()
+
+        threading.Thread(target=run, name=self.name, daemon=True).start()
+        ready.wait()
+        return self.url
@@ -0,0 +1,134 @@
+"""Local stand-in for the Redis server behind CACHE_URL=redis://...
+
+Implements the commands cache_backends.RedisBackend sends (GET, SET with NX
+and PX/EX, DEL, SELECT, AUTH, PING) plus FLUSHDB, keeping keys in a dict.
+Every reply is delayed by `latency` seconds to model a network hop.
+
+>>> import cache_backends
+>>> server = FakeRedis()
+>>> host, port = server.start_in_thread()
+>>> cache = cache_backends.RedisBackend(host, port, db=1)
+>>> cache.add('evt_1', b'1', ttl=60), cache.add('evt_1', b'1', ttl=60)
+(True, False)
+>>> cache.get('evt_1'), cache.get('evt_2')
+(b'1', None)
+>>> cache.delete('evt_1')
+>>> cache.get('evt_1') is None, server.commands['SET']
+(True, 2)
+"""
+import asyncio
+import threading
+import time
+
+__all__ = ["FakeRedis"]
+
+
+class FakeRedis:
+    name = "fake-redis"
+
+    def __init__(self, latency=0.0, clock=time.monotonic):
+        self.latency = latency
+        self.clock = clock
+        # db -> key -> (value, expires at or None)
+        self.data = {}
+        self.commands = {}
+        self.host = None
+        self.port = None
+
+    def _db(self, db):
+        return self.data.setdefault(db, {})
+
+    def _get(self, db, key):
+        entry = self._db(db).get(key)
+        if entry is None:
+            return None
+        value, expires_at = entry
+        if expires_at is not None and self.clock() >= expires_at:
+            del self._db(db)[key]
+            return None
+        return value
+
+    def execute(self, db, args):
+        """Returns (reply, db)"""
+        name = args[0].decode("utf-8").upper()
+        self.commands[name] = self.commands.get(name, 0) + 1
+        if name == "PING":
+            return "+PONG", db
+        if name in ("AUTH", "FLUSHDB"):
+            if name == "FLUSHDB":
+                self._db(db).clear()
+            return "+OK", db
+        if name == "SELECT":
+            return "+OK", int(args[1])
+        if name == "GET":
+            return self._get(db, args[1]), db
+        if name == "DEL":
+            return sum(self._db(db).pop(k, None) is not None for k in args[1:]), db
+        if name == "SET":
+            key, value = args[1], args[2]
+            options = [a.decode("utf-8").upper() for a in args[3:]]
+            expires_at = None
+            if "PX" in options:
+                expires_at = self.clock() + int(options[options.index("PX") + 1]) / 1000
+            elif "EX" in options:
+                expires_at = self.clock() + int(options[options.index("EX") + 1])
+            if "NX" in options and self._get(db, key) is not None:
+                return None, db
+            self._db(db)[key] = (value, expires_at)
+            return "+OK", db
+        return f"-ERR unknown command '{name}'", db
+
+    @staticmethod
+    def encode(reply):
+        if reply is None:
+            return b"$-1\r\n"
+        if isinstance(reply, int):
+            return b":%d\r\n" % reply
+        if isinstance(reply, bytes):
+            return b"$%d\r\n%s\r\n" % (len(reply), reply)
+        return reply.encode("utf-8") + b"\r\n"
+
+    async def handle(self, reader, writer):
+        db = 0
+        try:
+            while True:
+                line = await reader.readline()
+                if not line:
+                    break
+                args = []
+                for _ in range(int(line[1:])):
+                    length = int((await reader.readline())[1:])
+                    args.append((await reader.readexactly(length + 2))[:-2])
+                if self.latency:
+                    await asyncio.sleep(self.latency)
+                reply, db = self.execute(db, args)
+                writer.write(self.encode(reply))
+                await writer.drain()
+        except (ConnectionError, asyncio.IncompleteReadError):
+            pass
+        finally:
+            writer.close()
+
+    async def start(self, host="127.0.0.1", port=0):
+        self.server = await asyncio.start_server(self.handle, host, port, backlog=4096)
+        self.host, self.port = self.server.sockets[0].getsockname()[:2]
+        return self.host, self.port
+
+    def start_in_thread(self):
+        """Serve from a background event loop, returning (host, port)"""
+        loop = asyncio.new_event_loop()
+        ready = threading.Event()
+
+        def run():
+            asyncio.set_event_loop(loop)
+            loop.run_until_complete(self.start())
+            ready.set()
+            loop.run_forever()
+
+        threading.Thread(target=run, name=self.name, daemon=True).start()
+        ready.wait()
+        return self.host, self.port
+
+    @property
+    def url(self):
+        return f"redis://{self.host}:{self.port}/0"
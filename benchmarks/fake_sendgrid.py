@@ -0,0 +1,23 @@
+"""A local stand-in for SendGrid's v3 mail send endpoint"""
+import json
+
+from fake_http import FakeHTTPServer
+
+__all__ = ["FakeSendGrid"]
+
+
+class FakeSendGrid(FakeHTTPServer):
+    name = "fake-sendgrid"
+
+    def __init__(self, latency=0.05, error_rate=0.0, seed=None):
+        super().__init__(latency=latency, error_rate=error_rate, seed=seed)
+        self.personalizations = 0
+
+    def error(self):
+        return 500, {"errors": [{"message": "injected error"}]}
+
+    def respond(self, method, path, params, body):
+        if method == "POST" and path == "/v3/mail/send":
+            self.personalizations += len(json.loads(body)["personalizations"])
+            return 202, None
+        return 404, {"errors": [{"message": f"{method} {path}"}]}
@@ -0,0 +1,114 @@
+"""A local stand-in for the parts of the Stripe API the app uses
+
+Responses are canned, fully expanded objects, which is enough to exercise
+every page and webhook handler while measuring how the app behaves while
+waiting on Stripe.
+"""
+import itertools
+import time
+
+from fake_http import FakeHTTPServer
+
+__all__ = ["FakeStripe"]
+
+CREATED = 1571000000
+BILLING_DETAILS = {"name": "Ada Lovelace", "email": "ada@example.com"}
+CARD = {"brand": "visa", "funding": "credit", "last4": "4242", "wallet": None}
+
+
+class FakeStripe(FakeHTTPServer):
+    name = "fake-stripe"
+
+    def __init__(self, latency=0.1, error_rate=0.0, seed=None):
+        super().__init__(latency=latency, error_rate=error_rate, seed=seed)
+        self._ids = itertools.count(1)
+
+    def checkout_session(self, params):
+        n = next(self._ids)
+        return {
+            "id": f"cs_test_{n}",
+            "object": "checkout.session",
+            "mode": params.get("mode", "payment"),
+            "success_url": params.get("success_url"),
+            "cancel_url": params.get("cancel_url"),
+        }
+
+    def charge(self, id, amount=5000):
+        return {
+            "id": f"ch_{id}",
+            "object": "charge",
+            "amount": amount,
+            "created": CREATED,
+            "status": "succeeded",
+            "paid": True,
+            "failure_message": None,
+            "invoice": None,
+            "metadata": {},
+            "billing_details": BILLING_DETAILS,
+            "payment_method_details": {"type": "card", "card": CARD},
+        }
+
+    def payment_intent(self, id):
+        return {
+            "id": f"pi_{id}",
+            "object": "payment_intent",
+            "metadata": {"host": "localhost"},
+            "charges": {"object": "list", "data": [self.charge(id)]},
+        }
+
+    def subscription(self, id):
+        return {
+            "id": id,
+            "object": "subscription",
+            "status": "active",
+            "quantity": 1,
+            "plan": {"id": "mb-monthly-001", "object": "plan", "amount": 2500},
+            "current_period_end": int(time.time()) + 30 * 24 * 60 * 60,
+            "metadata": {"origin": "http://localhost"},
+            "default_payment_method": {
+                "id": f"pm_{id}",
+                "object": "payment_method",
+                "type": "card",
+                "card": CARD,
+                "billing_details": BILLING_DETAILS,
+            },
+        }
+
+    def retrieved_session(self, id):
+        if id.startswith("cs_sub_"):
+            return {
+                "id": id,
+                "object": "checkout.session",
+                "mode": "subscription",
+                "subscription": self.subscription(f"sub_{id}"),
+            }
+        return {
+            "id": id,
+            "object": "checkout.session",
+            "mode": "payment",
+            "payment_intent": self.payment_intent(id),
+        }
+
+    def invoice(self, id):
+        return {
+            "id": id,
+            "object": "invoice",
+            "billing_reason": "subscription_cycle",
+            "subscription": self.subscription(f"sub_{id}"),
+            "payment_intent": self.payment_intent(id),
+        }
+
+    def respond(self, method, path, params, body):
+        """Return (status, JSON object) for a request"""
+        resource, _, id = path[len("/v1/") :].rpartition("/")
+        if method == "POST" and path == "/v1/checkout/sessions":
+            return 200, self.checkout_session(params)
+        if method == "GET" and resource == "checkout/sessions":
+            return 200, self.retrieved_session(id)
+        if method == "GET" and resource == "subscriptions":
+            return 200, self.subscription(id)
+        if method == "DELETE" and resource == "subscriptions":
+            return 200, dict(self.subscription(id), status="canceled")
+        if method == "GET" and resource == "invoices":
+            return 200, self.invoice(id)
+        return 404, {"error": {"type": "invalid_request_error", "message": path}}
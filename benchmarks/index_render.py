@@ -0,0 +1,46 @@
+"""Compare cold (template rendered) and warm (cached) donation page throughput
+
+    $ python benchmarks/index_render.py [requests]
+"""
+import sys
+
+from common import load_app, measure, report
+
+PATHS = ["/", "/250/?frequency=monthly", "/$1,000/", "/50/?utm_source=gala"]
+
+
+def main(n=2000):
+    application = load_app()
+    client = application.app.test_client()
+
+    def cold():
+        application.index_cache.clear()
+        for path in PATHS:
+            client.get(path)
+
+    def warm():
+        for path in PATHS:
+            client.get(path)
+
+    def revalidate():
+        for path, etag in etags:
+            client.get(path, headers={"If-None-Match": f'"{etag}"'})
+
+    warm()
+    etags = [(path, client.get(path).headers["ETag"].strip('"')) for path in PATHS]
+    assert (
+        client.get(PATHS[1], headers={"If-None-Match": f'"{etags[1][1]}"'}).status_code
+        == 304
+    )
+    for name, fn in (
+        ("cold render", cold),
+        ("warm cache", warm),
+        ("304 revalidate", revalidate),
+    ):
+        rate, latencies = measure(fn, n // len(PATHS))
+        report(name, rate * len(PATHS), [t / len(PATHS) for t in latencies])
+    print(application.index_cache.stats())
+
+
+if __name__ == "__main__":
+    main(*map(int, sys.argv[1:]))
@@ -0,0 +1,153 @@
+"""Fan-out of live donation totals to many idle /stats/live streams
+
+Opens `--connections` GET /stats/live streams on the ASGI app in-process,
+then records `--bursts` bursts of `--burst-size` donations through
+application.track_donation from a webhook-like thread, one burst per
+second. For every burst it reports how long each stream took to receive
+the new totals (including the `--coalesce` window) and how many events a
+stream got per burst. A `--slow` fraction of the streams take
+`--slow-delay` seconds to accept each event, to show that they skip to the
+latest totals instead of queueing.
+
+    $ python benchmarks/live_stream.py --connections 5000 --bursts 10
+"""
+import argparse
+import asyncio
+import json
+import resource
+import sys
+import time
+
+from common import load_app, percentile
+
+HOST = "gala.localhost"
+
+
+class Stream:
+    def __init__(self, delay):
+        self.delay = delay
+        self.events = []
+        self.closed = asyncio.Event()
+
+    async def receive(self):
+        await self.closed.wait()
+        return {"type": "http.disconnect"}
+
+    async def send(self, message):
+        body = message.get("body", b"")
+        if body.startswith(b"event: totals"):
+            data = json.loads(body.split(b"data: ", 1)[1])
+            self.events.append((time.perf_counter(), data["count"]))
+        if self.delay and body:
+            await asyncio.sleep(self.delay)
+
+
+def scope():
+    return {
+        "type": "http",
+        "http_version": "1.1",
+        "method": "GET",
+        "scheme": "http",
+        "path": "/stats/live",
+        "query_string": b"",
+        "headers": [(b"host", HOST.encode("latin-1"))],
+        "server": ("localhost", 80),
+        "client": ("127.0.0.1", 50000),
+    }
+
+
+def donate(application, burst, size):
+    import stripe
+
+    for i in range(size):
+        charge = stripe.Charge.construct_from(
+            {
+                "id": f"ch_{burst}_{i}",
+                "amount": 5000,
+                "created": int(time.time()),
+            },
+            stripe.api_key,
+        )
+        application.track_donation({"host": HOST}, "one-time", charge)
+
+
+async def run(application, asgi, args):
+    streams = [
+        Stream(args.slow_delay if i < args.connections * args.slow else 0)
+        for i in range(args.connections)
+    ]
+    start = time.perf_counter()
+    tasks = [
+        asyncio.ensure_future(asgi.app(scope(), s.receive, s.send)) for s in streams
+    ]
+    while sum(bool(s.events) for s in streams) < len(streams):
+        await asyncio.sleep(0.01)
+    print(
+        "{} streams open in {:.2f}s, max RSS {:.0f} MB".format(
+            len(streams),
+            time.perf_counter() - start,
+            resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / 1024,
+        )
+    )
+    loop = asyncio.get_event_loop()
+    fast = [s for s in streams if not s.delay]
+    print(
+        "{:>5} {:>12} {:>12} {:>12} {:>16}".format(
+            "burst", "p50 ms", "p99 ms", "max ms", "events/stream"
+        )
+    )
+    for burst in range(args.bursts):
+        expected = (burst + 1) * args.burst_size
+        before = [len(s.events) for s in fast]
+        t0 = time.perf_counter()
+        await loop.run_in_executor(None, donate, application, burst, args.burst_size)
+        while any(s.events[-1][1] < expected for s in fast):
+            await asyncio.sleep(0.005)
+        latencies = [
+            next(t for t, count in s.events if count == expected) - t0 for s in fast
+        ]
+        events = [len(s.events) - n for s, n in zip(fast, before)]
+        print(
+            "{:>5} {:>12.1f} {:>12.1f} {:>12.1f} {:>16.2f}".format(
+                burst,
+                1000 * percentile(latencies, 50),
+                1000 * percentile(latencies, 99),
+                1000 * max(latencies),
+                sum(events) / len(events),
+            )
+        )
+        await asyncio.sleep(max(0.0, t0 + 1.0 - time.perf_counter()))
+    slow = [s for s in streams if s.delay]
+    if slow:
+        print(
+            "slow streams: {:.1f} events each for {} bursts".format(
+                sum(len(s.events) for s in slow) / len(slow), args.bursts
+            )
+        )
+    for s in streams:
+        s.closed.set()
+    await asyncio.gather(*tasks)
+    stats = application.live_totals.stats()
+    print("live totals: {}".format(stats))
+    print("server-side fan-out: {}".format(application.metrics.summary()["live_totals"]))
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description=__doc__.split("\n", 1)[0])
+    parser.add_argument("--connections", type=int, default=5000)
+    parser.add_argument("--bursts", type=int, default=10)
+    parser.add_argument("--burst-size", type=int, default=20)
+    parser.add_argument("--coalesce", type=float, default=0.25)
+    parser.add_argument("--slow", type=float, default=0.05)
+    parser.add_argument("--slow-delay", type=float, default=2.0)
+    args = parser.parse_args(argv)
+
+    application = load_app(LIVE_TOTALS_COALESCE=str(args.coalesce))
+    import asgi
+
+    asyncio.get_event_loop().run_until_complete(run(application, asgi, args))
+    return 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
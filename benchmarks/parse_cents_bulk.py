@@ -0,0 +1,72 @@
+"""Bulk amount parsing: the scalar parse_cents loop vs the batch APIs
+
+Parses a synthetic spreadsheet column shaped like campaign exports: mostly
+whole dollar amounts, some with $ signs, commas and cents, and a few invalid
+entries.
+
+    $ python benchmarks/parse_cents_bulk.py [rows] [repeats]
+"""
+import random
+import sys
+import time
+
+from common import ROOT
+
+sys.path.insert(0, ROOT)
+
+from parse_cents import numpy, parse_cents, parse_cents_array, parse_cents_many  # noqa
+
+
+def column(rows, seed=0):
+    rng = random.Random(seed)
+    shapes = (
+        (60, lambda: str(rng.randint(1, 5000))),
+        (15, lambda: "${}".format(rng.randint(1, 5000))),
+        (10, lambda: "{:,}".format(rng.randint(1000, 10 ** 6))),
+        (10, lambda: "${}.{:02d}".format(rng.randint(1, 999), rng.randint(0, 99))),
+        (5, lambda: rng.choice(["", "0", "01234", "-$100", "100.", "n/a"])),
+    )
+    weights = [w for w, _ in shapes]
+    makers = [m for _, m in shapes]
+    return [rng.choices(makers, weights)[0]() for _ in range(rows)]
+
+
+def best_of(fn, repeats):
+    best = float("inf")
+    for _ in range(repeats):
+        t0 = time.perf_counter()
+        fn()
+        best = min(best, time.perf_counter() - t0)
+    return best
+
+
+def main(rows=100000, repeats=5):
+    values = column(rows)
+    expected = [parse_cents(s) for s in values]
+    assert parse_cents_many(values) == expected
+    cents, valid = parse_cents_array(values)
+    assert [c if v else None for c, v in zip(cents, valid)] == expected
+    print(
+        "{} rows, {} invalid, numpy {}".format(
+            rows,
+            expected.count(None),
+            "installed" if numpy is not None else "not installed",
+        )
+    )
+    baseline = None
+    for name, fn in (
+        ("[parse_cents(s) for s in ...]", lambda: [parse_cents(s) for s in values]),
+        ("parse_cents_many", lambda: parse_cents_many(values)),
+        ("parse_cents_array", lambda: parse_cents_array(values)),
+    ):
+        elapsed = best_of(fn, repeats)
+        baseline = baseline or elapsed
+        print(
+            "{:<32} {:>8.1f} ms  {:>10.0f} rows/s  {:>5.2f}x".format(
+                name, 1000 * elapsed, rows / elapsed, baseline / elapsed
+            )
+        )
+
+
+if __name__ == "__main__":
+    main(*map(int, sys.argv[1:]))
@@ -0,0 +1,151 @@
+"""Receipt payloads per second, old formatting helpers vs receipts.py
+
+Renders receipts for random Stripe charges with a copy of the helpers that
+application.py used before receipts.py, and checks that both produce the
+same payloads before timing them.
+
+    $ python benchmarks/receipt_render.py [charges]
+"""
+import random
+import re
+import sys
+from datetime import datetime
+
+from common import load_app, measure, report
+
+BRANDS = ["amex", "diners", "discover", "jcb", "mastercard", "unionpay", "visa", "x"]
+NAMES = ["Ada Lovelace", "Hopper, Grace", "Turing; Alan, Dr.", "Katherine Johnson"]
+
+
+def random_charges(stripe, n, seed=0):
+    rng = random.Random(seed)
+    for i in range(n):
+        if rng.random() < 0.9:
+            wallet = rng.choice([None, {"type": "apple_pay"}, {"type": "google_pay"}])
+            details = {
+                "type": "card",
+                "card": {
+                    "brand": rng.choice(BRANDS),
+                    "funding": rng.choice(["credit", "debit", "prepaid", "unknown"]),
+                    "wallet": wallet,
+                },
+            }
+        else:
+            details = {"type": "ach_debit", "ach_debit": {}}
+        yield stripe.Charge.construct_from(
+            {
+                "id": f"ch_{i}",
+                "amount": rng.choice([500, 2500, 10000, rng.randrange(100, 10 ** 7)]),
+                "created": rng.randrange(1546300800, 1609459200),
+                "billing_details": {
+                    "name": rng.choice(NAMES),
+                    "email": f"donor{i}@example.com",
+                },
+                "payment_method_details": details,
+            },
+            "sk_test",
+        )
+
+
+# The helpers as they were in application.py, kept as the golden reference
+
+
+def legacy_format_identifier(s):
+    return " ".join(map(lambda s: s.capitalize(), s.split("_")))
+
+
+def legacy_payment_method(payment_method_details, card_brands):
+    payment_type = payment_method_details.type
+    if payment_type in ("card", "card_present"):
+        details = payment_method_details[payment_type]
+        parts = []
+        brand = card_brands.get(details.brand)
+        if brand:
+            parts.append(brand)
+        if details.funding != "unknown":
+            parts.append(details.funding)
+        parts.append("card")
+        if details.wallet:
+            parts.append("({})".format(legacy_format_identifier(details.wallet.type)))
+        return " ".join(parts)
+    else:
+        return legacy_format_identifier(payment_type)
+
+
+def legacy_email_template_data(template_id, charge, frequency, receipts):
+    billing_details = charge.billing_details
+    payment_method = legacy_payment_method(
+        charge.payment_method_details, receipts.CARD_BRANDS
+    )
+    if billing_details.name:
+        donor = f"{billing_details.name} <{billing_details.email}>"
+    else:
+        donor = billing_details.email
+    return {
+        "template_id": template_id,
+        "from": {"name": "Mission Bit", "email": "donate@missionbit.org"},
+        "personalizations": [
+            {
+                "to": [
+                    {
+                        "name": re.sub(r"([,;]\s*)+", " ", billing_details.name),
+                        "email": billing_details.email,
+                    }
+                ],
+                "dynamic_template_data": {
+                    "transaction_id": charge.id,
+                    "frequency": frequency,
+                    "total": "${:,.2f}".format(charge.amount * 0.01),
+                    "date": datetime.fromtimestamp(
+                        charge.created, receipts.local_tz()
+                    ).strftime("%x"),
+                    "payment_method": payment_method,
+                    "donor": donor,
+                },
+            }
+        ],
+    }
+
+
+def main(n=20000):
+    application = load_app()
+    import receipts
+    import stripe
+
+    charges = list(random_charges(stripe, n))
+    template_id = application.RECEIPT_TEMPLATE_ID
+
+    def legacy():
+        return [
+            legacy_email_template_data(template_id, c, "one-time", receipts)
+            for c in charges
+        ]
+
+    def current():
+        return [
+            application.email_template_data(template_id, c, "one-time") for c in charges
+        ]
+
+    views = [receipts.ChargeView.from_charge(c) for c in charges]
+
+    def from_views():
+        return [
+            receipts.template_data(template_id, application.SENDER, v, "one-time")
+            for v in views
+        ]
+
+    if legacy() != current():
+        print("receipts.py output differs from the legacy helpers")
+        return 1
+    for name, fn in (
+        ("legacy helpers", legacy),
+        ("email_template_data", current),
+        ("template_data(ChargeView)", from_views),
+    ):
+        rate, latencies = measure(fn, 5)
+        report(f"{name} (x{n})", rate * n, [t / n for t in latencies])
+    return 0
+
+
+if __name__ == "__main__":
+    sys.exit(main(*map(int, sys.argv[1:])))
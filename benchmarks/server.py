@@ -0,0 +1,133 @@
+"""Requests/s per core of the production server profile (gunicorn.conf.py)
+
+Starts gunicorn with the repository's config for each `--workers` count and
+drives it with `--clients` client processes, each keeping one connection
+alive, for `--duration` seconds per path. The clients compete with the
+workers for CPU, so for numbers to compare with production, give gunicorn
+its own cores (e.g. `taskset`) or a bigger machine than the workers need.
+
+    $ python benchmarks/server.py --workers 1 2 4 --clients 8
+"""
+import argparse
+import http.client
+import os
+import socket
+import subprocess
+import sys
+import tempfile
+import time
+from concurrent.futures import ProcessPoolExecutor
+
+from common import BENCHMARK_ENV, ROOT, percentile
+
+
+def client(port, path, duration):
+    """Returns the latencies of requests sent back to back for `duration`s"""
+    conn = http.client.HTTPConnection("127.0.0.1", port, timeout=30)
+    latencies = []
+    deadline = time.perf_counter() + duration
+    while time.perf_counter() < deadline:
+        t0 = time.perf_counter()
+        conn.request("GET", path)
+        response = conn.getresponse()
+        response.read()
+        if response.status != 200:
+            raise RuntimeError(f"GET {path}: {response.status}")
+        latencies.append(time.perf_counter() - t0)
+    conn.close()
+    return latencies
+
+
+def wait_for_port(proc, port, timeout=30):
+    deadline = time.monotonic() + timeout
+    while time.monotonic() < deadline and proc.poll() is None:
+        try:
+            socket.create_connection(("127.0.0.1", port), timeout=1).close()
+            return
+        except OSError:
+            time.sleep(0.1)
+    raise TimeoutError(f"gunicorn did not listen on {port}")
+
+
+def free_port():
+    with socket.socket() as s:
+        s.bind(("127.0.0.1", 0))
+        return s.getsockname()[1]
+
+
+def start_gunicorn(workers, threads, port):
+    env = dict(os.environ, **BENCHMARK_ENV)
+    tmp = tempfile.mkdtemp(prefix="mb-server-")
+    env.update(
+        PORT=str(port),
+        WEB_CONCURRENCY=str(workers),
+        GUNICORN_THREADS=str(threads),
+        WEBHOOK_QUEUE_PATH=os.path.join(tmp, "webhooks.sqlite3"),
+        DONATION_STORE_PATH=os.path.join(tmp, "donations.sqlite3"),
+    )
+    proc = subprocess.Popen(
+        [
+            sys.executable,
+            "-c",
+            "from gunicorn.app.wsgiapp import run; run()",
+            "application:app",
+            # Logging every request would dominate the measurement
+            "--access-logfile",
+            os.devnull,
+        ],
+        cwd=ROOT,
+        env=env,
+    )
+    wait_for_port(proc, port)
+    return proc
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description=__doc__.split("\n", 1)[0])
+    parser.add_argument("--workers", type=int, nargs="+", default=[1, 2])
+    parser.add_argument("--threads", type=int, default=8)
+    parser.add_argument("--clients", type=int, default=8)
+    parser.add_argument("--duration", type=float, default=5.0)
+    parser.add_argument("--paths", nargs="+", default=["/", "/250/?frequency=monthly"])
+    args = parser.parse_args(argv)
+
+    cpus = os.cpu_count() or 1
+    print(
+        "{:<8} {:<26} {:>9} {:>13} {:>9} {:>9}".format(
+            "workers", "path", "req/s", "req/s/core", "p50 ms", "p99 ms"
+        )
+    )
+    for workers in args.workers:
+        port = free_port()
+        proc = start_gunicorn(workers, args.threads, port)
+        try:
+            with ProcessPoolExecutor(args.clients) as pool:
+                n = args.clients
+                for path in args.paths:
+                    # Warm every worker up before measuring
+                    list(pool.map(client, [port] * n, [path] * n, [0.5] * n))
+                    start = time.perf_counter()
+                    latencies = []
+                    for ts in pool.map(
+                        client, [port] * n, [path] * n, [args.duration] * n
+                    ):
+                        latencies.extend(ts)
+                    rate = len(latencies) / (time.perf_counter() - start)
+                    print(
+                        "{:<8} {:<26} {:>9.0f} {:>13.0f} {:>9.2f} {:>9.2f}".format(
+                            workers,
+                            path,
+                            rate,
+                            rate / min(workers, cpus),
+                            1000 * percentile(latencies, 50),
+                            1000 * percentile(latencies, 99),
+                        )
+                    )
+        finally:
+            proc.terminate()
+            proc.wait()
+    return 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
@@ -0,0 +1,117 @@
+"""Stripe retrieves and duplicate webhooks across workers, per cache backend
+
+Forks `--workers` processes that each look up `--lookups` invoices (a few
+popular ones more often than the rest) through their own StripeCache, and
+claim `--events` event ids through their own EventLedger with a separate
+SQLite file, the way separate instances would. This runs once without a
+shared backend, once with MmapBackend and once with RedisBackend against a
+local stand-in (`--redis-latency` per command), and reports how many
+requests reached the Stripe stand-in, lookups per second, hit ratio per
+tier and how many events more than one worker would have processed.
+
+    $ python benchmarks/shared_cache.py --workers 4 --lookups 2000
+"""
+import argparse
+import multiprocessing
+import os
+import random
+import sys
+import tempfile
+import time
+
+from common import load_app
+from fake_redis import FakeRedis
+from fake_stripe import FakeStripe
+
+# Set in the parent before forking the workers
+SCENARIO = {}
+
+
+def worker(index):
+    import stripe
+    from event_ledger import EventLedger
+    from stripe_cache import StripeCache
+
+    args, shared = SCENARIO["args"], SCENARIO["shared"]
+    cache = StripeCache(shared=shared, local_ttl=args.local_ttl)
+    rng = random.Random(index)
+    # Popular invoices are looked up far more often than the rest
+    weights = [1 / (rank + 1) for rank in range(args.objects)]
+    ids = rng.choices(range(args.objects), weights, k=args.lookups)
+    start = time.perf_counter()
+    for i in ids:
+        cache.retrieve(
+            stripe.Invoice, f"in_{i}", expand=["subscription", "payment_intent"]
+        )
+    elapsed = time.perf_counter() - start
+    ledger = EventLedger(
+        os.path.join(SCENARIO["tmp"], f"ledger-{index}.sqlite3"), shared=shared
+    )
+    processed = sum(ledger.add(f"evt_{i}") for i in range(args.events))
+    return elapsed, cache.stats(), processed
+
+
+def run(args, name, shared):
+    SCENARIO.update(args=args, shared=shared, tmp=tempfile.mkdtemp(prefix="mb-"))
+    stripe_server = SCENARIO["stripe"]
+    requests_before = stripe_server.requests
+    with multiprocessing.get_context("fork").Pool(args.workers) as pool:
+        results = pool.map(worker, range(args.workers))
+    lookups = args.workers * args.lookups
+    tiers = {}
+    for _, stats, _ in results:
+        for tier, s in stats["tiers"].items():
+            totals = tiers.setdefault(tier, [0, 0])
+            totals[0] += s["hits"]
+            totals[1] += s["hits"] + s["misses"]
+    print(
+        "{:<8} {:>16} {:>12} {:>12} {:>12} {:>16}".format(
+            name,
+            stripe_server.requests - requests_before,
+            "{:.0f}".format(lookups / max(r[0] for r in results)),
+            "{:.2f}".format(tiers["memory"][0] / tiers["memory"][1]),
+            "{:.2f}".format(tiers["shared"][0] / tiers["shared"][1])
+            if "shared" in tiers
+            else "-",
+            sum(r[2] for r in results) - args.events,
+        )
+    )
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description=__doc__.split("\n", 1)[0])
+    parser.add_argument("--workers", type=int, default=4)
+    parser.add_argument("--lookups", type=int, default=2000)
+    parser.add_argument("--objects", type=int, default=500)
+    parser.add_argument("--events", type=int, default=1000)
+    parser.add_argument("--local-ttl", type=float, default=10.0)
+    parser.add_argument("--stripe-latency", type=float, default=0.01)
+    parser.add_argument("--redis-latency", type=float, default=0.0002)
+    args = parser.parse_args(argv)
+
+    application = load_app()
+    from cache_backends import MmapBackend, RedisBackend
+
+    SCENARIO["stripe"] = FakeStripe(latency=args.stripe_latency)
+    application.stripe.api_base = SCENARIO["stripe"].start_in_thread()
+    host, port = FakeRedis(latency=args.redis_latency).start_in_thread()
+    mmap_path = os.path.join(tempfile.mkdtemp(prefix="mb-mmap-"), "cache.mmap")
+
+    print(
+        "{:<8} {:>16} {:>12} {:>12} {:>12} {:>16}".format(
+            "backend",
+            "stripe requests",
+            "lookups/s",
+            "memory hit",
+            "shared hit",
+            "events repeated",
+        )
+    )
+    run(args, "none", None)
+    run(args, "mmap", MmapBackend(mmap_path))
+    run(args, "redis", RedisBackend(host, port))
+    return 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
@@ -0,0 +1,43 @@
+"""Bytes on the wire and latency for static assets with and without compression
+
+    $ python benchmarks/static_assets.py [requests]
+"""
+import sys
+
+from common import load_app, measure, report
+
+ASSETS = [
+    "/static/css/style.css",
+    "/static/js/donate.js",
+    "/static/images/horizontal-logo.svg",
+    "/static/images/3030-header-1440x640-tinyjpg.jpg",
+    "/favicon.ico",
+    "/robots.txt",
+]
+ENCODINGS = ["identity", "gzip, deflate, br"]
+
+
+def main(n=500):
+    application = load_app()
+    client = application.app.test_client()
+    for path in ASSETS:
+        for accept in ENCODINGS:
+            headers = {"Accept-Encoding": accept}
+            response = client.get(path, headers=headers)
+            nbytes = len(response.get_data())
+            response.close()
+
+            def fetch():
+                client.get(path, headers=headers).close()
+
+            rate, latencies = measure(fetch, n)
+            label = "{} [{}]".format(
+                path.rsplit("/", 1)[-1][:20],
+                response.headers.get("Content-Encoding", "identity"),
+            )
+            report(label, rate, latencies)
+            print("{:<32} {:>10} bytes".format("", nbytes))
+
+
+if __name__ == "__main__":
+    main(*map(int, sys.argv[1:]))
@@ -0,0 +1,274 @@
+"""Per-route load test against local Stripe and SendGrid stand-ins
+
+Boots application.app with its Stripe and SendGrid clients pointed at local
+fake servers (with configurable latency and error rates). Each route is
+driven with `--concurrency` threads, and throughput and latency percentiles
+are reported per route. Webhooks are signed like Stripe's, and the suite
+waits for the webhook queue to drain so that handler work is included.
+
+    $ python benchmarks/suite.py                      # report only
+    $ python benchmarks/suite.py --save baseline.json
+    $ python benchmarks/suite.py --check benchmarks/baseline.json
+
+`--check` reruns with the baseline's settings and exits with status 1 if
+any route's p95 latency, throughput or error rate regressed by more than
+`--tolerance`. Latency and throughput only compare on the machine and Python
+the baseline was measured with, so elsewhere (e.g. CI) pass `--warn-timing`
+to print those regressions without failing; error rates still fail.
+"""
+import argparse
+import itertools
+import json
+import platform
+import sys
+import time
+from concurrent.futures import ThreadPoolExecutor
+
+from common import load_app, percentile, sign_payload
+from fake_sendgrid import FakeSendGrid
+from fake_stripe import FakeStripe
+
+# Distinct session/subscription ids per run, so some retrieves hit the cache
+DISTINCT_OBJECTS = 50
+# Latency regressions smaller than this are noise at these scales
+SLACK_MS = 2.0
+DEFAULTS = {
+    "requests": 200,
+    "concurrency": 8,
+    "stripe_latency": 0.02,
+    "sendgrid_latency": 0.02,
+    "error_rate": 0.0,
+}
+
+
+def webhook_event(n):
+    return json.dumps(
+        {
+            "id": f"evt_bench_{time.time_ns()}_{n}",
+            "object": "event",
+            "type": "checkout.session.completed",
+            "data": {
+                "object": {
+                    "id": f"cs_test_{n % DISTINCT_OBJECTS}",
+                    "object": "checkout.session",
+                    "mode": "payment",
+                }
+            },
+        }
+    )
+
+
+def routes(application):
+    """name -> function(client, n) returning a response"""
+    secret = application.stripe_keys["endpoint_secret"]
+    checkout_body = {"amount": 5000, "frequency": "once", "metadata": {}}
+
+    def hooks(client, n):
+        payload = webhook_event(n)
+        return client.post(
+            "/hooks",
+            data=payload,
+            content_type="application/json",
+            headers={"Stripe-Signature": sign_payload(payload, secret)},
+        )
+
+    return {
+        "/": lambda client, n: client.get("/"),
+        "/<dollars>": lambda client, n: client.get(f"/{n % 500 + 1}/"),
+        "/checkout": lambda client, n: client.post("/checkout", json=checkout_body),
+        "/success": lambda client, n: client.get(
+            f"/success?session_id=cs_test_{n % DISTINCT_OBJECTS}"
+        ),
+        "/subscriptions/<id>": lambda client, n: client.get(
+            f"/subscriptions/sub_{n % DISTINCT_OBJECTS}"
+        ),
+        "/hooks": hooks,
+    }
+
+
+def drive(client, fn, requests, concurrency):
+    """Returns (elapsed seconds, latencies, error count)"""
+    counter = itertools.count()
+
+    def one(_):
+        n = next(counter)
+        t0 = time.perf_counter()
+        response = fn(client, n)
+        elapsed = time.perf_counter() - t0
+        ok = response.status_code == 200
+        response.close()
+        return elapsed, ok
+
+    start = time.perf_counter()
+    with ThreadPoolExecutor(concurrency) as pool:
+        results = list(pool.map(one, range(requests)))
+    return (
+        time.perf_counter() - start,
+        [t for t, _ in results],
+        sum(1 for _, ok in results if not ok),
+    )
+
+
+def wait_for_webhooks(application, timeout=60):
+    start = time.perf_counter()
+    while time.perf_counter() - start < timeout:
+        depth = application.webhook_queue.depth()
+        if not depth["pending"] and not depth["running"]:
+            break
+        time.sleep(0.05)
+    application.email_batcher.flush()
+    return time.perf_counter() - start
+
+
+def run(config):
+    application = load_app()
+    stripe_server = FakeStripe(
+        latency=config["stripe_latency"], error_rate=config["error_rate"], seed=1
+    )
+    sendgrid_server = FakeSendGrid(
+        latency=config["sendgrid_latency"], error_rate=config["error_rate"], seed=2
+    )
+    application.stripe.api_base = stripe_server.start_in_thread()
+    application.sendgrid_client.client.host = sendgrid_server.start_in_thread()
+    client = application.app.test_client()
+    results = {}
+    for name, fn in routes(application).items():
+        elapsed, latencies, errors = drive(
+            client, fn, config["requests"], config["concurrency"]
+        )
+        results[name] = {
+            "rps": config["requests"] / elapsed,
+            "p50_ms": 1000 * percentile(latencies, 50),
+            "p95_ms": 1000 * percentile(latencies, 95),
+            "p99_ms": 1000 * percentile(latencies, 99),
+            "max_ms": 1000 * max(latencies),
+            "error_rate": errors / config["requests"],
+        }
+    drain = wait_for_webhooks(application)
+    print(
+        "webhook queue drained {:.2f}s after the last /hooks request; "
+        "{} Stripe requests, {} SendGrid requests ({} receipts)".format(
+            drain,
+            stripe_server.requests,
+            sendgrid_server.requests,
+            sendgrid_server.personalizations,
+        )
+    )
+    return results
+
+
+def print_results(results):
+    print(
+        "{:<22} {:>9} {:>9} {:>9} {:>9} {:>9} {:>7}".format(
+            "route", "req/s", "p50 ms", "p95 ms", "p99 ms", "max ms", "errors"
+        )
+    )
+    for name, r in results.items():
+        print(
+            "{:<22} {:>9.0f} {:>9.2f} {:>9.2f} {:>9.2f} {:>9.2f} {:>6.1%}".format(
+                name,
+                r["rps"],
+                r["p50_ms"],
+                r["p95_ms"],
+                r["p99_ms"],
+                r["max_ms"],
+                r["error_rate"],
+            )
+        )
+
+
+def regressions(baseline, results, tolerance):
+    """(timing, description) for every way a route is worse than `baseline`
+    beyond `tolerance`, where `timing` is whether it's latency or throughput
+
+    >>> base = {"/": {"rps": 100, "p95_ms": 10.0, "error_rate": 0.0}}
+    >>> regressions(base, {"/": {"rps": 90, "p95_ms": 12.0, "error_rate": 0}}, 0.25)
+    []
+    >>> regressions(base, {"/": {"rps": 50, "p95_ms": 30.0, "error_rate": 0.1}}, 0.25)
+    [(True, '/: p95 30.00 ms > 14.50 ms'), (True, '/: 50 req/s < 80 req/s'), (False, '/: error rate 10.0% > 0.0%')]
+    """
+    rval = []
+    for name, base in baseline.items():
+        r = results.get(name)
+        if r is None:
+            rval.append((False, f"{name}: missing"))
+            continue
+        limit = base["p95_ms"] * (1 + tolerance) + SLACK_MS
+        if r["p95_ms"] > limit:
+            rval.append((True, f"{name}: p95 {r['p95_ms']:.2f} ms > {limit:.2f} ms"))
+        floor = base["rps"] / (1 + tolerance)
+        if r["rps"] < floor:
+            rval.append((True, f"{name}: {r['rps']:.0f} req/s < {floor:.0f} req/s"))
+        if r["error_rate"] > base["error_rate"] + 0.01:
+            rval.append(
+                (
+                    False,
+                    f"{name}: error rate {r['error_rate']:.1%}"
+                    f" > {base['error_rate']:.1%}",
+                )
+            )
+    return rval
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description=__doc__.split("\n", 1)[0])
+    parser.add_argument("--requests", type=int, help="per route")
+    parser.add_argument("--concurrency", type=int)
+    parser.add_argument("--stripe-latency", type=float, help="seconds")
+    parser.add_argument("--sendgrid-latency", type=float, help="seconds")
+    parser.add_argument("--error-rate", type=float, help="fraction of upstream 500s")
+    parser.add_argument("--save", metavar="PATH", help="write results as a baseline")
+    parser.add_argument("--check", metavar="PATH", help="compare with a baseline")
+    parser.add_argument("--tolerance", type=float, default=0.5)
+    parser.add_argument(
+        "--warn-timing",
+        action="store_true",
+        help="don't fail on latency or throughput regressions",
+    )
+    args = parser.parse_args(argv)
+
+    config = dict(DEFAULTS)
+    baseline = None
+    if args.check:
+        with open(args.check) as f:
+            baseline = json.load(f)
+        config.update(baseline["config"])
+    for key in DEFAULTS:
+        if getattr(args, key) is not None:
+            config[key] = getattr(args, key)
+
+    results = run(config)
+    print_results(results)
+    if args.save:
+        with open(args.save, "w") as f:
+            json.dump(
+                {
+                    "config": config,
+                    "python": platform.python_version(),
+                    "routes": results,
+                },
+                f,
+                indent=2,
+                sort_keys=True,
+            )
+            f.write("\n")
+    if baseline is not None:
+        failed = False
+        for timing, problem in regressions(baseline["routes"], results, args.tolerance):
+            if timing and args.warn_timing:
+                print(f"WARNING {problem}")
+            else:
+                print(f"REGRESSION {problem}")
+                failed = True
+        if args.warn_timing and baseline.get("python") != platform.python_version():
+            print(
+                "baseline measured with Python {}, timings are only indicative".format(
+                    baseline.get("python")
+                )
+            )
+        return 1 if failed else 0
+    return 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
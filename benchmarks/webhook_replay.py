@@ -0,0 +1,349 @@
+"""Replay signed Stripe webhook events against /hooks to measure throughput
+
+Events are either generated (a mix of checkout.session.completed,
+invoice.payment_succeeded and invoice.payment_failed) or loaded from recorded
+events with `--events` (a list object, a JSON array or JSON lines, e.g. as
+exported from the Stripe API). Each event is signed with
+WEBHOOK_SIGNING_SECRET when it is sent, so that stripe_webhook verifies it
+exactly as it would a real one, and gets a fresh event id unless
+`--keep-ids` is given (the app drops duplicates).
+
+By default the app runs in-process with its Stripe and SendGrid clients
+pointed at local stand-ins. With `--url` the events are posted over HTTP to
+a running app instead, and the stage latencies are read from its
+/internal/stats (they are cumulative since that process started), with
+`--token` if the app has INTERNAL_TOKEN set.
+
+    $ python benchmarks/webhook_replay.py --count 500             # burst
+    $ python benchmarks/webhook_replay.py --count 500 --rate 50   # events/s
+    $ python benchmarks/webhook_replay.py --events events.jsonl \\
+          --url http://localhost:5000 --rate 20
+"""
+import argparse
+import http.client
+import itertools
+import json
+import os
+import random
+import sys
+import threading
+import time
+from collections import Counter
+from concurrent.futures import ThreadPoolExecutor
+from urllib.parse import urlsplit
+
+from common import ROOT, load_app, percentile, sign_payload
+
+DEFAULT_MIX = (
+    "checkout.session.completed=6,invoice.payment_succeeded=3,"
+    "invoice.payment_failed=1"
+)
+
+
+def invoice_object(n):
+    return {"id": f"in_replay_{n}", "object": "invoice"}
+
+
+OBJECTS = {
+    "checkout.session.completed": lambda n: {
+        "id": f"cs_replay_{n}",
+        "object": "checkout.session",
+        "mode": "payment",
+    },
+    "invoice.payment_succeeded": invoice_object,
+    "invoice.payment_failed": invoice_object,
+}
+
+
+def parse_mix(text):
+    """Event type weights from "type=weight,..."
+
+    >>> parse_mix("invoice.payment_succeeded=3,invoice.payment_failed=1")
+    {'invoice.payment_succeeded': 3.0, 'invoice.payment_failed': 1.0}
+    """
+    rval = {}
+    for item in text.split(","):
+        event_type, _, weight = item.partition("=")
+        if event_type.strip() not in OBJECTS:
+            raise ValueError(f"unknown event type {event_type.strip()!r}")
+        rval[event_type.strip()] = float(weight or 1)
+    return rval
+
+
+def generate_events(count, mix, seed=0):
+    """`count` events with types drawn from the `mix` weights
+
+    >>> [e["type"] for e in generate_events(2, {"invoice.payment_failed": 1})]
+    ['invoice.payment_failed', 'invoice.payment_failed']
+    """
+    rng = random.Random(seed)
+    types = rng.choices(list(mix), weights=list(mix.values()), k=count)
+    for n, event_type in enumerate(types):
+        yield {
+            "id": f"evt_replay_{n}",
+            "object": "event",
+            "type": event_type,
+            "created": int(time.time()),
+            "data": {"object": OBJECTS[event_type](n)},
+        }
+
+
+def load_events(paths):
+    if ROOT not in sys.path:
+        sys.path.insert(0, ROOT)
+    from reconcile import iter_fixture_objects
+
+    for obj in iter_fixture_objects(paths):
+        if obj.get("object") == "event":
+            yield obj
+
+
+def payloads(events, keep_ids=False):
+    """Serialized events, renumbered so that the app doesn't drop them as
+    duplicates of an earlier run
+
+    >>> [json.loads(p)["id"] for p in payloads([{"id": "evt_1"}], keep_ids=True)]
+    ['evt_1']
+    """
+    run = time.time_ns()
+    rval = []
+    for n, event in enumerate(events):
+        if not keep_ids:
+            event = dict(event, id=f"evt_replay_{run}_{n}")
+        rval.append(json.dumps(event))
+    return rval
+
+
+class CountingTelemetryClient:
+    """Stands in for the Application Insights client so that the telemetry
+    stage runs without an instrumentation key"""
+
+    def __init__(self):
+        self.events = 0
+
+    def track_event(self, name, properties=None, measurements=None):
+        self.events += 1
+
+    def flush(self):
+        pass
+
+
+class InProcessTarget:
+    """Posts to application.app through the Flask test client"""
+
+    def __init__(self, application):
+        self.application = application
+        self.client = application.app.test_client()
+        telemetry_client = CountingTelemetryClient()
+        application.get_telemetry_client = lambda: telemetry_client
+        application.telemetry.get_client = application.get_telemetry_client
+
+    def post(self, payload, signature):
+        response = self.client.post(
+            "/hooks",
+            data=payload,
+            content_type="application/json",
+            headers={"Stripe-Signature": signature},
+        )
+        response.close()
+        return response.status_code
+
+    def stats(self):
+        return {
+            "latency": self.application.metrics.summary(),
+            "webhooks": self.application.webhook_queue.stats(),
+        }
+
+    def depth(self):
+        return self.application.webhook_queue.depth()
+
+
+class HTTPTarget:
+    """Posts to a running app over keep-alive connections, one per thread"""
+
+    def __init__(self, url, token=None):
+        self.token = token
+        parts = urlsplit(url)
+        self.connection_class = (
+            http.client.HTTPSConnection
+            if parts.scheme == "https"
+            else http.client.HTTPConnection
+        )
+        self.netloc = parts.netloc
+        self.prefix = parts.path.rstrip("/")
+        self._local = threading.local()
+
+    def request(self, method, path, body=None, headers={}):
+        for attempt in (1, 2):
+            conn = getattr(self._local, "conn", None)
+            if conn is None:
+                conn = self._local.conn = self.connection_class(self.netloc, timeout=60)
+            try:
+                conn.request(method, self.prefix + path, body=body, headers=headers)
+                response = conn.getresponse()
+                return response.status, response.read()
+            except (ConnectionError, http.client.HTTPException):
+                # The server closed an idle keep-alive connection
+                conn.close()
+                self._local.conn = None
+                if attempt == 2:
+                    raise
+
+    def post(self, payload, signature):
+        status, _ = self.request(
+            "POST",
+            "/hooks",
+            body=payload.encode("utf-8"),
+            headers={
+                "Content-Type": "application/json",
+                "Stripe-Signature": signature,
+            },
+        )
+        return status
+
+    def stats(self):
+        headers = {"Authorization": f"Bearer {self.token}"} if self.token else {}
+        status, body = self.request("GET", "/internal/stats", headers=headers)
+        if status != 200:
+            raise SystemExit(f"GET /internal/stats: HTTP {status}, pass --token?")
+        return json.loads(body)
+
+    def depth(self):
+        return self.stats()["webhooks"]["depth"]
+
+
+def replay(target, payloads, secret, rate=None, concurrency=8):
+    """Post every payload, signed as it is sent, all at once or at `rate`/s
+
+    Returns (elapsed seconds, acknowledgement latencies, status counts,
+    worst lag behind the rate schedule in seconds).
+    """
+    counter = itertools.count()
+    start = time.perf_counter()
+
+    def one(_):
+        n = next(counter)
+        lag = 0.0
+        if rate:
+            due = start + n / rate
+            lag = time.perf_counter() - due
+            if lag < 0:
+                time.sleep(-lag)
+                lag = 0.0
+        payload = payloads[n]
+        t0 = time.perf_counter()
+        status = target.post(payload, sign_payload(payload, secret))
+        return time.perf_counter() - t0, status, lag
+
+    with ThreadPoolExecutor(concurrency) as pool:
+        results = list(pool.map(one, range(len(payloads))))
+    return (
+        time.perf_counter() - start,
+        [t for t, _, _ in results],
+        Counter(status for _, status, _ in results),
+        max((lag for _, _, lag in results), default=0.0),
+    )
+
+
+def wait_for_drain(target, timeout):
+    start = time.perf_counter()
+    while time.perf_counter() - start < timeout:
+        depth = target.depth()
+        if not depth["pending"] and not depth["running"]:
+            break
+        time.sleep(0.1)
+    return time.perf_counter() - start
+
+
+def print_stages(stats):
+    """Stage latencies from the app's metrics and webhook queue stats"""
+    print(
+        "{:<34} {:>7} {:>9} {:>9} {:>9}".format(
+            "stage", "count", "p50 ms", "p95 ms", "p99 ms"
+        )
+    )
+    for key, s in stats["latency"].items():
+        if key.startswith("webhook{"):
+            stage = key[len('webhook{stage="') : -len('"}')]
+            print(
+                "{:<34} {:>7} {:>9.2f} {:>9.2f} {:>9.2f}".format(
+                    stage, s["count"], s["p50_ms"], s["p95_ms"], s["p99_ms"]
+                )
+            )
+    print("{:<34} {:>7} {:>9} {:>9}".format("queue", "count", "mean ms", "max ms"))
+    for key, s in sorted(stats["webhooks"]["latency"].items()):
+        print(
+            "{:<34} {:>7} {:>9.2f} {:>9.2f}".format(
+                key, s["count"], s["mean_ms"], s["max_ms"]
+            )
+        )
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description=__doc__.split("\n", 1)[0])
+    parser.add_argument("--count", type=int, default=200, help="events to generate")
+    parser.add_argument("--mix", default=DEFAULT_MIX, help="type=weight,...")
+    parser.add_argument("--events", nargs="+", metavar="PATH", help="recorded events")
+    parser.add_argument("--keep-ids", action="store_true")
+    parser.add_argument("--rate", type=float, help="events/s (default: one burst)")
+    parser.add_argument("--concurrency", type=int, default=8)
+    parser.add_argument("--url", help="post to a running app instead")
+    parser.add_argument("--secret", help="signing secret (WEBHOOK_SIGNING_SECRET)")
+    parser.add_argument(
+        "--token", help="for /internal/stats with --url (INTERNAL_TOKEN)"
+    )
+    parser.add_argument("--stripe-latency", type=float, default=0.05)
+    parser.add_argument("--sendgrid-latency", type=float, default=0.05)
+    parser.add_argument("--drain-timeout", type=float, default=600)
+    args = parser.parse_args(argv)
+
+    if args.events:
+        events = load_events(args.events)
+    else:
+        events = generate_events(args.count, parse_mix(args.mix))
+    bodies = payloads(events, keep_ids=args.keep_ids)
+
+    if args.url:
+        target = HTTPTarget(args.url, args.token or os.environ.get("INTERNAL_TOKEN"))
+        secret = args.secret or os.environ["WEBHOOK_SIGNING_SECRET"]
+    else:
+        from fake_sendgrid import FakeSendGrid
+        from fake_stripe import FakeStripe
+
+        application = load_app()
+        application.stripe.api_base = FakeStripe(
+            latency=args.stripe_latency
+        ).start_in_thread()
+        application.sendgrid_client.client.host = FakeSendGrid(
+            latency=args.sendgrid_latency
+        ).start_in_thread()
+        target = InProcessTarget(application)
+        secret = args.secret or application.stripe_keys["endpoint_secret"]
+
+    elapsed, latencies, statuses, lag = replay(
+        target, bodies, secret, rate=args.rate, concurrency=args.concurrency
+    )
+    drain = wait_for_drain(target, args.drain_timeout)
+    print(
+        "{} events acknowledged in {:.2f}s ({:.0f}/s, p50 {:.2f} ms, p99 {:.2f} ms, "
+        "statuses {}), worst lag behind schedule {:.2f}s".format(
+            len(bodies),
+            elapsed,
+            len(bodies) / elapsed,
+            1000 * percentile(latencies, 50),
+            1000 * percentile(latencies, 99),
+            dict(statuses),
+            lag,
+        )
+    )
+    print(
+        "processed in {:.2f}s ({:.1f} events/s end to end)".format(
+            elapsed + drain, len(bodies) / (elapsed + drain)
+        )
+    )
+    print_stages(target.stats())
+    return 0 if set(statuses) == {200} else 1
+
+
+if __name__ == "__main__":
+    sys.exit(main())
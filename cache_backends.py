@@ -0,0 +1,598 @@
+"""Cache backends shared between workers and instances, and a tiered cache
+
+Every backend has the same small interface: `get`, `set`, `add` (set only if
+absent, which is atomic in shared backends), `delete` and `stats`. Entries
+may be given a TTL in seconds.
+
+- `MemoryBackend` is a per-process LRU, values are stored as they are
+- `MmapBackend` is a fixed-size hash table in a memory-mapped file, so that
+  workers on the same machine share it
+- `RedisBackend` speaks enough RESP to use a Redis (or compatible) server
+  shared by every instance
+
+Shared backends store bytes. `TieredCache` puts a `MemoryBackend` in front
+of a shared one, serializes values for the shared tier and counts hits per
+tier. `backend_from_url` picks the shared backend from `CACHE_URL`.
+"""
+import hashlib
+import mmap
+import os
+import socket
+import struct
+import threading
+import time
+from urllib.parse import unquote, urlsplit
+
+from caching import LRUCache
+from resilience import CircuitBreaker
+
+try:
+    import fcntl
+except ImportError:
+    fcntl = None
+
+__all__ = [
+    "CacheError",
+    "MemoryBackend",
+    "MmapBackend",
+    "RedisBackend",
+    "TieredCache",
+    "backend_from_url",
+]
+
+MISSING = object()
+
+
+class CacheError(Exception):
+    """A shared backend could not be reached or answered with an error"""
+
+
+def _expires_at(ttl, clock):
+    return 0.0 if ttl is None else clock() + ttl
+
+
+class MemoryBackend:
+    """A per-process LRU with per-entry TTLs, capped at `max_ttl`
+
+    >>> now = [0.0]
+    >>> cache = MemoryBackend(2, max_ttl=60, clock=lambda: now[0])
+    >>> cache.set('a', 1, ttl=300)
+    >>> cache.add('a', 2), cache.get('a')
+    (False, 1)
+    >>> now[0] = 60.0
+    >>> cache.get('a') is None, cache.add('a', 2), cache.get('a')
+    (True, True, 2)
+    """
+
+    serialized = False
+
+    def __init__(self, maxsize: int, max_ttl: float = None, clock=time.monotonic):
+        self.cache = LRUCache(maxsize)
+        self.max_ttl = max_ttl
+        self.clock = clock
+        # add is a get and a set that must not interleave with another add
+        self._lock = threading.Lock()
+
+    def _ttl(self, ttl):
+        if self.max_ttl is None:
+            return ttl
+        return self.max_ttl if ttl is None else min(ttl, self.max_ttl)
+
+    def get(self, key, default=None):
+        entry = self.cache.get(key)
+        if entry is None:
+            return default
+        value, expires_at = entry
+        if expires_at and self.clock() >= expires_at:
+            self.cache.pop(key)
+            return default
+        return value
+
+    def set(self, key, value, ttl: float = None) -> None:
+        self.cache.set(key, (value, _expires_at(self._ttl(ttl), self.clock)))
+
+    def add(self, key, value, ttl: float = None) -> bool:
+        with self._lock:
+            if self.get(key, MISSING) is not MISSING:
+                return False
+            self.set(key, value, ttl)
+            return True
+
+    def delete(self, key) -> None:
+        self.cache.pop(key)
+
+    def stats(self) -> dict:
+        return self.cache.stats()
+
+
+# key hash (0 is an empty slot), expiry (0 never expires), value length,
+# key length
+SLOT_HEADER = struct.Struct("<QdIH")
+# Slots probed for a key, the oldest of them is evicted when all are taken
+PROBES = 8
+
+
+def _key_hash(key: bytes) -> int:
+    return int.from_bytes(hashlib.blake2b(key, digest_size=8).digest(), "little") or 1
+
+
+class MmapBackend:
+    """A hash table of `slots` fixed-size slots in a file mapped by every
+    worker on the machine
+
+    Values larger than a slot are not cached. Operations take an exclusive
+    `flock` on the file, so they are atomic across processes.
+
+    >>> import tempfile
+    >>> path = os.path.join(tempfile.mkdtemp(), 'cache.mmap')
+    >>> cache = MmapBackend(path, slots=16, slot_size=64)
+    >>> cache.set('a', b'1')
+    >>> cache.add('a', b'2'), cache.get('a')
+    (False, b'1')
+    >>> MmapBackend(path, slots=16, slot_size=64).get('a')
+    b'1'
+    >>> cache.delete('a')
+    >>> cache.add('a', b'2'), cache.get('a')
+    (True, b'2')
+    >>> cache.set('b', b'x' * 64)
+    >>> cache.get('b') is None, cache.stats()['too_large']
+    (True, 1)
+    """
+
+    serialized = True
+
+    def __init__(
+        self, path: str, slots: int = 4096, slot_size: int = 16384, clock=time.time
+    ):
+        if fcntl is None:
+            raise RuntimeError("MmapBackend needs fcntl.flock")
+        self.path = path
+        self.slots = slots
+        self.slot_size = slot_size
+        # Shared between processes, so expiry uses wall clock time
+        self.clock = clock
+        self._lock = threading.Lock()
+        # Threads share this process's file descriptor, so flock alone does
+        # not exclude them
+        self._op_lock = threading.Lock()
+        self._mapped = None
+        self.counters = {"hits": 0, "misses": 0, "evictions": 0, "too_large": 0}
+        os.makedirs(os.path.dirname(os.path.abspath(path)), exist_ok=True)
+        fd = os.open(path, os.O_RDWR | os.O_CREAT, 0o600)
+        try:
+            if os.fstat(fd).st_size < slots * slot_size:
+                os.ftruncate(fd, slots * slot_size)
+        finally:
+            os.close(fd)
+
+    def _map(self):
+        """This process's (file descriptor, mmap), flock does not exclude
+        other processes holding the same open file, so each pid opens its own
+        """
+        with self._lock:
+            mapped = self._mapped
+            if mapped is None or mapped[0] != os.getpid():
+                fd = os.open(self.path, os.O_RDWR)
+                mapped = (os.getpid(), fd, mmap.mmap(fd, self.slots * self.slot_size))
+                self._mapped = mapped
+            return mapped[1], mapped[2]
+
+    def _count(self, name):
+        with self._lock:
+            self.counters[name] += 1
+
+    def _locked(self, fn):
+        fd, mm = self._map()
+        with self._op_lock:
+            fcntl.flock(fd, fcntl.LOCK_EX)
+            try:
+                return fn(mm)
+            finally:
+                fcntl.flock(fd, fcntl.LOCK_UN)
+
+    def _find(self, mm, key, h, now):
+        """(offset of `key`'s live slot or None, offset to store it in, or
+        None if every probed slot is taken)
+        """
+        free = None
+        start = h % self.slots
+        for i in range(PROBES):
+            offset = ((start + i) % self.slots) * self.slot_size
+            slot_hash, expires_at, _, key_len = SLOT_HEADER.unpack_from(mm, offset)
+            if not slot_hash or (expires_at and now >= expires_at):
+                if free is None:
+                    free = offset
+            elif slot_hash == h:
+                start_key = offset + SLOT_HEADER.size
+                if mm[start_key : start_key + key_len] == key:
+                    return offset, offset
+        return None, free
+
+    def _victim(self, mm, h):
+        """The probed slot whose entry expires first"""
+        start = h % self.slots
+        offsets = [((start + i) % self.slots) * self.slot_size for i in range(PROBES)]
+        return min(
+            offsets,
+            key=lambda offset: SLOT_HEADER.unpack_from(mm, offset)[1] or float("inf"),
+        )
+
+    def _read(self, mm, offset):
+        _, _, value_len, key_len = SLOT_HEADER.unpack_from(mm, offset)
+        start = offset + SLOT_HEADER.size + key_len
+        return mm[start : start + value_len]
+
+    def _write(self, mm, offset, key, h, value, ttl):
+        SLOT_HEADER.pack_into(
+            mm, offset, h, _expires_at(ttl, self.clock), len(value), len(key)
+        )
+        start = offset + SLOT_HEADER.size
+        mm[start : start + len(key)] = key
+        mm[start + len(key) : start + len(key) + len(value)] = value
+
+    def _store(self, key, value, ttl, only_if_absent):
+        key = key.encode("utf-8")
+        if SLOT_HEADER.size + len(key) + len(value) > self.slot_size:
+            self._count("too_large")
+            return False
+        h = _key_hash(key)
+
+        def store(mm):
+            found, offset = self._find(mm, key, h, self.clock())
+            if found is not None and only_if_absent:
+                return False
+            if offset is None:
+                offset = self._victim(mm, h)
+                self._count("evictions")
+            self._write(mm, offset, key, h, value, ttl)
+            return True
+
+        return self._locked(store)
+
+    def get(self, key, default=None):
+        key = key.encode("utf-8")
+        h = _key_hash(key)
+
+        def get(mm):
+            found, _ = self._find(mm, key, h, self.clock())
+            return None if found is None else self._read(mm, found)
+
+        value = self._locked(get)
+        self._count("misses" if value is None else "hits")
+        return default if value is None else value
+
+    def set(self, key, value: bytes, ttl: float = None) -> None:
+        self._store(key, value, ttl, only_if_absent=False)
+
+    def add(self, key, value: bytes, ttl: float = None) -> bool:
+        if not self._store(key, value, ttl, only_if_absent=True):
+            if (
+                SLOT_HEADER.size + len(key.encode("utf-8")) + len(value)
+                > self.slot_size
+            ):
+                raise CacheError(f"{len(value)} byte value does not fit a slot")
+            return False
+        return True
+
+    def delete(self, key) -> None:
+        key = key.encode("utf-8")
+        h = _key_hash(key)
+
+        def delete(mm):
+            found, _ = self._find(mm, key, h, self.clock())
+            if found is not None:
+                SLOT_HEADER.pack_into(mm, found, 0, 0.0, 0, 0)
+
+        self._locked(delete)
+
+    def stats(self) -> dict:
+        with self._lock:
+            return dict(self.counters)
+
+
+def encode_command(*args) -> bytes:
+    """A RESP array of bulk strings
+
+    >>> encode_command("SET", "k", b"v", "PX", 1000)
+    b'*5\\r\\n$3\\r\\nSET\\r\\n$1\\r\\nk\\r\\n$1\\r\\nv\\r\\n$2\\r\\nPX\\r\\n$4\\r\\n1000\\r\\n'
+    """
+    parts = [b"*%d\r\n" % len(args)]
+    for arg in args:
+        if not isinstance(arg, bytes):
+            arg = str(arg).encode("utf-8")
+        parts.append(b"$%d\r\n%s\r\n" % (len(arg), arg))
+    return b"".join(parts)
+
+
+def read_reply(f):
+    """Read one RESP reply from a binary file object
+
+    >>> import io
+    >>> read_reply(io.BytesIO(b'$3\\r\\nabc\\r\\n')), read_reply(io.BytesIO(b'$-1\\r\\n'))
+    (b'abc', None)
+    >>> read_reply(io.BytesIO(b'*2\\r\\n+OK\\r\\n:1\\r\\n'))
+    ['OK', 1]
+    >>> read_reply(io.BytesIO(b'-ERR wrong type\\r\\n'))
+    Traceback (most recent call last):
+      ...
+    cache_backends.CacheError: ERR wrong type
+    """
+    line = f.readline()
+    if not line.endswith(b"\r\n"):
+        raise ConnectionError("connection closed")
+    kind, rest = line[:1], line[1:-2]
+    if kind == b"+":
+        return rest.decode("utf-8")
+    if kind == b"-":
+        raise CacheError(rest.decode("utf-8"))
+    if kind == b":":
+        return int(rest)
+    if kind == b"$":
+        length = int(rest)
+        if length < 0:
+            return None
+        data = f.read(length + 2)
+        if len(data) != length + 2:
+            raise ConnectionError("connection closed")
+        return data[:-2]
+    if kind == b"*":
+        length = int(rest)
+        return None if length < 0 else [read_reply(f) for _ in range(length)]
+    raise CacheError(f"unexpected reply {line!r}")
+
+
+class RedisBackend:
+    """A Redis client with one connection per thread
+
+    Failures raise `CacheError` after a single attempt, and a circuit
+    breaker stops waiting on a server that keeps failing.
+    """
+
+    serialized = True
+
+    def __init__(
+        self,
+        host: str = "127.0.0.1",
+        port: int = 6379,
+        db: int = 0,
+        password: str = None,
+        timeout: float = 0.25,
+        breaker: CircuitBreaker = None,
+    ):
+        self.host = host
+        self.port = port
+        self.db = db
+        self.password = password
+        self.timeout = timeout
+        self.breaker = breaker or CircuitBreaker(
+            "cache", failure_threshold=5, reset_timeout=10
+        )
+        self._local = threading.local()
+        self._lock = threading.Lock()
+        self.counters = {"hits": 0, "misses": 0, "errors": 0, "connections": 0}
+
+    def _count(self, name):
+        with self._lock:
+            self.counters[name] += 1
+
+    def _connect(self):
+        sock = socket.create_connection((self.host, self.port), self.timeout)
+        sock.setsockopt(socket.IPPROTO_TCP, socket.TCP_NODELAY, 1)
+        conn = (os.getpid(), sock, sock.makefile("rb"))
+        self._count("connections")
+        if self.password:
+            self._send(conn, "AUTH", self.password)
+        if self.db:
+            self._send(conn, "SELECT", self.db)
+        return conn
+
+    def _send(self, conn, *args):
+        conn[1].sendall(encode_command(*args))
+        return read_reply(conn[2])
+
+    def _close(self):
+        conn = getattr(self._local, "conn", None)
+        self._local.conn = None
+        if conn is not None:
+            conn[2].close()
+            conn[1].close()
+
+    def command(self, *args):
+        if not self.breaker.allow():
+            self._count("errors")
+            raise CacheError("cache breaker is open")
+        try:
+            conn = getattr(self._local, "conn", None)
+            if conn is None or conn[0] != os.getpid():
+                conn = self._local.conn = self._connect()
+            reply = self._send(conn, *args)
+        except (OSError, CacheError) as e:
+            self._close()
+            self._count("errors")
+            # Error replies mean the server is up
+            self.breaker.record(ok=isinstance(e, CacheError))
+            if isinstance(e, CacheError):
+                raise
+            raise CacheError(str(e)) from e
+        except BaseException:
+            self._close()
+            self.breaker.record(ok=False)
+            raise
+        self.breaker.record(ok=True)
+        return reply
+
+    def get(self, key, default=None):
+        value = self.command("GET", key)
+        self._count("misses" if value is None else "hits")
+        return default if value is None else value
+
+    def set(self, key, value: bytes, ttl: float = None) -> None:
+        if ttl is None:
+            self.command("SET", key, value)
+        else:
+            self.command("SET", key, value, "PX", max(1, int(ttl * 1000)))
+
+    def add(self, key, value: bytes, ttl: float = None) -> bool:
+        args = ["SET", key, value, "NX"]
+        if ttl is not None:
+            args.extend(["PX", max(1, int(ttl * 1000))])
+        return self.command(*args) is not None
+
+    def delete(self, key) -> None:
+        self.command("DEL", key)
+
+    def stats(self) -> dict:
+        with self._lock:
+            rval = dict(self.counters)
+        rval["breaker"] = self.breaker.state
+        return rval
+
+
+def backend_from_url(url):
+    """The shared backend for a `CACHE_URL`, or None when it is empty
+
+    >>> backend_from_url('')
+    >>> cache = backend_from_url('redis://:secret@cache.internal:6380/2')
+    >>> cache.host, cache.port, cache.db, cache.password
+    ('cache.internal', 6380, 2, 'secret')
+    >>> backend_from_url('ftp://example.com')
+    Traceback (most recent call last):
+      ...
+    ValueError: unsupported CACHE_URL scheme 'ftp'
+    """
+    if not url:
+        return None
+    parts = urlsplit(url)
+    if parts.scheme == "redis":
+        return RedisBackend(
+            parts.hostname or "127.0.0.1",
+            parts.port or 6379,
+            db=int(parts.path.strip("/") or 0),
+            password=parts.password and unquote(parts.password),
+        )
+    if parts.scheme == "mmap":
+        return MmapBackend(unquote(parts.path))
+    raise ValueError(f"unsupported CACHE_URL scheme {parts.scheme!r}")
+
+
+class TieredCache:
+    """Look keys up in each of `tiers` ((name, backend) pairs) in order
+
+    A hit in a later tier is copied into the earlier ones. Values are passed
+    through `dumps`/`loads` for backends that store bytes. Shared tiers that
+    fail are treated as a miss.
+
+    >>> front, shared = MemoryBackend(10), MemoryBackend(10)
+    >>> cache = TieredCache([("memory", front), ("shared", shared)], ttl=60)
+    >>> cache.set('a', 1)
+    >>> front.delete('a')
+    >>> cache.get('a'), cache.get('a'), cache.get('b')
+    (1, 1, None)
+    >>> stats = cache.stats()
+    >>> stats['hits'], stats['misses'], stats['tiers']['shared']['hit_ratio']
+    (2, 1, 0.5)
+    >>> cache.add('a', 2), cache.add('c', 3), shared.get('c')
+    (False, True, 3)
+    """
+
+    def __init__(self, tiers, ttl: float = None, dumps=None, loads=None):
+        self.tiers = list(tiers)
+        self.ttl = ttl
+        self.dumps = dumps or (lambda value: value)
+        self.loads = loads or (lambda data: data)
+        self._lock = threading.Lock()
+        self.counters = {
+            name: {"hits": 0, "misses": 0, "errors": 0} for name, _ in self.tiers
+        }
+
+    def _count(self, name, counter):
+        with self._lock:
+            self.counters[name][counter] += 1
+
+    def _encode(self, backend, value):
+        return self.dumps(value) if backend.serialized else value
+
+    def _decode(self, backend, value):
+        return self.loads(value) if backend.serialized else value
+
+    def get(self, key, default=None):
+        for i, (name, backend) in enumerate(self.tiers):
+            try:
+                value = backend.get(key, MISSING)
+            except CacheError:
+                self._count(name, "errors")
+                continue
+            if value is MISSING:
+                self._count(name, "misses")
+                continue
+            self._count(name, "hits")
+            value = self._decode(backend, value)
+            for _, earlier in self.tiers[:i]:
+                self._set(earlier, key, value, self.ttl)
+            return value
+        return default
+
+    def _set(self, backend, key, value, ttl):
+        try:
+            backend.set(key, self._encode(backend, value), ttl)
+        except CacheError:
+            pass
+
+    def set(self, key, value, ttl: float = None) -> None:
+        ttl = self.ttl if ttl is None else ttl
+        for name, backend in self.tiers:
+            try:
+                backend.set(key, self._encode(backend, value), ttl)
+            except CacheError:
+                self._count(name, "errors")
+
+    def add(self, key, value, ttl: float = None) -> bool:
+        """Store `value` unless `key` is present, the last tier decides
+
+        Raises CacheError if the last tier can't be reached.
+        """
+        ttl = self.ttl if ttl is None else ttl
+        *front, (name, last) = self.tiers
+        for _, backend in front:
+            if backend.get(key, MISSING) is not MISSING:
+                return False
+        try:
+            added = last.add(key, self._encode(last, value), ttl)
+        except CacheError:
+            self._count(name, "errors")
+            raise
+        if added:
+            for _, backend in front:
+                self._set(backend, key, value, ttl)
+        return added
+
+    def delete(self, key) -> None:
+        for name, backend in self.tiers:
+            try:
+                backend.delete(key)
+            except CacheError:
+                self._count(name, "errors")
+
+    def stats(self) -> dict:
+        tiers = {}
+        with self._lock:
+            counters = {name: dict(c) for name, c in self.counters.items()}
+        for name, backend in self.tiers:
+            c = counters[name]
+            lookups = c["hits"] + c["misses"]
+            tiers[name] = dict(
+                backend.stats(),
+                hits=c["hits"],
+                misses=c["misses"],
+                errors=c["errors"],
+                hit_ratio=c["hits"] / lookups if lookups else 0.0,
+            )
+        hits = sum(c["hits"] for c in counters.values())
+        name = self.tiers[-1][0]
+        misses = counters[name]["misses"] + counters[name]["errors"]
+        return {
+            "hits": hits,
+            "misses": misses,
+            "hit_ratio": hits / (hits + misses) if hits + misses else 0.0,
+            "tiers": tiers,
+        }
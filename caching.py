@@ -0,0 +1,70 @@
+"""Small in-process caches
+
+"""
+import threading
+from collections import OrderedDict
+
+__all__ = ["LRUCache"]
+
+MISSING = object()
+
+
+class LRUCache:
+    """A thread-safe bounded mapping that evicts the least recently used key
+
+    >>> cache = LRUCache(2)
+    >>> cache.set('a', 1)
+    >>> cache.set('b', 2)
+    >>> cache.get('a')
+    1
+    >>> cache.set('c', 3)
+    >>> cache.get('b') is None
+    True
+    >>> sorted(cache.stats().items())
+    [('evictions', 1), ('hits', 1), ('misses', 1), ('size', 2)]
+    """
+
+    def __init__(self, maxsize: int):
+        self.maxsize = maxsize
+        self._data = OrderedDict()
+        self._lock = threading.Lock()
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+
+    def __len__(self):
+        return len(self._data)
+
+    def get(self, key, default=None):
+        with self._lock:
+            value = self._data.get(key, MISSING)
+            if value is MISSING:
+                self.misses += 1
+                return default
+            self._data.move_to_end(key)
+            self.hits += 1
+            return value
+
+    def set(self, key, value) -> None:
+        with self._lock:
+            self._data[key] = value
+            self._data.move_to_end(key)
+            while len(self._data) > self.maxsize:
+                self._data.popitem(last=False)
+                self.evictions += 1
+
+    def pop(self, key, default=None):
+        with self._lock:
+            return self._data.pop(key, default)
+
+    def clear(self) -> None:
+        with self._lock:
+            self._data.clear()
+
+    def stats(self) -> dict:
+        return {
+            "size": len(self._data),
+            "hits": self.hits,
+            "misses": self.misses,
+            "evictions": self.evictions,
+        }
@@ -0,0 +1,262 @@
+"""Append-only store of donations with running totals per host and frequency
+
+The webhook handlers append one row per donation charge. The same
+transaction adds it to running totals per (host, frequency), both all-time
+and per hour, so the totals shown on /stats are a primary key lookup
+however many donations there are. Old donation rows can be compacted away,
+since the totals already include them.
+
+    $ python donation_store.py totals --host gala.missionbit.org
+    $ python donation_store.py snapshot backups/donations.sqlite3
+    $ python donation_store.py compact --days 30
+"""
+import argparse
+import json
+import os
+import sqlite3
+import sys
+import threading
+import time
+
+from event_ledger import DEFAULT_TTL
+from parse_cents import format_cents
+
+__all__ = ["DonationStore", "donation_host"]
+
+HOUR = 60 * 60
+# The bucket holding all-time totals
+ALL_TIME = -1
+# As long as event_ledger remembers an event, so a redelivered charge is
+# still recognized after compaction
+DEFAULT_RETENTION_DAYS = DEFAULT_TTL // (24 * HOUR)
+
+SCHEMA = """
+CREATE TABLE IF NOT EXISTS donation_events (
+    charge_id TEXT PRIMARY KEY,
+    host TEXT NOT NULL,
+    frequency TEXT NOT NULL,
+    amount INTEGER NOT NULL,
+    created INTEGER NOT NULL
+) WITHOUT ROWID;
+CREATE INDEX IF NOT EXISTS donation_events_created ON donation_events (created);
+CREATE TABLE IF NOT EXISTS donation_totals (
+    host TEXT NOT NULL,
+    bucket INTEGER NOT NULL,
+    frequency TEXT NOT NULL,
+    count INTEGER NOT NULL,
+    amount INTEGER NOT NULL,
+    PRIMARY KEY (host, bucket, frequency)
+) WITHOUT ROWID;
+"""
+
+
+def donation_host(metadata):
+    """The host a donation was made on, from its checkout metadata
+
+    >>> donation_host({'host': 'gala.missionbit.org'})
+    'gala.missionbit.org'
+    >>> donation_host({'origin': 'https://donate.missionbit.org'})
+    'donate.missionbit.org'
+    >>> donation_host({})
+    'unknown'
+    """
+    host = metadata.get("host")
+    if host:
+        return host
+    origin = metadata.get("origin", "")
+    return origin.partition("://")[2] or "unknown"
+
+
+class DonationStore:
+    """Donations and their running totals in SQLite
+
+    >>> store = DonationStore(':memory:')
+    >>> store.record('ch_1', 'gala.missionbit.org', 'one-time', 25000, 7200)
+    True
+    >>> store.record('ch_1', 'gala.missionbit.org', 'one-time', 25000, 7200)
+    False
+    >>> store.record('ch_2', 'gala.missionbit.org', 'monthly', 5000, 10800)
+    True
+    >>> store.record('ch_3', 'donate.missionbit.org', 'one-time', 5000, 10800)
+    True
+    >>> store.totals('gala.missionbit.org')
+    {'one-time': {'count': 1, 'amount': 25000}, 'monthly': {'count': 1, 'amount': 5000}}
+    >>> store.totals('gala.missionbit.org', since=10800)
+    {'monthly': {'count': 1, 'amount': 5000}}
+    >>> store.totals()['one-time']
+    {'count': 2, 'amount': 30000}
+    >>> store.compact(before=10000), store.stats()['events']
+    (1, 2)
+    >>> store.totals('gala.missionbit.org')['one-time']
+    {'count': 1, 'amount': 25000}
+    """
+
+    def __init__(self, path: str):
+        self.path = path
+        self._local = threading.local()
+        self._shared = None
+        self._lock = threading.Lock()
+        if path != ":memory:":
+            os.makedirs(os.path.dirname(os.path.abspath(path)), exist_ok=True)
+        self._connection().executescript(SCHEMA)
+
+    def _connection(self) -> sqlite3.Connection:
+        if self.path == ":memory:":
+            # Every connection to :memory: is a new database, share one
+            if self._shared is None:
+                self._shared = sqlite3.connect(
+                    self.path, isolation_level=None, check_same_thread=False
+                )
+            return self._shared
+        conn = getattr(self._local, "conn", None)
+        if conn is None or getattr(self._local, "pid", None) != os.getpid():
+            conn = sqlite3.connect(self.path, timeout=30, isolation_level=None)
+            conn.execute("PRAGMA journal_mode=WAL")
+            conn.execute("PRAGMA synchronous=NORMAL")
+            self._local.conn = conn
+            self._local.pid = os.getpid()
+        return conn
+
+    def record(
+        self, charge_id: str, host: str, frequency: str, amount: int, created: int
+    ) -> bool:
+        """Append a donation and add it to the totals, unless `charge_id` was
+        already recorded
+        """
+        conn = self._connection()
+        # The lock only matters for the connection shared by :memory:, other
+        # processes are serialized by BEGIN IMMEDIATE
+        with self._lock:
+            conn.execute("BEGIN IMMEDIATE")
+            try:
+                cursor = conn.execute(
+                    "INSERT OR IGNORE INTO donation_events"
+                    " (charge_id, host, frequency, amount, created)"
+                    " VALUES (?, ?, ?, ?, ?)",
+                    (charge_id, host, frequency, amount, created),
+                )
+                added = cursor.rowcount == 1
+                if added:
+                    for bucket in (ALL_TIME, created // HOUR):
+                        key = (host, bucket, frequency)
+                        conn.execute(
+                            "INSERT OR IGNORE INTO donation_totals"
+                            " (host, bucket, frequency, count, amount)"
+                            " VALUES (?, ?, ?, 0, 0)",
+                            key,
+                        )
+                        conn.execute(
+                            "UPDATE donation_totals"
+                            " SET count = count + 1, amount = amount + ?"
+                            " WHERE host = ? AND bucket = ? AND frequency = ?",
+                            (amount,) + key,
+                        )
+                conn.execute("COMMIT")
+            except BaseException:
+                conn.execute("ROLLBACK")
+                raise
+        return added
+
+    def totals(self, host: str = None, since: int = None) -> dict:
+        """{frequency: {"count", "amount"}} for `host` (or every host)
+
+        Without `since` this reads the all-time rows. With it, the hourly
+        rows from the hour containing `since` onwards.
+        """
+        where, params = [], []
+        if host is not None:
+            where.append("host = ?")
+            params.append(host)
+        if since is None:
+            where.append("bucket = ?")
+            params.append(ALL_TIME)
+        else:
+            where.append("bucket >= ?")
+            params.append(max(0, since // HOUR))
+        rows = self._connection().execute(
+            "SELECT frequency, SUM(count), SUM(amount) FROM donation_totals"
+            f" WHERE {' AND '.join(where)} GROUP BY frequency"
+            " ORDER BY frequency DESC",
+            params,
+        )
+        return {
+            frequency: {"count": count, "amount": amount}
+            for frequency, count, amount in rows
+        }
+
+    def hosts(self) -> list:
+        return [
+            host
+            for (host,) in self._connection().execute(
+                "SELECT DISTINCT host FROM donation_totals WHERE bucket = ?"
+                " ORDER BY host",
+                (ALL_TIME,),
+            )
+        ]
+
+    def compact(self, before: int) -> int:
+        """Delete donations created before `before`, returning how many
+
+        The totals are kept, and hourly totals are all that's left of them.
+        """
+        with self._lock:
+            cursor = self._connection().execute(
+                "DELETE FROM donation_events WHERE created < ?", (before,)
+            )
+        return cursor.rowcount
+
+    def snapshot(self, path: str) -> None:
+        """Write a consistent copy of the store to `path`"""
+        os.makedirs(os.path.dirname(os.path.abspath(path)), exist_ok=True)
+        target = sqlite3.connect(path)
+        try:
+            with self._lock:
+                self._connection().backup(target)
+        finally:
+            target.close()
+
+    def stats(self) -> dict:
+        conn = self._connection()
+        (events,) = conn.execute("SELECT COUNT(*) FROM donation_events").fetchone()
+        (rows,) = conn.execute("SELECT COUNT(*) FROM donation_totals").fetchone()
+        return {"events": events, "total_rows": rows, "hosts": len(self.hosts())}
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description=__doc__.split("\n", 1)[0])
+    parser.add_argument(
+        "--db",
+        default=os.environ.get(
+            "DONATION_STORE_PATH",
+            os.path.join(os.path.dirname(__file__), "instance", "donations.sqlite3"),
+        ),
+        help="donation store database, the app's DONATION_STORE_PATH"
+        " (default: instance/donations.sqlite3)",
+    )
+    commands = parser.add_subparsers(dest="command")
+    totals = commands.add_parser("totals", help="print totals as JSON")
+    totals.add_argument("--host", help="default: every host")
+    totals.add_argument("--since", type=int, help="unix time")
+    snapshot = commands.add_parser("snapshot", help="copy the store to a file")
+    snapshot.add_argument("path")
+    compact = commands.add_parser("compact", help="delete old donation rows")
+    compact.add_argument("--days", type=int, default=DEFAULT_RETENTION_DAYS)
+    args = parser.parse_args(argv)
+
+    store = DonationStore(args.db)
+    if args.command == "snapshot":
+        store.snapshot(args.path)
+    elif args.command == "compact":
+        removed = store.compact(int(time.time()) - args.days * 24 * HOUR)
+        print(f"removed {removed} donations", file=sys.stderr)
+    else:
+        host = getattr(args, "host", None)
+        rval = store.totals(host, getattr(args, "since", None))
+        rval["total"] = format_cents(sum(t["amount"] for t in rval.values()))
+        json.dump(rval, sys.stdout, indent=2)
+        print()
+    return 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
@@ -0,0 +1,220 @@
+"""Coalesce SendGrid template sends into multi-personalization requests
+
+"""
+import json
+import os
+import threading
+import time
+from concurrent.futures import Future
+
+from python_http_client.exceptions import BadRequestsError
+
+__all__ = ["EmailBatcher", "batch_key", "merge_messages"]
+
+# SendGrid accepts at most 1000 personalizations per v3 mail send request
+MAX_PERSONALIZATIONS = 1000
+
+
+def batch_key(message):
+    """Messages that only differ in personalizations can be sent together
+
+    >>> a = {'template_id': 'd-1', 'personalizations': [{'to': 'a'}]}
+    >>> b = {'template_id': 'd-1', 'personalizations': [{'to': 'b'}]}
+    >>> batch_key(a) == batch_key(b)
+    True
+    >>> batch_key(a) == batch_key(dict(a, template_id='d-2'))
+    False
+    """
+    return json.dumps(
+        {k: v for k, v in message.items() if k != "personalizations"},
+        sort_keys=True,
+    )
+
+
+def merge_messages(messages):
+    """
+    >>> merge_messages([
+    ...     {'template_id': 'd-1', 'personalizations': [{'to': 'a'}]},
+    ...     {'template_id': 'd-1', 'personalizations': [{'to': 'b'}]},
+    ... ])
+    {'template_id': 'd-1', 'personalizations': [{'to': 'a'}, {'to': 'b'}]}
+    """
+    rval = dict(messages[0])
+    rval["personalizations"] = [p for m in messages for p in m["personalizations"]]
+    return rval
+
+
+class Batch:
+    __slots__ = ("created", "size", "items")
+
+    def __init__(self):
+        self.created = time.monotonic()
+        self.size = 0
+        self.items = []
+
+
+class EmailBatcher:
+    """Queue messages and send them in batches from a background thread
+
+    A batch is flushed when it reaches `max_size` personalizations or when
+    its oldest message has waited `max_delay` seconds. Each submitted message
+    gets its own Future; if SendGrid rejects a merged request with a 400 the
+    batch is retried one message at a time so that only the failing donor's
+    event sees the error.
+
+    >>> from python_http_client.exceptions import BadRequestsError
+    >>> class FakeClient:
+    ...     sent = []
+    ...     def send(self, message):
+    ...         to = [p['to'] for p in message['personalizations']]
+    ...         self.sent.append(to)
+    ...         if 'bad' in to:
+    ...             raise BadRequestsError(400, 'Bad Request', b'', {})
+    ...         return 202
+    >>> client = FakeClient()
+    >>> batcher = EmailBatcher(client, max_delay=60)
+    >>> futures = [
+    ...     batcher.submit({'template_id': 'd-1', 'personalizations': [{'to': to}]})
+    ...     for to in ('a', 'bad', 'b')
+    ... ]
+    >>> batcher.flush()
+    >>> client.sent
+    [['a', 'bad', 'b'], ['a'], ['bad'], ['b']]
+    >>> [f.exception() is None for f in futures]
+    [True, False, True]
+    >>> batcher.stop()
+    """
+
+    def __init__(self, client, max_size=MAX_PERSONALIZATIONS, max_delay=0.5):
+        self.client = client
+        self.max_size = min(max_size, MAX_PERSONALIZATIONS)
+        self.max_delay = max_delay
+        self._cond = threading.Condition()
+        self._pending = {}
+        self._ready = []
+        self._pid = None
+        self._stopping = False
+        self._thread = None
+        self.counters = {
+            "messages": 0,
+            "requests": 0,
+            "split_batches": 0,
+            "failed_messages": 0,
+        }
+
+    def submit(self, message) -> Future:
+        future = Future()
+        size = len(message["personalizations"])
+        if size > self.max_size:
+            # Too big to share a request with anything else
+            self._send_batch([(message, future)])
+            return future
+        key = batch_key(message)
+        self._start()
+        with self._cond:
+            batch = self._pending.get(key)
+            if batch is not None and batch.size + size > self.max_size:
+                self._ready.append(self._pending.pop(key))
+                batch = None
+            if batch is None:
+                batch = self._pending[key] = Batch()
+            batch.items.append((message, future))
+            batch.size += size
+            self.counters["messages"] += 1
+            if batch.size >= self.max_size:
+                self._pending.pop(key)
+                self._ready.append(batch)
+            self._cond.notify()
+        return future
+
+    def _start(self):
+        if self._pid == os.getpid():
+            return
+        with self._cond:
+            if self._pid == os.getpid():
+                return
+            self._ready = []
+            self._pending = {}
+            self._stopping = False
+            self._thread = threading.Thread(
+                target=self._run, name="email-batcher", daemon=True
+            )
+            self._thread.start()
+            self._pid = os.getpid()
+
+    def _take_due(self, force=False):
+        now = time.monotonic()
+        due = self._ready
+        self._ready = []
+        for key, batch in list(self._pending.items()):
+            if force or now - batch.created >= self.max_delay:
+                due.append(self._pending.pop(key))
+        return due
+
+    def _next_deadline(self):
+        if not self._pending:
+            return None
+        oldest = min(b.created for b in self._pending.values())
+        return max(0.0, oldest + self.max_delay - time.monotonic())
+
+    def _run(self):
+        while True:
+            with self._cond:
+                due = self._take_due(force=self._stopping)
+                if not due:
+                    if self._stopping:
+                        return
+                    self._cond.wait(self._next_deadline())
+                    continue
+            for batch in due:
+                self._send_batch(batch.items)
+
+    def _send(self, message):
+        with self._cond:
+            self.counters["requests"] += 1
+        return self.client.send(message)
+
+    def _send_batch(self, items):
+        try:
+            response = self._send(merge_messages([m for m, _ in items]))
+        except BadRequestsError as e:
+            if len(items) == 1:
+                self._fail(items, e)
+                return
+            with self._cond:
+                self.counters["split_batches"] += 1
+            for item in items:
+                self._send_batch([item])
+            return
+        except Exception as e:
+            self._fail(items, e)
+            return
+        for _, future in items:
+            future.set_result(response)
+
+    def _fail(self, items, e):
+        with self._cond:
+            self.counters["failed_messages"] += len(items)
+        for _, future in items:
+            future.set_exception(e)
+
+    def flush(self) -> None:
+        """Send everything that is pending on the calling thread"""
+        with self._cond:
+            due = self._take_due(force=True)
+        for batch in due:
+            self._send_batch(batch.items)
+
+    def stop(self, timeout=None) -> None:
+        with self._cond:
+            self._stopping = True
+            self._cond.notify()
+        if self._thread is not None:
+            self._thread.join(timeout)
+        self._pid = None
+
+    def stats(self) -> dict:
+        with self._cond:
+            rval = dict(self.counters)
+            rval["pending"] = sum(b.size for b in self._pending.values())
+        return rval
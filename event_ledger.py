@@ -0,0 +1,176 @@
+"""Persistent ledger of Stripe event ids used to skip duplicate deliveries
+
+"""
+import os
+import sqlite3
+import threading
+import time
+
+from cache_backends import CacheError
+from caching import LRUCache
+
+__all__ = ["EventLedger"]
+
+SCHEMA = """
+CREATE TABLE IF NOT EXISTS webhook_events (
+    event_id TEXT PRIMARY KEY,
+    seen_at REAL NOT NULL
+) WITHOUT ROWID;
+CREATE INDEX IF NOT EXISTS webhook_events_seen_at ON webhook_events (seen_at);
+"""
+
+# Stripe retries a failed delivery for up to three days, but an event can
+# still be resent from the dashboard for 30 days after it was created
+DEFAULT_TTL = 30 * 24 * 60 * 60
+# How long an id seen by this process is trusted without asking the shared
+# backend or database, where a `discard` from another process shows up
+DEFAULT_FRONT_TTL = 5 * 60
+
+
+class EventLedger:
+    """Remembers event ids for `ttl` seconds
+
+    Ids seen in the last `front_ttl` seconds are answered from an in-memory
+    LRU without touching the database, everything else is a single primary
+    key insert. The
+    database is per machine, so instances behind a load balancer also claim
+    ids in a `shared` backend (see cache_backends) first. If it can't be
+    reached, the database alone decides.
+
+    >>> from cache_backends import MemoryBackend
+    >>> shared = MemoryBackend(100)
+    >>> ledger = EventLedger(':memory:', shared=shared)
+    >>> ledger.add('evt_1')
+    True
+    >>> ledger.add('evt_1')
+    False
+    >>> EventLedger(':memory:', shared=shared).add('evt_1')
+    False
+    >>> ledger.stats()['hits'], ledger.stats()['misses']
+    (1, 1)
+
+    An event whose handling was given up on is discarded, so that it can be
+    resent from the Stripe dashboard:
+
+    >>> ledger.discard('evt_1')
+    >>> ledger.add('evt_1')
+    True
+    """
+
+    def __init__(
+        self,
+        path: str,
+        ttl: float = DEFAULT_TTL,
+        front_size: int = 10000,
+        front_ttl: float = DEFAULT_FRONT_TTL,
+        compact_every: int = 1000,
+        shared=None,
+    ):
+        self.path = path
+        self.ttl = ttl
+        self.compact_every = compact_every
+        self.front = LRUCache(front_size)
+        self.front_ttl = front_ttl
+        self.shared = shared
+        self._local = threading.local()
+        self._lock = threading.Lock()
+        self._shared = None
+        self._since_compact = 0
+        self.counters = {
+            "front_hits": 0,
+            "shared_hits": 0,
+            "store_hits": 0,
+            "misses": 0,
+            "shared_errors": 0,
+        }
+        if path != ":memory:":
+            os.makedirs(os.path.dirname(os.path.abspath(path)), exist_ok=True)
+        self._connection().executescript(SCHEMA)
+
+    def _connection(self) -> sqlite3.Connection:
+        if self.path == ":memory:":
+            # Every connection to :memory: is a new database, share one
+            if self._shared is None:
+                self._shared = sqlite3.connect(
+                    self.path, isolation_level=None, check_same_thread=False
+                )
+            return self._shared
+        conn = getattr(self._local, "conn", None)
+        if conn is None or getattr(self._local, "pid", None) != os.getpid():
+            conn = sqlite3.connect(self.path, timeout=30, isolation_level=None)
+            conn.execute("PRAGMA journal_mode=WAL")
+            conn.execute("PRAGMA synchronous=NORMAL")
+            self._local.conn = conn
+            self._local.pid = os.getpid()
+        return conn
+
+    def _count(self, name):
+        with self._lock:
+            self.counters[name] += 1
+
+    def add(self, event_id: str) -> bool:
+        """Record `event_id`, returning False if it was already seen"""
+        now = time.time()
+        seen_at = self.front.get(event_id)
+        if seen_at is not None and now - seen_at < self.front_ttl:
+            self._count("front_hits")
+            return False
+        if self.shared is not None:
+            try:
+                claimed = self.shared.add(f"event:{event_id}", b"1", self.ttl)
+            except CacheError:
+                self._count("shared_errors")
+            else:
+                if not claimed:
+                    self.front.set(event_id, now)
+                    self._count("shared_hits")
+                    return False
+        cursor = self._connection().execute(
+            "INSERT OR IGNORE INTO webhook_events (event_id, seen_at) VALUES (?, ?)",
+            (event_id, now),
+        )
+        self.front.set(event_id, now)
+        if cursor.rowcount == 0:
+            self._count("store_hits")
+            return False
+        self._count("misses")
+        self._maybe_compact(now)
+        return True
+
+    def discard(self, event_id: str) -> None:
+        """Forget `event_id` so that a redelivery will be processed"""
+        self.front.pop(event_id)
+        if self.shared is not None:
+            try:
+                self.shared.delete(f"event:{event_id}")
+            except CacheError:
+                self._count("shared_errors")
+        self._connection().execute(
+            "DELETE FROM webhook_events WHERE event_id = ?", (event_id,)
+        )
+
+    def _maybe_compact(self, now):
+        with self._lock:
+            self._since_compact += 1
+            if self._since_compact < self.compact_every:
+                return
+            self._since_compact = 0
+        self.compact(now)
+
+    def compact(self, now=None) -> int:
+        """Delete ids older than the TTL, returning how many were removed"""
+        if now is None:
+            now = time.time()
+        cursor = self._connection().execute(
+            "DELETE FROM webhook_events WHERE seen_at < ?", (now - self.ttl,)
+        )
+        return cursor.rowcount
+
+    def stats(self) -> dict:
+        with self._lock:
+            counters = dict(self.counters)
+        counters["hits"] = (
+            counters["front_hits"] + counters["shared_hits"] + counters["store_hits"]
+        )
+        counters["front_size"] = len(self.front)
+        return counters
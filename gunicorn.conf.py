@@ -0,0 +1,49 @@
+"""Production settings for `gunicorn application:app`
+
+gunicorn reads this file from the working directory. The app is imported and
+warmed up once in the master, then forked into `WEB_CONCURRENCY` workers that
+share those pages copy-on-write. Requests mostly wait on Stripe and SendGrid,
+so each worker serves them from a pool of `GUNICORN_THREADS` threads.
+
+On a graceful reload (`kill -HUP <master pid>`) or shutdown, old workers stop
+accepting connections, finish their requests and, before exiting, let
+in-flight webhook jobs finish and send pending receipts and telemetry.
+"""
+import gc
+import multiprocessing
+import os
+
+bind = f"0.0.0.0:{os.environ.get('PORT', '8000')}"
+workers = int(os.environ.get("WEB_CONCURRENCY", multiprocessing.cpu_count() * 2 + 1))
+worker_class = "gthread"
+threads = int(os.environ.get("GUNICORN_THREADS", "8"))
+preload_app = True
+# Seconds a worker may go without a heartbeat, and to drain on reload
+timeout = int(os.environ.get("GUNICORN_TIMEOUT", "120"))
+graceful_timeout = int(os.environ.get("GRACEFUL_TIMEOUT", "30"))
+# The App Service front end keeps connections to the app open
+keepalive = 75
+accesslog = "-"
+forwarded_allow_ips = "*"
+
+
+def when_ready(server):
+    import application
+
+    application.warm_up()
+    # Objects that exist now are never collected, so collections in the
+    # workers don't touch (and un-share) the pages they live in
+    gc.freeze()
+
+
+def post_worker_init(worker):
+    import application
+
+    # Pick up queued webhooks right away instead of on the first request
+    application.start_webhook_workers()
+
+
+def worker_exit(server, worker):
+    import application
+
+    application.shutdown(timeout=graceful_timeout)
@@ -0,0 +1,578 @@
+"""Keep-alive HTTP connection pooling shared by the Stripe and SendGrid clients
+
+"""
+import asyncio
+import functools
+import http.client
+import select
+import ssl
+import threading
+from collections import deque
+from contextlib import contextmanager
+from urllib.parse import urlsplit
+
+import python_http_client
+import sendgrid
+import stripe
+from python_http_client.exceptions import HTTPError, ServiceUnavailableError, err_dict
+
+from instrumentation import route_template
+from resilience import BudgetExhausted, budgeted_timeout
+
+__all__ = [
+    "AsyncConnectionPool",
+    "ConnectionPool",
+    "PooledResponse",
+    "PooledStripeClient",
+    "PooledSendGridAPIClient",
+    "CircuitOpen",
+    "StripeBusy",
+    "check_breaker",
+    "record_outcome",
+    "upstream_span",
+]
+
+# Errors that mean an idle keep-alive connection was closed by the server
+STALE_CONNECTION_ERRORS = (
+    http.client.RemoteDisconnected,
+    http.client.CannotSendRequest,
+    BrokenPipeError,
+    ConnectionResetError,
+)
+# Requests that can be sent again when a reused connection drops before the
+# response, even though the server may have processed the first one
+IDEMPOTENT_METHODS = frozenset(["GET", "HEAD", "OPTIONS", "PUT", "DELETE"])
+
+
+def can_resend(method, headers):
+    """Whether a request whose response was lost is safe to send again
+
+    stripe-python sends an Idempotency-Key with every POST, SendGrid doesn't.
+
+    >>> can_resend("get", {}), can_resend("POST", {})
+    (True, False)
+    >>> can_resend("POST", {"Idempotency-Key": "3f1c"})
+    True
+    """
+    return method.upper() in IDEMPOTENT_METHODS or any(
+        name.lower() == "idempotency-key" for name in (headers or {})
+    )
+
+
+def connection_dropped(conn) -> bool:
+    """Whether the server closed an idle connection, which it shouldn't be
+    sending anything on
+    """
+    if conn.sock is None:
+        return True
+    try:
+        return bool(select.select([conn.sock], [], [], 0)[0])
+    except (OSError, ValueError):
+        return True
+
+
+class PooledResponse:
+    """A fully read HTTP response"""
+
+    __slots__ = ("status", "reason", "headers", "body")
+
+    def __init__(self, status, reason, headers, body):
+        self.status = status
+        self.reason = reason
+        self.headers = headers
+        self.body = body
+
+    # The interface expected by python_http_client.Response
+    def getcode(self):
+        return self.status
+
+    def read(self):
+        return self.body
+
+    def info(self):
+        return self.headers
+
+
+@functools.lru_cache(maxsize=None)
+def default_ssl_context():
+    """Shared by all pools, and created on the first https connection since
+    loading the CA certificates takes tens of milliseconds
+    """
+    return ssl.create_default_context()
+
+
+class HostStats:
+    __slots__ = ("requests", "created", "reused", "errors")
+
+    def __init__(self):
+        self.requests = 0
+        self.created = 0
+        self.reused = 0
+        self.errors = 0
+
+
+class ConnectionPool:
+    """Reuses up to `maxsize` idle keep-alive connections per origin
+
+    >>> import threading
+    >>> from http.server import ThreadingHTTPServer, BaseHTTPRequestHandler
+    >>> class Handler(BaseHTTPRequestHandler):
+    ...     protocol_version = "HTTP/1.1"
+    ...     def do_GET(self):
+    ...         self.send_response(200)
+    ...         self.send_header("Content-Length", "2")
+    ...         self.end_headers()
+    ...         self.wfile.write(b"ok")
+    ...     def log_message(self, *args):
+    ...         pass
+    >>> server = ThreadingHTTPServer(("127.0.0.1", 0), Handler)
+    >>> threading.Thread(target=server.serve_forever, daemon=True).start()
+    >>> origin = "http://127.0.0.1:{}".format(server.server_port)
+    >>> pool = ConnectionPool()
+    >>> [pool.request("GET", origin + "/").body for _ in range(3)]
+    [b'ok', b'ok', b'ok']
+    >>> stats = pool.stats()[origin]
+    >>> stats["created"], stats["reused"], stats["idle"]
+    (1, 2, 1)
+    >>> pool.close()
+    >>> server.shutdown()
+    >>> server.server_close()
+    """
+
+    def __init__(self, maxsize: int = 10, timeout: float = 30.0):
+        self.maxsize = maxsize
+        self.timeout = timeout
+        self._lock = threading.Lock()
+        self._idle = {}
+        self._stats = {}
+
+    def _origin(self, parts):
+        return f"{parts.scheme}://{parts.netloc}"
+
+    def _new_connection(self, parts, timeout):
+        if parts.scheme == "https":
+            return http.client.HTTPSConnection(
+                parts.hostname,
+                parts.port,
+                timeout=timeout,
+                context=default_ssl_context(),
+            )
+        return http.client.HTTPConnection(parts.hostname, parts.port, timeout=timeout)
+
+    def _checkout(self, origin, parts, timeout):
+        with self._lock:
+            stats = self._stats.get(origin)
+            if stats is None:
+                stats = self._stats[origin] = HostStats()
+            stats.requests += 1
+            idle = self._idle.get(origin)
+            while idle:
+                conn = idle.pop()
+                if connection_dropped(conn):
+                    conn.close()
+                    continue
+                stats.reused += 1
+                conn.timeout = timeout
+                if conn.sock is not None:
+                    conn.sock.settimeout(timeout)
+                return conn, True
+            stats.created += 1
+        return self._new_connection(parts, timeout), False
+
+    def _checkin(self, origin, conn):
+        with self._lock:
+            idle = self._idle.setdefault(origin, deque())
+            if len(idle) < self.maxsize:
+                idle.append(conn)
+                return
+        conn.close()
+
+    def _error(self, origin):
+        with self._lock:
+            self._stats[origin].errors += 1
+
+    def request(self, method, url, body=None, headers=None, timeout=None):
+        """Perform a request and read the whole response body"""
+        parts = urlsplit(url)
+        origin = self._origin(parts)
+        path = parts.path or "/"
+        if parts.query:
+            path = f"{path}?{parts.query}"
+        timeout = self.timeout if timeout is None else timeout
+        resend = can_resend(method, headers)
+        while True:
+            conn, reused = self._checkout(origin, parts, timeout)
+            sent = False
+            try:
+                conn.request(method.upper(), path, body=body, headers=headers or {})
+                sent = True
+                response = conn.getresponse()
+                data = response.read()
+            except STALE_CONNECTION_ERRORS:
+                conn.close()
+                if reused and (resend or not sent):
+                    # The server closed an idle connection, try a fresh one
+                    continue
+                self._error(origin)
+                raise
+            except BaseException:
+                conn.close()
+                self._error(origin)
+                raise
+            if response.will_close:
+                conn.close()
+            else:
+                self._checkin(origin, conn)
+            return PooledResponse(response.status, response.reason, response.msg, data)
+
+    def stats(self) -> dict:
+        with self._lock:
+            return {
+                origin: {
+                    "requests": s.requests,
+                    "created": s.created,
+                    "reused": s.reused,
+                    "errors": s.errors,
+                    "idle": len(self._idle.get(origin, ())),
+                }
+                for origin, s in self._stats.items()
+            }
+
+    def close(self) -> None:
+        with self._lock:
+            idle, self._idle = self._idle, {}
+        for conns in idle.values():
+            for conn in conns:
+                conn.close()
+
+
+async def read_response(reader):
+    """Read an HTTP/1.1 response, returning (PooledResponse, keep_alive)"""
+    status_line = await reader.readline()
+    if not status_line:
+        raise http.client.RemoteDisconnected("Remote end closed connection")
+    version, status, reason = (
+        status_line.decode("latin-1").rstrip("\r\n") + " "
+    ).split(" ", 2)
+    headers = http.client.HTTPMessage()
+    while True:
+        line = await reader.readline()
+        if line in (b"\r\n", b"\n", b""):
+            break
+        name, _, value = line.decode("latin-1").partition(":")
+        headers[name.strip()] = value.strip()
+    keep_alive = (
+        version == "HTTP/1.1" and headers.get("Connection", "").lower() != "close"
+    )
+    if headers.get("Transfer-Encoding", "").lower() == "chunked":
+        chunks = []
+        while True:
+            size = int((await reader.readline()).split(b";", 1)[0], 16)
+            if size == 0:
+                await reader.readline()
+                break
+            chunks.append(await reader.readexactly(size))
+            await reader.readexactly(2)
+        body = b"".join(chunks)
+    elif "Content-Length" in headers:
+        body = await reader.readexactly(int(headers["Content-Length"]))
+    else:
+        body = await reader.read()
+        keep_alive = False
+    return PooledResponse(int(status), reason.strip(), headers, body), keep_alive
+
+
+class AsyncConnectionPool:
+    """asyncio counterpart of `ConnectionPool` for use on an event loop
+
+    Requests never block the loop, so one process can hold as many in-flight
+    requests as the remote end (and `asyncio.Semaphore` limits) allow.
+    """
+
+    def __init__(self, maxsize: int = 100, timeout: float = 30.0):
+        self.maxsize = maxsize
+        self.timeout = timeout
+        self._idle = {}
+        self._stats = {}
+
+    async def _checkout(self, origin, parts):
+        stats = self._stats.get(origin)
+        if stats is None:
+            stats = self._stats[origin] = HostStats()
+        stats.requests += 1
+        idle = self._idle.get(origin)
+        while idle:
+            reader, writer = idle.pop()
+            if not reader.at_eof() and not writer.is_closing():
+                stats.reused += 1
+                return reader, writer, True
+            writer.close()
+        stats.created += 1
+        port = parts.port or (443 if parts.scheme == "https" else 80)
+        reader, writer = await asyncio.open_connection(
+            parts.hostname,
+            port,
+            ssl=default_ssl_context() if parts.scheme == "https" else None,
+        )
+        return reader, writer, False
+
+    def _checkin(self, origin, reader, writer):
+        idle = self._idle.setdefault(origin, deque())
+        if len(idle) < self.maxsize:
+            idle.append((reader, writer))
+        else:
+            writer.close()
+
+    async def _exchange(self, origin, parts, data, resend):
+        while True:
+            reader, writer, reused = await self._checkout(origin, parts)
+            sent = False
+            try:
+                writer.write(data)
+                await writer.drain()
+                sent = True
+                response, keep_alive = await read_response(reader)
+            except (
+                asyncio.IncompleteReadError,
+                http.client.RemoteDisconnected,
+                ConnectionResetError,
+                BrokenPipeError,
+            ):
+                writer.close()
+                # Once sent, only resend what is safe to process twice
+                if reused and (resend or not sent):
+                    continue
+                raise
+            except BaseException:
+                writer.close()
+                raise
+            if keep_alive:
+                self._checkin(origin, reader, writer)
+            else:
+                writer.close()
+            return response
+
+    async def request(self, method, url, body=None, headers=None, timeout=None):
+        """Perform a request and read the whole response body"""
+        parts = urlsplit(url)
+        origin = f"{parts.scheme}://{parts.netloc}"
+        path = parts.path or "/"
+        if parts.query:
+            path = f"{path}?{parts.query}"
+        if isinstance(body, str):
+            body = body.encode("utf-8")
+        lines = [f"{method.upper()} {path} HTTP/1.1", f"Host: {parts.netloc}"]
+        for k, v in (headers or {}).items():
+            lines.append(f"{k}: {v}")
+        lines.append(f"Content-Length: {len(body or b'')}")
+        data = ("\r\n".join(lines) + "\r\n\r\n").encode("latin-1") + (body or b"")
+        try:
+            return await asyncio.wait_for(
+                self._exchange(origin, parts, data, can_resend(method, headers)),
+                self.timeout if timeout is None else timeout,
+            )
+        except BaseException:
+            self._stats[origin].errors += 1
+            raise
+
+    def stats(self) -> dict:
+        return {
+            origin: {
+                "requests": s.requests,
+                "created": s.created,
+                "reused": s.reused,
+                "errors": s.errors,
+                "idle": len(self._idle.get(origin, ())),
+            }
+            for origin, s in self._stats.items()
+        }
+
+    def close(self) -> None:
+        idle, self._idle = self._idle, {}
+        for conns in idle.values():
+            for _, writer in conns:
+                writer.close()
+
+
+@contextmanager
+def upstream_span(metrics, upstream, method, url):
+    """Time a request as an `upstream` span of `metrics`, if one was given"""
+    if metrics is None:
+        yield
+        return
+    path = route_template(urlsplit(url).path)
+    with metrics.span(upstream, method=method.upper(), path=path):
+        yield
+
+
+def stripe_connection_error(message, should_retry):
+    err = stripe.error.APIConnectionError(message)
+    err.should_retry = should_retry
+    return err
+
+
+def check_breaker(breaker, upstream):
+    """Raise `CircuitOpen` unless `breaker` (if any) lets a call through"""
+    if breaker is not None and not breaker.allow():
+        raise CircuitOpen(f"{upstream} circuit breaker is open")
+
+
+def record_outcome(breaker, status):
+    """Server errors count against the breaker, anything else closes it"""
+    if breaker is not None:
+        breaker.record(ok=status < 500)
+
+
+class CircuitOpen(ConnectionError):
+    pass
+
+
+class StripeBusy(stripe.error.APIConnectionError):
+    """Too many Stripe calls are already in flight from this process"""
+
+    should_retry = False
+
+
+class PooledStripeClient(stripe.http_client.HTTPClient):
+    """A stripe-python HTTP client backed by a `ConnectionPool`
+
+    Timeouts are capped by the calling thread's request budget, and calls
+    fail fast with APIConnectionError while `breaker` is open. With a
+    `limit` (an admission.ConcurrencyLimit), a call that can't start within
+    `limit_wait` seconds raises StripeBusy.
+    """
+
+    name = "http_pool"
+
+    def __init__(
+        self,
+        pool: ConnectionPool,
+        timeout=None,
+        metrics=None,
+        breaker=None,
+        limit=None,
+        limit_wait=0.0,
+        **kw,
+    ):
+        super().__init__(**kw)
+        self.pool = pool
+        self.timeout = timeout
+        self.metrics = metrics
+        self.breaker = breaker
+        self.limit = limit
+        self.limit_wait = limit_wait
+
+    def request(self, method, url, headers, post_data=None):
+        if isinstance(post_data, str):
+            post_data = post_data.encode("utf-8")
+        try:
+            wait = budgeted_timeout(self.limit_wait)
+        except BudgetExhausted as e:
+            raise stripe_connection_error(f"Stripe is unavailable ({e})", False)
+        if self.limit is not None and not self.limit.acquire(wait):
+            raise StripeBusy("Too many Stripe requests in flight, try again shortly")
+        try:
+            return self._request(method, url, headers, post_data)
+        finally:
+            if self.limit is not None:
+                self.limit.release()
+
+    def _request(self, method, url, headers, post_data):
+        try:
+            timeout = budgeted_timeout(self.timeout)
+            check_breaker(self.breaker, "Stripe")
+        except (BudgetExhausted, CircuitOpen) as e:
+            raise stripe_connection_error(f"Stripe is unavailable ({e})", False)
+        try:
+            with upstream_span(self.metrics, "stripe", method, url):
+                response = self.pool.request(
+                    method, url, body=post_data, headers=headers, timeout=timeout
+                )
+        except (OSError, http.client.HTTPException) as e:
+            record_outcome(self.breaker, 599)
+            raise stripe_connection_error(
+                f"Unexpected error communicating with Stripe. (Network error: {e!r})",
+                True,
+            )
+        except BaseException:
+            record_outcome(self.breaker, 599)
+            raise
+        record_outcome(self.breaker, response.status)
+        lh = {k.lower(): v for k, v in response.headers.items()}
+        return response.body, response.status, lh
+
+    def close(self):
+        pass
+
+
+class PooledHTTPClient(python_http_client.Client):
+    """python_http_client.Client that sends requests through a `ConnectionPool`"""
+
+    def __init__(self, *args, pool: ConnectionPool, metrics=None, breaker=None, **kw):
+        super().__init__(*args, **kw)
+        self.pool = pool
+        self.metrics = metrics
+        self.breaker = breaker
+
+    def _build_client(self, name=None):
+        url_path = self._url_path + [name] if name else self._url_path
+        return PooledHTTPClient(
+            host=self.host,
+            version=self._version,
+            request_headers=self.request_headers,
+            url_path=url_path,
+            append_slash=self.append_slash,
+            timeout=self.timeout,
+            pool=self.pool,
+            metrics=self.metrics,
+            breaker=self.breaker,
+        )
+
+    def _make_request(self, opener, request, timeout=None):
+        method, url = request.get_method(), request.get_full_url()
+        timeout = budgeted_timeout(timeout or self.timeout)
+        try:
+            check_breaker(self.breaker, "SendGrid")
+        except CircuitOpen as e:
+            raise ServiceUnavailableError(503, str(e), b"", {})
+        try:
+            with upstream_span(self.metrics, "sendgrid", method, url):
+                response = self.pool.request(
+                    method,
+                    url,
+                    body=request.data,
+                    headers=dict(request.header_items()),
+                    timeout=timeout,
+                )
+        except BaseException:
+            record_outcome(self.breaker, 599)
+            raise
+        record_outcome(self.breaker, response.status)
+        if response.status >= 400:
+            args = (response.status, response.reason, response.body, response.headers)
+            raise err_dict.get(response.status, HTTPError)(*args)
+        return response
+
+
+class PooledSendGridAPIClient(sendgrid.SendGridAPIClient):
+    """A SendGridAPIClient that can be shared across requests and threads"""
+
+    def __init__(
+        self,
+        api_key,
+        pool: ConnectionPool,
+        timeout=None,
+        metrics=None,
+        breaker=None,
+        **kw,
+    ):
+        super().__init__(api_key, **kw)
+        self.client = PooledHTTPClient(
+            host=self.host,
+            request_headers=self._default_headers,
+            version=3,
+            timeout=timeout,
+            pool=pool,
+            metrics=metrics,
+            breaker=breaker,
+        )
@@ -0,0 +1,271 @@
+"""Low-overhead latency histograms with Prometheus text export
+
+Spans are timed with `Metrics.span(name, **labels)` and recorded into fixed
+bucket histograms, so recording is a bisect and a few increments under a
+lock. Percentiles are estimated from the buckets.
+"""
+import bisect
+import os
+import threading
+import time
+from contextlib import contextmanager
+
+__all__ = ["Histogram", "Metrics", "BUCKETS", "route_template"]
+
+# Upper bounds in seconds, roughly 1-2.5-5 steps from 1ms to 60s
+BUCKETS = (
+    0.001,
+    0.0025,
+    0.005,
+    0.01,
+    0.025,
+    0.05,
+    0.1,
+    0.25,
+    0.5,
+    1.0,
+    2.5,
+    5.0,
+    10.0,
+    30.0,
+    60.0,
+)
+QUANTILES = (0.5, 0.95, 0.99)
+
+
+class Histogram:
+    """
+    >>> h = Histogram()
+    >>> for ms in (1, 2, 3, 4, 40, 400):
+    ...     h.observe(ms / 1000)
+    >>> h.count
+    6
+    >>> round(1000 * h.quantile(0.5), 2)
+    3.75
+    >>> h.quantile(0.99) <= 0.5
+    True
+    """
+
+    __slots__ = (
+        "bounds",
+        "counts",
+        "count",
+        "sum",
+        "window_count",
+        "window_sum",
+        "window_min",
+        "window_max",
+    )
+
+    def __init__(self, bounds=BUCKETS):
+        self.bounds = bounds
+        # The last bucket is +Inf
+        self.counts = [0] * (len(bounds) + 1)
+        self.count = 0
+        self.sum = 0.0
+        self.reset_window()
+
+    def reset_window(self):
+        self.window_count = 0
+        self.window_sum = 0.0
+        self.window_min = None
+        self.window_max = None
+
+    def observe(self, seconds: float) -> None:
+        self.counts[bisect.bisect_left(self.bounds, seconds)] += 1
+        self.count += 1
+        self.sum += seconds
+        self.window_count += 1
+        self.window_sum += seconds
+        if self.window_min is None or seconds < self.window_min:
+            self.window_min = seconds
+        if self.window_max is None or seconds > self.window_max:
+            self.window_max = seconds
+
+    def quantile(self, q: float) -> float:
+        """Estimate a quantile by interpolating inside its bucket"""
+        if not self.count:
+            return 0.0
+        rank = q * self.count
+        seen = 0
+        for i, n in enumerate(self.counts):
+            if n and seen + n >= rank:
+                lower = self.bounds[i - 1] if i > 0 else 0.0
+                if i == len(self.bounds):
+                    return lower
+                return lower + (self.bounds[i] - lower) * (rank - seen) / n
+            seen += n
+        return self.bounds[-1]
+
+
+def format_labels(labels):
+    r"""
+    >>> print(format_labels((("span", "stripe"), ("path", '/v1/"x"'))))
+    {span="stripe",path="/v1/\"x\""}
+    >>> format_labels(())
+    ''
+    """
+    if not labels:
+        return ""
+    escaped = (
+        (k, str(v).replace("\\", "\\\\").replace('"', '\\"').replace("\n", "\\n"))
+        for k, v in labels
+    )
+    return "{" + ",".join(f'{k}="{v}"' for k, v in escaped) + "}"
+
+
+def route_template(path):
+    """Replace object ids in an API path so it can be used as a label
+
+    >>> route_template("/v1/subscriptions/sub_1GfXq2ABC")
+    '/v1/subscriptions/{id}'
+    >>> route_template("/v1/payment_intents/pi_123?expand[]=invoice")
+    '/v1/payment_intents/{id}'
+    >>> route_template("/v3/mail/send")
+    '/v3/mail/send'
+    """
+    segments = path.split("?", 1)[0].split("/")
+    for i, segment in enumerate(segments):
+        if i > 1 and "_" in segment and any(c.isdigit() for c in segment):
+            segments[i] = "{id}"
+    return "/".join(segments)
+
+
+class Metrics:
+    """A registry of histograms keyed by span name and labels
+
+    >>> metrics = Metrics()
+    >>> with metrics.span("jinja", template="index.html"):
+    ...     pass
+    >>> text = metrics.prometheus(gauges=[("webhook_jobs", {"state": "ready"}, 3)])
+    >>> 'mb_span_seconds_count{span="jinja",template="index.html"} 1' in text
+    True
+    >>> text.rstrip().splitlines()[-1]
+    'mb_webhook_jobs{state="ready"} 3'
+    """
+
+    def __init__(self, prefix="mb"):
+        self.prefix = prefix
+        self._lock = threading.Lock()
+        self._histograms = {}
+        self._forwarder_pid = None
+
+    def observe(self, name: str, seconds: float, **labels) -> None:
+        key = (name, tuple(sorted(labels.items())))
+        with self._lock:
+            h = self._histograms.get(key)
+            if h is None:
+                h = self._histograms[key] = Histogram()
+            h.observe(seconds)
+
+    @contextmanager
+    def span(self, name: str, **labels):
+        start = time.perf_counter()
+        try:
+            yield
+        finally:
+            self.observe(name, time.perf_counter() - start, **labels)
+
+    def summary(self) -> dict:
+        """p50/p95/p99 in milliseconds for every span, e.g. for JSON stats"""
+        rval = {}
+        with self._lock:
+            for (name, labels), h in sorted(self._histograms.items()):
+                key = name + format_labels(labels)
+                rval[key] = {"count": h.count}
+                for q in QUANTILES:
+                    rval[key][f"p{int(q * 100)}_ms"] = 1000 * h.quantile(q)
+        return rval
+
+    def prometheus(self, gauges=()) -> str:
+        """Render every histogram (plus extra (name, labels, value) gauges)"""
+        family = f"{self.prefix}_span_seconds"
+        lines = [
+            f"# HELP {family} Latency of timed spans",
+            f"# TYPE {family} histogram",
+        ]
+        quantile_lines = []
+        with self._lock:
+            for (name, labels), h in sorted(self._histograms.items()):
+                base = (("span", name),) + labels
+                cumulative = 0
+                for bound, n in zip(h.bounds + (float("inf"),), h.counts):
+                    cumulative += n
+                    le = "+Inf" if bound == float("inf") else repr(bound)
+                    lines.append(
+                        f"{family}_bucket{format_labels(base + (('le', le),))} {cumulative}"
+                    )
+                lines.append(f"{family}_sum{format_labels(base)} {h.sum!r}")
+                lines.append(f"{family}_count{format_labels(base)} {h.count}")
+                for q in QUANTILES:
+                    quantile_lines.append(
+                        f"{family}_quantile"
+                        f"{format_labels(base + (('quantile', str(q)),))} "
+                        f"{h.quantile(q)!r}"
+                    )
+        lines.append(f"# HELP {family}_quantile Estimated span latency quantiles")
+        lines.append(f"# TYPE {family}_quantile gauge")
+        lines.extend(quantile_lines)
+        seen = set()
+        for name, labels, value in gauges:
+            metric = f"{self.prefix}_{name}"
+            if metric not in seen:
+                lines.append(f"# TYPE {metric} gauge")
+                seen.add(metric)
+            lines.append(f"{metric}{format_labels(tuple(labels.items()))} {value}")
+        return "\n".join(lines) + "\n"
+
+    def forward(self, client) -> None:
+        """Send per-span aggregates since the last call to Application Insights"""
+        with self._lock:
+            windows = []
+            for (name, labels), h in self._histograms.items():
+                if h.window_count:
+                    windows.append(
+                        (
+                            name,
+                            dict(labels),
+                            h.window_sum / h.window_count,
+                            h.window_count,
+                            h.window_min,
+                            h.window_max,
+                            {f"p{int(q * 100)}": h.quantile(q) for q in QUANTILES},
+                        )
+                    )
+                    h.reset_window()
+        for name, labels, mean, count, lo, hi, quantiles in windows:
+            properties = {k: str(v) for k, v in labels.items()}
+            properties.update({k: f"{v:.6f}" for k, v in quantiles.items()})
+            client.track_metric(
+                f"{name}_seconds",
+                mean,
+                count=count,
+                min=lo,
+                max=hi,
+                properties=properties,
+            )
+
+    def start_forwarding(self, get_client, interval: float = 60.0, logger=None) -> None:
+        """Forward to `get_client()` every `interval` seconds (once per process)
+
+        A failed forward is logged and retried on the next tick.
+        """
+        if self._forwarder_pid == os.getpid():
+            return
+        self._forwarder_pid = os.getpid()
+
+        def run():
+            while True:
+                time.sleep(interval)
+                try:
+                    client = get_client()
+                    if client is not None:
+                        self.forward(client)
+                except Exception as e:
+                    msg = f"forwarding metrics failed: {e!r}"
+                    if logger is not None:
+                        logger.warning(msg)
+                    else:
+                        print(msg)
+
+        threading.Thread(target=run, name="metrics-forwarder", daemon=True).start()
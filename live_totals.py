@@ -0,0 +1,278 @@
+"""Pushes donation totals to server-sent event streams
+
+`publish(host)` is called from the webhook threads after a donation is
+recorded. It only marks the host as changed on the event loop that serves
+the streams. The loop waits `coalesce` seconds for more donations, reads
+the totals once per changed host and hands the same encoded event to every
+subscriber of that host. Each subscriber holds at most one undelivered
+event, so a client that reads slower than totals change skips to the
+latest totals instead of buffering them. Hosts with subscribers are also
+re-read every `poll_interval` seconds, to pick up donations recorded by
+other processes. Totals are read on the loop's default executor, so a slow
+or locked database doesn't hold up the streams, and a read that fails is
+logged and tried again with the next change or poll.
+"""
+import asyncio
+import json
+import threading
+import time
+
+__all__ = ["LiveTotals", "Subscriber", "encode_event"]
+
+
+def encode_event(obj, event="totals"):
+    """A server-sent event carrying `obj` as JSON
+
+    >>> encode_event({'count': 1})
+    b'event: totals\\ndata: {"count": 1}\\n\\n'
+    """
+    data = json.dumps(obj, sort_keys=True)
+    return f"event: {event}\ndata: {data}\n\n".encode("utf-8")
+
+
+class Subscriber:
+    """One stream's undelivered event, replaced by newer ones"""
+
+    __slots__ = ("host", "pending", "published_at", "closed", "_waiter")
+
+    def __init__(self, host):
+        self.host = host
+        self.pending = None
+        self.published_at = None
+        self.closed = False
+        self._waiter = None
+
+    def _wake(self):
+        if self._waiter is not None and not self._waiter.done():
+            self._waiter.set_result(None)
+
+    def offer(self, message: bytes, published_at=None) -> None:
+        if self.pending is None:
+            # Latency is measured from the oldest donation not yet delivered
+            self.published_at = published_at
+        self.pending = message
+        self._wake()
+
+    def close(self) -> None:
+        self.closed = True
+        self._wake()
+
+    async def get(self, timeout: float):
+        """(event, published_at), or None after `timeout` seconds or once
+        closed
+        """
+        if self.pending is None and not self.closed:
+            # A bare future and timer rather than wait_for, which would
+            # start a task per wait on every stream
+            loop = asyncio.get_event_loop()
+            self._waiter = loop.create_future()
+            timer = loop.call_later(timeout, self._wake)
+            try:
+                await self._waiter
+            finally:
+                timer.cancel()
+                self._waiter = None
+        if self.closed or self.pending is None:
+            return None
+        rval = (self.pending, self.published_at)
+        self.pending = self.published_at = None
+        return rval
+
+
+class LiveTotals:
+    """Fans out changes to `totals(host)` to subscribers of each host
+
+    >>> totals = {'gala': 0}
+    >>> live = LiveTotals(lambda host: {'amount': totals[host]}, coalesce=0)
+    >>> async def demo():
+    ...     subscriber = live.subscribe('gala')
+    ...     first = await subscriber.get(1)
+    ...     totals['gala'] = 2500
+    ...     live.publish('gala')
+    ...     live.publish('gala')
+    ...     second = await subscriber.get(1)
+    ...     live.unsubscribe(subscriber)
+    ...     return first[0], second[0]
+    >>> asyncio.new_event_loop().run_until_complete(demo())
+    (b'event: totals\\ndata: {"amount": 0}\\n\\n', b'event: totals\\ndata: {"amount": 2500}\\n\\n')
+    >>> stats = live.stats()
+    >>> stats['published'], stats['broadcasts'], stats['subscribers']
+    (2, 1, 0)
+
+    A failed read skips one broadcast, not every later one:
+
+    >>> def flaky(host):
+    ...     if totals['gala'] == 5000:
+    ...         raise RuntimeError('database is locked')
+    ...     return {'amount': totals['gala']}
+    >>> live = LiveTotals(flaky, coalesce=0, logger=None)
+    >>> async def demo():
+    ...     subscriber = live.subscribe('gala')
+    ...     await subscriber.get(1)
+    ...     for amount in (5000, 7500):
+    ...         totals['gala'] = amount
+    ...         live.publish('gala')
+    ...         event = await subscriber.get(1)
+    ...     live.unsubscribe(subscriber)
+    ...     await asyncio.sleep(0.01)
+    ...     return event[0]
+    >>> asyncio.new_event_loop().run_until_complete(demo())
+    live totals for gala failed: RuntimeError('database is locked')
+    b'event: totals\\ndata: {"amount": 7500}\\n\\n'
+    >>> live.stats()['errors']
+    1
+    """
+
+    def __init__(
+        self,
+        totals,
+        coalesce: float = 0.25,
+        poll_interval: float = 5.0,
+        max_subscribers: int = 10000,
+        observe=None,
+        clock=time.perf_counter,
+        logger=None,
+    ):
+        self.totals = totals
+        self.coalesce = coalesce
+        self.poll_interval = poll_interval
+        self.max_subscribers = max_subscribers
+        self.observe = observe
+        self.clock = clock
+        self.logger = logger
+        # host -> set of Subscriber, only touched on the event loop
+        self._subscribers = {}
+        # host -> time of the first publish since the last broadcast
+        self._dirty = {}
+        # host -> the last event sent to its subscribers
+        self._last = {}
+        self._count = 0
+        self._loop = None
+        self._wakeup = None
+        self._task = None
+        self._lock = threading.Lock()
+        self.published = 0
+        self.broadcasts = 0
+        self.deliveries = 0
+        # Events replaced before a slow client read them
+        self.superseded = 0
+        self.rejected = 0
+        self.errors = 0
+        self.max_seen = 0
+
+    def publish(self, host: str) -> None:
+        """Note that `host`'s totals changed, from any thread"""
+        loop = self._loop
+        if loop is None:
+            return
+        with self._lock:
+            self.published += 1
+        try:
+            loop.call_soon_threadsafe(self._mark, host, self.clock())
+        except RuntimeError:
+            # The loop was closed
+            self._loop = None
+
+    def _mark(self, host, published_at):
+        if host in self._subscribers:
+            self._dirty.setdefault(host, published_at)
+            self._wakeup.set()
+
+    def subscribe(self, host: str):
+        """A `Subscriber` with the current totals pending, or None if there
+        are already `max_subscribers`. Call on the event loop.
+        """
+        if self._count >= self.max_subscribers:
+            self.rejected += 1
+            return None
+        if self._task is None:
+            self._loop = asyncio.get_event_loop()
+            self._wakeup = asyncio.Event()
+            self._task = self._loop.create_task(self._run())
+        subscriber = Subscriber(host)
+        subscribers = self._subscribers.setdefault(host, set())
+        if not subscribers or host not in self._last:
+            self._last[host] = encode_event(self.totals(host))
+        subscribers.add(subscriber)
+        subscriber.offer(self._last[host])
+        self._count += 1
+        self.max_seen = max(self.max_seen, self._count)
+        return subscriber
+
+    def unsubscribe(self, subscriber: Subscriber) -> None:
+        subscribers = self._subscribers.get(subscriber.host)
+        if subscribers is None or subscriber not in subscribers:
+            return
+        subscribers.discard(subscriber)
+        self._count -= 1
+        if not subscribers:
+            del self._subscribers[subscriber.host]
+            self._last.pop(subscriber.host, None)
+            self._dirty.pop(subscriber.host, None)
+        if not self._count:
+            # Nothing to publish to until the next subscriber
+            self._loop = None
+            self._task.cancel()
+            self._task = None
+
+    def delivered(self, published_at) -> None:
+        """Record that a subscriber's stream accepted an event"""
+        self.deliveries += 1
+        if published_at is not None and self.observe is not None:
+            self.observe("live_totals", self.clock() - published_at)
+
+    async def _run(self):
+        while True:
+            try:
+                await asyncio.wait_for(self._wakeup.wait(), self.poll_interval)
+            except asyncio.TimeoutError:
+                for host in self._subscribers:
+                    self._dirty.setdefault(host, None)
+            self._wakeup.clear()
+            if self.coalesce:
+                # Donations in the meantime go out with this broadcast
+                await asyncio.sleep(self.coalesce)
+            dirty, self._dirty = self._dirty, {}
+            for host, published_at in dirty.items():
+                if host not in self._subscribers:
+                    continue
+                try:
+                    totals = await self._loop.run_in_executor(None, self.totals, host)
+                except Exception as e:
+                    self.errors += 1
+                    self._log(f"live totals for {host} failed: {e!r}")
+                    continue
+                self._broadcast(host, totals, published_at)
+
+    def _log(self, msg):
+        if self.logger is not None:
+            self.logger.warning(msg)
+        else:
+            print(msg)
+
+    def _broadcast(self, host, totals, published_at):
+        subscribers = self._subscribers.get(host)
+        if not subscribers:
+            return
+        message = encode_event(totals)
+        if message == self._last.get(host):
+            return
+        self._last[host] = message
+        self.broadcasts += 1
+        for subscriber in subscribers:
+            if subscriber.pending is not None:
+                self.superseded += 1
+            subscriber.offer(message, published_at)
+
+    def stats(self) -> dict:
+        return {
+            "subscribers": self._count,
+            "max_subscribers": self.max_seen,
+            "hosts": len(self._subscribers),
+            "rejected": self.rejected,
+            "errors": self.errors,
+            "published": self.published,
+            "broadcasts": self.broadcasts,
+            "deliveries": self.deliveries,
+            "superseded": self.superseded,
+        }
@@ -0,0 +1,58 @@
+"""Bounded cache of rendered pages with strong ETags
+
+"""
+import hashlib
+
+from caching import LRUCache
+
+__all__ = ["PageCache", "CachedPage", "make_etag"]
+
+
+def make_etag(body: bytes) -> str:
+    """
+    >>> make_etag(b'<html></html>')
+    '941efb7368e46b27b937d34b'
+    """
+    return hashlib.sha1(body).hexdigest()[:24]
+
+
+class CachedPage:
+    __slots__ = ("body", "etag")
+
+    def __init__(self, body: bytes, etag: str):
+        self.body = body
+        self.etag = etag
+
+
+class PageCache:
+    """Memoize `render()` by a hashable key describing every input of the page
+
+    >>> cache = PageCache(2)
+    >>> renders = []
+    >>> def render():
+    ...     renders.append(1)
+    ...     return '<p>hi</p>'
+    >>> cache.get(('/', 'once'), render).body
+    b'<p>hi</p>'
+    >>> cache.get(('/', 'once'), render).etag == make_etag(b'<p>hi</p>')
+    True
+    >>> len(renders)
+    1
+    """
+
+    def __init__(self, maxsize: int = 512):
+        self.cache = LRUCache(maxsize)
+
+    def get(self, key, render) -> CachedPage:
+        page = self.cache.get(key)
+        if page is None:
+            body = render().encode("utf-8")
+            page = CachedPage(body, make_etag(body))
+            self.cache.set(key, page)
+        return page
+
+    def clear(self) -> None:
+        self.cache.clear()
+
+    def stats(self) -> dict:
+        return self.cache.stats()
@@ -2,9 +2,15 @@
 
 """
 import re
-from typing import Optional
+from array import array
+from typing import Iterable, List, Optional, Tuple
 
-__all__ = ["parse_cents"]
+try:
+    import numpy
+except ImportError:  # pragma: no cover
+    numpy = None
+
+__all__ = ["format_cents", "parse_cents", "parse_cents_many", "parse_cents_array"]
 
 DOLLAR_RE = re.compile(r"^\s*\$?([1-9]\d*)((?:,\d\d\d)*)(?:\.(\d\d))?\s*$")
 
@@ -50,6 +56,76 @@ def parse_cents(s: str) -> Optional[int]:
     return int(leading_digits + comma_groups.replace(",", "") + (cents or "00"))
 
 
+def format_cents(cents: int) -> str:
+    """Format cents as a dollar amount that `parse_cents` reads back, with
+    integer math only
+
+    >>> format_cents(12345678)
+    '$123,456.78'
+    >>> format_cents(2500), format_cents(5), format_cents(-150)
+    ('$25.00', '$0.05', '$-1.50')
+    >>> all(parse_cents(format_cents(c)) == c for c in range(100, 100000, 7))
+    True
+    """
+    if cents < 0:
+        return "$-" + format_cents(-cents)[1:]
+    dollars, cents = divmod(cents, 100)
+    return f"${dollars:,}.{cents:02d}"
+
+
+INT64_MAX = 2 ** 63 - 1
+
+
+def parse_cents_many(values: Iterable[str]) -> List[Optional[int]]:
+    """`parse_cents` over a column of strings in one pass
+
+    Plain ASCII digit strings, the bulk of exported amounts, skip the regex.
+
+    >>> parse_cents_many(['$1', '1.50', '200', '$123,456.78', '   20   '])
+    [100, 150, 20000, 12345678, 2000]
+    >>> parse_cents_many(['', '01234', '-$100', '100.0', '100.', '0'])
+    [None, None, None, None, None, None]
+    """
+    match = DOLLAR_RE.match
+    rval = []
+    append = rval.append
+    for s in values:
+        if s.isdigit() and s.isascii() and s[0] != "0":
+            append(int(s) * 100)
+            continue
+        m = match(s)
+        if m is None:
+            append(None)
+        else:
+            (leading_digits, comma_groups, cents) = m.groups()
+            append(
+                int(leading_digits + comma_groups.replace(",", "") + (cents or "00"))
+            )
+    return rval
+
+
+def parse_cents_array(values: Iterable[str]) -> Tuple[array, bytearray]:
+    """Parse a column into int64 cents and a validity mask
+
+    Invalid entries (including amounts too large for int64) are 0 in the
+    values and 0 in the mask. When NumPy is installed the result is an
+    int64 array and a bool array sharing the same buffers.
+
+    >>> cents, valid = parse_cents_array(['$1', 'nope', '1,234.50'])
+    >>> list(cents), list(map(bool, valid))
+    ([100, 0, 123450], [True, False, True])
+    """
+    parsed = parse_cents_many(values)
+    valid = bytearray(n is not None and n <= INT64_MAX for n in parsed)
+    cents = array("q", [n if ok else 0 for n, ok in zip(parsed, valid)])
+    if numpy is not None:
+        return (
+            numpy.frombuffer(cents, dtype=numpy.int64),
+            numpy.frombuffer(valid, dtype=numpy.bool_),
+        )
+    return cents, valid
+
+
 if __name__ == "__main__":
     import doctest
 
@@ -0,0 +1,180 @@
+"""Token bucket rate limiting
+
+"""
+import threading
+import time
+from collections import OrderedDict
+
+__all__ = ["KeyedTokenBuckets", "SlidingWindowCounter", "TokenBucket"]
+
+
+class TokenBucket:
+    """Allows `rate` operations per second with bursts of up to `capacity`
+
+    >>> now = [0.0]
+    >>> bucket = TokenBucket(rate=2, capacity=2, clock=lambda: now[0])
+    >>> bucket.try_acquire(), bucket.try_acquire(), bucket.try_acquire()
+    (True, True, False)
+    >>> bucket.delay()
+    0.5
+    >>> now[0] += 0.5
+    >>> bucket.try_acquire()
+    True
+    """
+
+    __slots__ = ("rate", "capacity", "tokens", "updated", "clock", "_lock")
+
+    def __init__(self, rate: float, capacity: float = None, clock=time.monotonic):
+        self.rate = rate
+        self.capacity = rate if capacity is None else capacity
+        self.tokens = self.capacity
+        self.clock = clock
+        self.updated = clock()
+        self._lock = threading.Lock()
+
+    def _refill(self, now):
+        elapsed = now - self.updated
+        if elapsed > 0:
+            self.tokens = min(self.capacity, self.tokens + elapsed * self.rate)
+            self.updated = now
+
+    def try_acquire(self, n: float = 1) -> bool:
+        """Take `n` tokens if they are available right now"""
+        with self._lock:
+            self._refill(self.clock())
+            if self.tokens >= n:
+                self.tokens -= n
+                return True
+            return False
+
+    def delay(self, n: float = 1) -> float:
+        """Seconds until `n` tokens will be available"""
+        with self._lock:
+            self._refill(self.clock())
+            return max(0.0, (n - self.tokens) / self.rate)
+
+    def acquire(self, n: float = 1, timeout: float = None) -> bool:
+        """Block until `n` tokens are taken, or return False after `timeout`"""
+        deadline = None if timeout is None else self.clock() + timeout
+        while True:
+            with self._lock:
+                now = self.clock()
+                self._refill(now)
+                if self.tokens >= n:
+                    self.tokens -= n
+                    return True
+                wait = (n - self.tokens) / self.rate
+            if deadline is not None:
+                if now + wait > deadline:
+                    return False
+            time.sleep(wait)
+
+
+class KeyedTokenBuckets:
+    """A token bucket per key (e.g. client IP) for up to `max_keys` keys
+
+    Each key only stores its token count and last refill time. When full,
+    the least recently seen key is forgotten and starts over with a full
+    bucket, so memory stays bounded however many keys there are.
+
+    >>> now = [0.0]
+    >>> buckets = KeyedTokenBuckets(rate=1, capacity=2, max_keys=2,
+    ...                             clock=lambda: now[0])
+    >>> [buckets.take('a') for _ in range(3)]
+    [0.0, 0.0, 1.0]
+    >>> buckets.take('b'), buckets.take('c'), len(buckets), buckets.evictions
+    (0.0, 0.0, 2, 1)
+    >>> now[0] += 0.5
+    >>> buckets.take('b'), buckets.take('b')
+    (0.0, 0.5)
+    """
+
+    def __init__(
+        self,
+        rate: float,
+        capacity: float = None,
+        max_keys: int = 10000,
+        clock=time.monotonic,
+    ):
+        self.rate = rate
+        self.capacity = rate if capacity is None else capacity
+        self.max_keys = max_keys
+        self.clock = clock
+        self.evictions = 0
+        # key -> [tokens, updated]
+        self._buckets = OrderedDict()
+        self._lock = threading.Lock()
+
+    def __len__(self):
+        return len(self._buckets)
+
+    def take(self, key, n: float = 1) -> float:
+        """Take `n` tokens from `key`'s bucket and return 0.0, or return the
+        seconds until they will be available without taking any
+        """
+        with self._lock:
+            now = self.clock()
+            bucket = self._buckets.get(key)
+            if bucket is None:
+                bucket = self._buckets[key] = [self.capacity, now]
+                if len(self._buckets) > self.max_keys:
+                    self._buckets.popitem(last=False)
+                    self.evictions += 1
+            else:
+                self._buckets.move_to_end(key)
+                elapsed = now - bucket[1]
+                if elapsed > 0:
+                    bucket[0] = min(self.capacity, bucket[0] + elapsed * self.rate)
+                    bucket[1] = now
+            if bucket[0] >= n:
+                bucket[0] -= n
+                return 0.0
+            return (n - bucket[0]) / self.rate
+
+
+class SlidingWindowCounter:
+    """Counts events in the last `window` seconds in constant space
+
+    The count is estimated from the current and previous fixed windows,
+    weighting the previous one by how much of it is still in range.
+
+    >>> now = [0.0]
+    >>> counter = SlidingWindowCounter(60, clock=lambda: now[0])
+    >>> for _ in range(10):
+    ...     counter.add()
+    >>> now[0] = 90.0
+    >>> counter.add()
+    >>> counter.count()
+    6.0
+    >>> now[0] = 200.0
+    >>> counter.count()
+    0.0
+    """
+
+    __slots__ = ("window", "clock", "start", "current", "previous", "_lock")
+
+    def __init__(self, window: float = 60.0, clock=time.monotonic):
+        self.window = window
+        self.clock = clock
+        self.start = clock()
+        self.current = 0
+        self.previous = 0
+        self._lock = threading.Lock()
+
+    def _roll(self, now):
+        windows = int((now - self.start) // self.window)
+        if windows > 0:
+            self.previous = self.current if windows == 1 else 0
+            self.current = 0
+            self.start += windows * self.window
+        return now - self.start
+
+    def add(self, n: int = 1) -> None:
+        with self._lock:
+            self._roll(self.clock())
+            self.current += n
+
+    def count(self) -> float:
+        with self._lock:
+            elapsed = self._roll(self.clock())
+            return self.previous * (1 - elapsed / self.window) + self.current
@@ -0,0 +1,107 @@
+"""Append-only log of receipts and donation events sent for each charge
+
+Reconciliation (see reconcile.py) joins Stripe's charges against this log.
+"""
+import os
+import sqlite3
+import threading
+import time
+from typing import Iterator, Tuple
+
+__all__ = ["ReceiptLog", "RECEIPT", "DONATION_EVENT", "SKIPPED", "FAILURE_NOTICE"]
+
+# Kinds of log entries
+RECEIPT = "receipt"
+DONATION_EVENT = "donation"
+SKIPPED = "skipped"
+# The payment failed email for a renewal, not checked by reconcile.py
+FAILURE_NOTICE = "failure"
+
+SCHEMA = """
+CREATE TABLE IF NOT EXISTS receipt_log (
+    charge_id TEXT NOT NULL,
+    kind TEXT NOT NULL,
+    amount INTEGER NOT NULL,
+    charge_created INTEGER NOT NULL,
+    logged_at REAL NOT NULL
+);
+CREATE INDEX IF NOT EXISTS receipt_log_charge_created
+    ON receipt_log (charge_created);
+CREATE INDEX IF NOT EXISTS receipt_log_charge_id ON receipt_log (charge_id);
+"""
+
+
+class ReceiptLog:
+    """Records what was sent for each charge, one row per send
+
+    Rows are never updated, so a charge with two receipt rows was sent
+    two receipts.
+
+    >>> log = ReceiptLog(':memory:')
+    >>> log.record('ch_1', RECEIPT, 5000, 1571000000)
+    >>> log.record('ch_1', DONATION_EVENT, 5000, 1571000000)
+    >>> list(log.rows(1570000000, 1572000000))
+    [('ch_1', 'receipt', 5000), ('ch_1', 'donation', 5000)]
+    >>> list(log.rows(0, 1570000000))
+    []
+    >>> sorted(log.kinds('ch_1')), log.kinds('ch_2')
+    (['donation', 'receipt'], set())
+    """
+
+    def __init__(self, path: str):
+        self.path = path
+        self._local = threading.local()
+        self._shared = None
+        if path != ":memory:":
+            os.makedirs(os.path.dirname(os.path.abspath(path)), exist_ok=True)
+        self._connection().executescript(SCHEMA)
+
+    def _connection(self) -> sqlite3.Connection:
+        if self.path == ":memory:":
+            # Every connection to :memory: is a new database, share one
+            if self._shared is None:
+                self._shared = sqlite3.connect(
+                    self.path, isolation_level=None, check_same_thread=False
+                )
+            return self._shared
+        conn = getattr(self._local, "conn", None)
+        if conn is None or getattr(self._local, "pid", None) != os.getpid():
+            conn = sqlite3.connect(self.path, timeout=30, isolation_level=None)
+            conn.execute("PRAGMA journal_mode=WAL")
+            conn.execute("PRAGMA synchronous=NORMAL")
+            self._local.conn = conn
+            self._local.pid = os.getpid()
+        return conn
+
+    def record(self, charge_id: str, kind: str, amount: int, charge_created: int):
+        self._connection().execute(
+            "INSERT INTO receipt_log"
+            " (charge_id, kind, amount, charge_created, logged_at)"
+            " VALUES (?, ?, ?, ?, ?)",
+            (charge_id, kind, amount, charge_created, time.time()),
+        )
+
+    def rows(self, start: int, end: int) -> Iterator[Tuple[str, str, int]]:
+        """(charge_id, kind, amount) for charges created in [start, end)"""
+        return self._connection().execute(
+            "SELECT charge_id, kind, amount FROM receipt_log"
+            " WHERE charge_created >= ? AND charge_created < ? ORDER BY rowid",
+            (start, end),
+        )
+
+    def kinds(self, charge_id: str) -> set:
+        """The kinds of entries logged for `charge_id`"""
+        return {
+            kind
+            for (kind,) in self._connection().execute(
+                "SELECT DISTINCT kind FROM receipt_log WHERE charge_id = ?",
+                (charge_id,),
+            )
+        }
+
+    def first_charge_created(self):
+        return (
+            self._connection()
+            .execute("SELECT MIN(charge_created) FROM receipt_log")
+            .fetchone()[0]
+        )
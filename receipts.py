@@ -0,0 +1,265 @@
+"""SendGrid dynamic template payloads for receipts and failure notices
+
+Stripe objects are read once into a `ChargeView`. Payment method labels are
+memoized per (type, brand, funding, wallet), amounts are formatted with
+integer math (`parse_cents.format_cents`), and dates are memoized per day,
+so building a payload is mostly dict construction.
+"""
+import functools
+import re
+from datetime import date, datetime
+
+from parse_cents import format_cents
+
+__all__ = [
+    "CARD_BRANDS",
+    "ChargeView",
+    "format_identifier",
+    "local_tz",
+    "long_date",
+    "payment_method_label",
+    "sendgrid_safe_name",
+    "short_date",
+    "template_data",
+]
+
+TIMEZONE = "America/Los_Angeles"
+DAY = 24 * 60 * 60
+EPOCH_ORDINAL = date(1970, 1, 1).toordinal()
+
+CARD_BRANDS = {
+    "amex": "American Express",
+    "diners": "Diners Club",
+    "discover": "Discover",
+    "jcb": "JCB",
+    "mastercard": "Mastercard",
+    "unionpay": "UnionPay",
+    "visa": "Visa",
+}
+UNSAFE_NAME_RE = re.compile(r"([,;]\s*)+")
+
+
+@functools.lru_cache(maxsize=None)
+def local_tz():
+    # dateutil.tz is only imported once it is needed
+    from dateutil import tz
+
+    return tz.gettz(TIMEZONE)
+
+
+@functools.lru_cache(maxsize=4096)
+def _utc_offset(utc_day):
+    """The local UTC offset in seconds throughout a UTC day, or None on days
+    when it changes
+    """
+    start, end = (
+        datetime.fromtimestamp(t, local_tz()).utcoffset()
+        for t in (utc_day * DAY, utc_day * DAY + DAY - 1)
+    )
+    return int(start.total_seconds()) if start == end else None
+
+
+def _local_day(timestamp):
+    offset = _utc_offset(timestamp // DAY)
+    if offset is None:
+        offset = int(
+            datetime.fromtimestamp(timestamp, local_tz()).utcoffset().total_seconds()
+        )
+    return (timestamp + offset) // DAY
+
+
+@functools.lru_cache(maxsize=4096)
+def _short_date(local_day):
+    return date.fromordinal(EPOCH_ORDINAL + local_day).strftime("%x")
+
+
+@functools.lru_cache(maxsize=4096)
+def _long_date(local_day):
+    d = date.fromordinal(EPOCH_ORDINAL + local_day)
+    return f"{d.strftime('%b')} {d.day}, {d.year}"
+
+
+def short_date(timestamp):
+    """
+    >>> short_date(1571000000)
+    '10/13/19'
+    """
+    return _short_date(_local_day(timestamp))
+
+
+def long_date(timestamp):
+    """
+    >>> long_date(1573678800)
+    'Nov 13, 2019'
+    """
+    return _long_date(_local_day(timestamp))
+
+
+def format_identifier(s):
+    """
+    >>> format_identifier('apple_pay')
+    'Apple Pay'
+    """
+    return " ".join(map(lambda s: s.capitalize(), s.split("_")))
+
+
+@functools.lru_cache(maxsize=1024)
+def _payment_method_label(payment_type, brand, funding, wallet_type):
+    if payment_type not in ("card", "card_present"):
+        return format_identifier(payment_type)
+    parts = []
+    brand = CARD_BRANDS.get(brand)
+    if brand:
+        parts.append(brand)
+    if funding != "unknown":
+        parts.append(funding)
+    parts.append("card")
+    if wallet_type:
+        parts.append("({})".format(format_identifier(wallet_type)))
+    return " ".join(parts)
+
+
+def payment_method_label(payment_method_details):
+    """How a charge's payment_method_details (or a PaymentMethod) is shown
+
+    >>> import stripe
+    >>> details = stripe.util.convert_to_stripe_object({
+    ...     "type": "card",
+    ...     "card": {"brand": "amex", "funding": "credit",
+    ...              "wallet": {"type": "apple_pay"}},
+    ... })
+    >>> payment_method_label(details)
+    'American Express credit card (Apple Pay)'
+    >>> payment_method_label(stripe.util.convert_to_stripe_object(
+    ...     {"type": "sepa_debit", "sepa_debit": {}}))
+    'Sepa Debit'
+    """
+    payment_type = payment_method_details.type
+    if payment_type not in ("card", "card_present"):
+        return _payment_method_label(payment_type, None, None, None)
+    details = payment_method_details[payment_type]
+    wallet = details.wallet
+    return _payment_method_label(
+        payment_type, details.brand, details.funding, wallet and wallet.type
+    )
+
+
+def sendgrid_safe_name(name):
+    """The to.name, cc.name, and bcc.name personalizations cannot include either the ; or , characters.
+
+    >>> sendgrid_safe_name("Lovelace, Ada; Countess")
+    'Lovelace Ada Countess'
+    """
+    if "," not in name and ";" not in name:
+        return name
+    return UNSAFE_NAME_RE.sub(" ", name)
+
+
+class ChargeView:
+    """The fields of a Stripe charge that a receipt needs, read once"""
+
+    __slots__ = ("id", "amount", "created", "name", "email", "payment_method")
+
+    def __init__(self, id, amount, created, name, email, payment_method):
+        self.id = id
+        self.amount = amount
+        self.created = created
+        self.name = name
+        self.email = email
+        self.payment_method = payment_method
+
+    @classmethod
+    def from_charge(cls, charge):
+        billing_details = charge.billing_details
+        return cls(
+            charge.id,
+            charge.amount,
+            charge.created,
+            billing_details.name,
+            billing_details.email,
+            payment_method_label(charge.payment_method_details),
+        )
+
+    @property
+    def donor(self):
+        if self.name:
+            return f"{self.name} <{self.email}>"
+        return self.email
+
+    def to(self):
+        """The SendGrid recipient, without a name if the charge has none"""
+        if self.name:
+            return {"name": sendgrid_safe_name(self.name), "email": self.email}
+        return {"email": self.email}
+
+
+def template_data(template_id, sender, charge, frequency, **kw):
+    """The message for one `ChargeView`, `kw` is added to the template data
+
+    The output matches the receipts sent before this module existed:
+
+    >>> import stripe
+    >>> charge = stripe.Charge.construct_from({
+    ...     "id": "ch_1", "amount": 123456, "created": 1571000000,
+    ...     "billing_details": {"name": "Lovelace, Ada; Countess",
+    ...                         "email": "ada@example.com"},
+    ...     "payment_method_details": {
+    ...         "type": "card",
+    ...         "card": {"brand": "amex", "funding": "credit",
+    ...                  "wallet": {"type": "apple_pay"}}},
+    ... }, "sk_test")
+    >>> sender = {"name": "Mission Bit", "email": "donate@missionbit.org"}
+    >>> template_data("d-1", sender, ChargeView.from_charge(charge), "one-time"
+    ...               ) == {
+    ...     "template_id": "d-1",
+    ...     "from": {"name": "Mission Bit", "email": "donate@missionbit.org"},
+    ...     "personalizations": [{
+    ...         "to": [{"name": "Lovelace Ada Countess", "email": "ada@example.com"}],
+    ...         "dynamic_template_data": {
+    ...             "transaction_id": "ch_1",
+    ...             "frequency": "one-time",
+    ...             "total": "$1,234.56",
+    ...             "date": "10/13/19",
+    ...             "payment_method": "American Express credit card (Apple Pay)",
+    ...             "donor": "Lovelace, Ada; Countess <ada@example.com>",
+    ...         },
+    ...     }],
+    ... }
+    True
+    >>> monthly = ChargeView("ch_2", 2500, 1572600000, "Grace Hopper",
+    ...                      "grace@example.com", "Visa card")
+    >>> template_data("d-1", sender, monthly, "monthly", monthly={
+    ...     "next": long_date(1573678800),
+    ...     "url": "https://donate.missionbit.org/subscriptions/sub_1",
+    ... })["personalizations"] == [{
+    ...     "to": [{"name": "Grace Hopper", "email": "grace@example.com"}],
+    ...     "dynamic_template_data": {
+    ...         "transaction_id": "ch_2",
+    ...         "frequency": "monthly",
+    ...         "total": "$25.00",
+    ...         "date": "11/01/19",
+    ...         "payment_method": "Visa card",
+    ...         "donor": "Grace Hopper <grace@example.com>",
+    ...         "monthly": {
+    ...             "next": "Nov 13, 2019",
+    ...             "url": "https://donate.missionbit.org/subscriptions/sub_1",
+    ...         },
+    ...     },
+    ... }]
+    True
+    """
+    data = {
+        "transaction_id": charge.id,
+        "frequency": frequency,
+        "total": format_cents(charge.amount),
+        "date": short_date(charge.created),
+        "payment_method": charge.payment_method,
+        "donor": charge.donor,
+    }
+    if kw:
+        data.update(kw)
+    return {
+        "template_id": template_id,
+        "from": dict(sender),
+        "personalizations": [{"to": [charge.to()], "dynamic_template_data": data}],
+    }
@@ -0,0 +1,260 @@
+"""Check that every successful charge got exactly one receipt and Donation event
+
+Charges are streamed from the Stripe API (or from exported JSON pages of
+charges or invoices) one window of dates at a time and joined against the
+receipt log written by the webhook handlers. Only one window's log rows are
+held in memory, so a run over years of history uses the same memory as a run
+over a month. Windows are reconciled in parallel worker processes.
+
+    $ python reconcile.py --since 2019-10-01
+    $ python reconcile.py --fixtures exports/charges-*.json --jobs 4
+
+Exits with status 1 if anything was found.
+"""
+import argparse
+import json
+import os
+import sys
+import time
+from collections import Counter, namedtuple
+from concurrent.futures import ProcessPoolExecutor
+from datetime import datetime, timezone
+
+from receipt_log import DONATION_EVENT, RECEIPT, SKIPPED, ReceiptLog
+
+__all__ = ["Finding", "build_index", "charge_records", "reconcile"]
+
+DAY = 24 * 60 * 60
+# Invoices are created up to an hour or so before their charge, allow for that
+# when looking up log rows (which are keyed on the charge's created time)
+INDEX_SLACK = 2 * DAY
+
+Finding = namedtuple("Finding", "kind charge_id amount detail")
+
+
+def iter_fixture_objects(paths):
+    """Stream objects from exported pages (a list object, a JSON array, or JSON
+    lines), one file at a time
+    """
+    for path in paths:
+        with open(path) as f:
+            if path.endswith(".jsonl"):
+                for line in f:
+                    if line.strip():
+                        yield json.loads(line)
+                continue
+            page = json.load(f)
+        yield from page["data"] if isinstance(page, dict) else page
+
+
+def iter_stripe_objects(start, end):
+    """Stream charges created in [start, end) from the Stripe API"""
+    import stripe
+
+    stripe.api_key = stripe.api_key or os.environ["SECRET_KEY"]
+    charges = stripe.Charge.list(created={"gte": start, "lt": end}, limit=100)
+    return charges.auto_paging_iter()
+
+
+def charge_records(objects):
+    """(charge_id, amount, created) for each successful charge or paid invoice
+
+    >>> list(charge_records([
+    ...     {"object": "charge", "id": "ch_1", "amount": 5000, "created": 1,
+    ...      "status": "succeeded", "paid": True, "metadata": {}},
+    ...     {"object": "charge", "id": "ch_2", "amount": 5000, "created": 1,
+    ...      "status": "failed", "paid": False, "metadata": {}},
+    ...     {"object": "invoice", "id": "in_1", "charge": "ch_3",
+    ...      "amount_paid": 1000, "created": 2, "status": "paid"},
+    ... ]))
+    [('ch_1', 5000, 1), ('ch_3', 1000, 2)]
+    """
+    for obj in objects:
+        if obj["object"] == "invoice":
+            if obj.get("status") == "paid" and obj.get("charge"):
+                yield obj["charge"], obj["amount_paid"], obj["created"]
+        elif obj.get("status") == "succeeded" and obj.get("paid"):
+            if (obj.get("metadata") or {}).get("app") == "www.missionbit.org":
+                # Receipts for the new donation portal are sent elsewhere
+                continue
+            yield obj["id"], obj["amount"], obj["created"]
+
+
+def build_index(rows):
+    """Hash index of receipt log rows: charge_id -> [(kind, amount), ...]"""
+    index = {}
+    for charge_id, kind, amount in rows:
+        entry = index.get(charge_id)
+        if entry is None:
+            index[charge_id] = [(kind, amount)]
+        else:
+            entry.append((kind, amount))
+    return index
+
+
+def reconcile(records, index, check_events=True):
+    """Yield a Finding for every charge whose log entries look wrong
+
+    >>> index = build_index([
+    ...     ("ch_1", "receipt", 5000), ("ch_1", "donation", 5000),
+    ...     ("ch_2", "receipt", 100), ("ch_2", "receipt", 100),
+    ...     ("ch_2", "donation", 100), ("ch_3", "receipt", 700),
+    ...     ("ch_3", "donation", 700), ("ch_5", "skipped", 100),
+    ... ])
+    >>> records = [("ch_1", 5000, 0), ("ch_2", 100, 0), ("ch_3", 750, 0),
+    ...            ("ch_4", 100, 0), ("ch_5", 100, 0)]
+    >>> for f in reconcile(records, index):
+    ...     print(f.kind, f.charge_id, f.detail or "-")
+    double_send ch_2 2 receipts
+    amount_mismatch ch_3 receipt for 700
+    amount_mismatch ch_3 donation for 700
+    missing_receipt ch_4 -
+    missing_donation_event ch_4 -
+    """
+    for charge_id, amount, _created in records:
+        entries = index.get(charge_id, ())
+        kinds = Counter(kind for kind, _ in entries)
+        if kinds[SKIPPED]:
+            continue
+        for kind, missing in (
+            (RECEIPT, "missing_receipt"),
+            (DONATION_EVENT, "missing_donation_event"),
+        ):
+            if kind == DONATION_EVENT and not check_events:
+                continue
+            if not kinds[kind]:
+                yield Finding(missing, charge_id, amount, "")
+            elif kinds[kind] > 1:
+                yield Finding(
+                    "double_send", charge_id, amount, f"{kinds[kind]} {kind}s"
+                )
+            for logged_kind, logged_amount in entries:
+                if logged_kind == kind and logged_amount != amount:
+                    yield Finding(
+                        "amount_mismatch",
+                        charge_id,
+                        amount,
+                        f"{kind} for {logged_amount}",
+                    )
+
+
+def reconcile_window(job):
+    """Reconcile charges created in [start, end), returning (counts, findings)
+
+    Run in a worker process, so everything it needs is in `job`.
+    """
+    db_path, start, end, fixtures, check_events = job
+    log = ReceiptLog(db_path)
+    index = build_index(log.rows(start - INDEX_SLACK, end + INDEX_SLACK))
+    if fixtures:
+        objects = iter_fixture_objects(fixtures)
+    else:
+        objects = iter_stripe_objects(start, end)
+    records = (r for r in charge_records(objects) if start <= r[2] < end)
+    counts = Counter()
+
+    def counted(records):
+        for record in records:
+            counts["charges"] += 1
+            counts["cents"] += record[1]
+            yield record
+
+    findings = list(reconcile(counted(records), index, check_events))
+    counts.update(f.kind for f in findings)
+    return counts, findings
+
+
+def windows(start, end, days):
+    """
+    >>> list(windows(0, 5 * DAY, 2))
+    [(0, 172800), (172800, 345600), (345600, 432000)]
+    """
+    step = days * DAY
+    while start < end:
+        yield start, min(start + step, end)
+        start += step
+
+
+def parse_date(s):
+    return int(
+        datetime.strptime(s, "%Y-%m-%d").replace(tzinfo=timezone.utc).timestamp()
+    )
+
+
+def format_date(ts):
+    return datetime.fromtimestamp(ts, timezone.utc).strftime("%Y-%m-%d")
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description=__doc__.split("\n", 1)[0])
+    parser.add_argument(
+        "--db",
+        default=os.environ.get(
+            "WEBHOOK_QUEUE_PATH",
+            os.path.join(os.path.dirname(__file__), "instance", "webhooks.sqlite3"),
+        ),
+        help="receipt log database (default: WEBHOOK_QUEUE_PATH)",
+    )
+    parser.add_argument(
+        "--since", help="YYYY-MM-DD (default: first charge in the receipt log)"
+    )
+    parser.add_argument("--until", help="YYYY-MM-DD, exclusive (default: now)")
+    parser.add_argument("--window-days", type=int, default=30)
+    parser.add_argument("--jobs", type=int, default=os.cpu_count())
+    parser.add_argument(
+        "--fixtures", nargs="+", help="exported charge or invoice JSON pages"
+    )
+    parser.add_argument(
+        "--no-events",
+        dest="check_events",
+        action="store_false",
+        help="don't expect Donation telemetry events",
+    )
+    args = parser.parse_args(argv)
+
+    if args.since:
+        start = parse_date(args.since)
+    else:
+        start = ReceiptLog(args.db).first_charge_created()
+        if start is None:
+            parser.error("the receipt log is empty, pass --since")
+    end = parse_date(args.until) if args.until else int(time.time())
+    jobs = [
+        (args.db, lo, hi, args.fixtures, args.check_events)
+        for lo, hi in windows(start, end, args.window_days)
+    ]
+    totals = Counter()
+    with ProcessPoolExecutor(max_workers=args.jobs) as executor:
+        for (_, lo, hi, _, _), (counts, findings) in zip(
+            jobs, executor.map(reconcile_window, jobs)
+        ):
+            totals.update(counts)
+            for f in findings:
+                print(
+                    f"{f.kind:<24} {f.charge_id:<30} "
+                    f"${f.amount / 100:>10,.2f}  {f.detail}"
+                )
+            print(
+                f"# {format_date(lo)} .. {format_date(hi)}: "
+                f"{counts['charges']} charges, {len(findings)} findings",
+                file=sys.stderr,
+            )
+    problems = sum(v for k, v in totals.items() if k not in ("charges", "cents"))
+    print(
+        f"# {totals['charges']} charges, ${totals['cents'] / 100:,.2f}, "
+        + ", ".join(
+            f"{k}: {totals[k]}"
+            for k in (
+                "missing_receipt",
+                "missing_donation_event",
+                "double_send",
+                "amount_mismatch",
+            )
+        ),
+        file=sys.stderr,
+    )
+    return 1 if problems else 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
@@ -0,0 +1,190 @@
+"""Answers redirects in front of the Flask app, without a request context
+
+With REDIRECT_TO_WWW, GET requests for the donation page and subscription
+pages are sent to www.missionbit.org. With CANONICAL_HOST, every request
+that isn't for a canonical host over https is sent to one. Both are decided
+from the WSGI environ by set and dict lookups against a table that is
+built once from the app's URL map. Constant Location headers are cached.
+Everything else is passed to the wrapped app untouched.
+"""
+import threading
+from urllib.parse import quote
+
+__all__ = ["RedirectTable", "request_host"]
+
+STATUS = "302 FOUND"
+# What add_cache_control_header would have added
+CACHE_CONTROL = ("Cache-Control", "no-cache, no-store, must-revalidate")
+# Characters that werkzeug.urls.iri_to_uri leaves unquoted in a Location
+SAFE = "/:?#[]@!$&'()*+,;=%"
+
+
+def last_value(value):
+    """The value ProxyFix trusts from a comma separated forwarded header"""
+    return value.rsplit(",", 1)[-1].strip() if value else None
+
+
+def request_host(environ, canonical_hosts=()):
+    """(scheme, host) as the app sees them behind verizonProxyHostFixer and
+    ProxyFix, i.e. what `urlsplit(request.url)` would give
+
+    >>> request_host({'wsgi.url_scheme': 'http', 'HTTP_HOST': 'example.com:80'})
+    ('http', 'example.com')
+    >>> request_host({'wsgi.url_scheme': 'http', 'HTTP_HOST': 'cdn',
+    ...               'HTTP_X_FORWARDED_PROTO': 'http, https',
+    ...               'HTTP_X_HOST': 'donate.missionbit.org'},
+    ...              ['donate.missionbit.org'])
+    ('https', 'donate.missionbit.org')
+    """
+    scheme = environ.get("wsgi.url_scheme", "http")
+    host = environ.get("HTTP_HOST")
+    if canonical_hosts:
+        scheme = last_value(environ.get("HTTP_X_FORWARDED_PROTO")) or scheme
+        x_host = environ.get("HTTP_X_HOST")
+        forwarded_host = (
+            x_host
+            if x_host in canonical_hosts
+            else last_value(environ.get("HTTP_X_FORWARDED_HOST"))
+        )
+        host = forwarded_host or host
+    if host is None:
+        port = environ.get("SERVER_PORT", "80")
+        host = environ.get("SERVER_NAME", "")
+        if (scheme, port) not in (("https", "443"), ("http", "80")):
+            host = f"{host}:{port}"
+    elif scheme == "http" and host.endswith(":80"):
+        host = host[:-3]
+    elif scheme == "https" and host.endswith(":443"):
+        host = host[:-4]
+    return scheme, host
+
+
+class RedirectTable:
+    """WSGI middleware that answers redirects from precomputed rules
+
+    `page_redirects` maps a path to the Location for GET and HEAD requests
+    for it. `segment_redirect` is the Location for any other one segment
+    path (e.g. /<dollars> and /<dollars>/) that isn't in `reserved`.
+    `prefix_redirects` maps the first segment of a two segment path (e.g.
+    /subscriptions/<id>) to a Location prefix for the second.
+
+    >>> def flask(environ, start_response):
+    ...     start_response("200 OK", [])
+    ...     return [b"flask"]
+    >>> table = RedirectTable(
+    ...     flask,
+    ...     canonical_hosts=["donate.missionbit.org"],
+    ...     page_redirects={"/": "https://www.missionbit.org/donate"},
+    ...     segment_redirect="https://www.missionbit.org/donate",
+    ...     prefix_redirects={
+    ...         "subscriptions": "https://www.missionbit.org/donate/subscriptions/"
+    ...     },
+    ...     reserved=["/robots.txt"],
+    ... )
+    >>> def get(path, host="donate.missionbit.org", scheme="https", query=""):
+    ...     response = {}
+    ...     def start_response(status, headers):
+    ...         response.update(headers, status=status)
+    ...     body = table({"REQUEST_METHOD": "GET", "PATH_INFO": path,
+    ...                   "QUERY_STRING": query, "wsgi.url_scheme": scheme,
+    ...                   "HTTP_HOST": host}, start_response)
+    ...     return response.get("Location", b"".join(body).decode())
+    >>> get("/250/"), get("/subscriptions/sub_1")
+    ('https://www.missionbit.org/donate', 'https://www.missionbit.org/donate/subscriptions/sub_1')
+    >>> get("/robots.txt"), get("/static/main.css")
+    ('flask', 'flask')
+    >>> get("/robots.txt", scheme="http", query="a=1 b")
+    'https://donate.missionbit.org/robots.txt?a=1%20b'
+    >>> get("/hooks", host="missionbit.azurewebsites.net")
+    'https://donate.missionbit.org/hooks'
+    >>> table.stats()
+    {'canonical': 2, 'page': 1, 'prefix': 1, 'passed': 2}
+    """
+
+    def __init__(
+        self,
+        app,
+        canonical_hosts=(),
+        page_redirects=None,
+        segment_redirect=None,
+        prefix_redirects=None,
+        reserved=(),
+    ):
+        self.app = app
+        self.canonical_hosts = frozenset(canonical_hosts)
+        self.default_host = canonical_hosts[0] if canonical_hosts else None
+        self._pages = {
+            path: self.headers(location)
+            for path, location in (page_redirects or {}).items()
+        }
+        self._segment = segment_redirect and self.headers(segment_redirect)
+        self._prefixes = dict(prefix_redirects or {})
+        self._reserved = frozenset(reserved)
+        self._lock = threading.Lock()
+        self._counts = {"canonical": 0, "page": 0, "prefix": 0, "passed": 0}
+
+    @staticmethod
+    def headers(location):
+        return [
+            ("Content-Type", "text/html; charset=utf-8"),
+            ("Content-Length", "0"),
+            ("Location", location),
+            CACHE_CONTROL,
+        ]
+
+    def _count(self, rule):
+        with self._lock:
+            self._counts[rule] += 1
+
+    def redirect(self, environ):
+        """(rule, headers) for a request to redirect, otherwise None"""
+        if self.canonical_hosts:
+            rval = self._canonical_redirect(environ)
+            if rval is not None:
+                return rval
+        if environ.get("REQUEST_METHOD") not in ("GET", "HEAD"):
+            return None
+        return self._www_redirect(environ.get("PATH_INFO", ""))
+
+    def _canonical_redirect(self, environ):
+        scheme, host = request_host(environ, self.canonical_hosts)
+        if host not in self.canonical_hosts:
+            host = self.default_host
+        elif scheme == "https":
+            return None
+        path = environ.get("SCRIPT_NAME", "") + environ.get("PATH_INFO", "")
+        location = "https://" + host + quote(path.encode("latin-1"), SAFE)
+        query = environ.get("QUERY_STRING")
+        if query:
+            location += "?" + quote(query.encode("latin-1"), SAFE)
+        return "canonical", self.headers(location)
+
+    def _www_redirect(self, path):
+        headers = self._pages.get(path)
+        if headers is not None:
+            return "page", headers
+        if path in self._reserved:
+            return None
+        first, _, rest = path[1:].partition("/")
+        if not first:
+            return None
+        if not rest:
+            return self._segment and ("page", self._segment)
+        prefix = self._prefixes.get(first)
+        if prefix is not None and "/" not in rest:
+            return "prefix", self.headers(prefix + quote(rest.encode("latin-1"), SAFE))
+        return None
+
+    def __call__(self, environ, start_response):
+        rval = self.redirect(environ)
+        if rval is None:
+            self._count("passed")
+            return self.app(environ, start_response)
+        rule, headers = rval
+        self._count(rule)
+        start_response(STATUS, list(headers))
+        return [b""]
+
+    def stats(self) -> dict:
+        with self._lock:
+            return dict(self._counts)
@@ -0,0 +1,252 @@
+"""Re-send receipt emails for charges in a date range or a list of charge ids
+
+Receipts are rebuilt with the same template data as the webhook handlers and
+sent by a pool of worker threads, rate limited to stay within SendGrid's
+quota. Every finished charge is appended to a checkpoint file, so an
+interrupted run picks up where it left off when started again with the same
+checkpoint. Charges that already have a receipt in the receipt log are
+skipped unless --force is given.
+
+    $ python resend_receipts.py --since 2019-10-01 --until 2019-10-08
+    $ python resend_receipts.py ch_1FxyZ... ch_1Fxz0...
+    $ python resend_receipts.py --charges-file ids.txt --rate 20 --workers 8
+"""
+import argparse
+import os
+import sys
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor
+
+import stripe
+from python_http_client import exceptions
+
+import application
+from ratelimit import TokenBucket
+from receipt_log import RECEIPT
+from reconcile import parse_date
+from resilience import backoff_delay
+
+__all__ = ["Checkpoint", "Resender", "receipt_for"]
+
+EXPAND = ["payment_intent", "invoice.subscription"]
+# Worth another attempt after a backoff
+RETRY_ERRORS = (
+    exceptions.TooManyRequestsError,
+    exceptions.InternalServerError,
+    exceptions.ServiceUnavailableError,
+    exceptions.GatewayTimeoutError,
+    OSError,
+)
+
+
+def iter_charges(charge_ids=None, since=None, until=None):
+    if charge_ids:
+        for charge_id in charge_ids:
+            yield application.stripe_cache.retrieve(
+                stripe.Charge, charge_id, expand=EXPAND
+            )
+        return
+    created = {"gte": since}
+    if until is not None:
+        created["lt"] = until
+    yield from stripe.Charge.list(
+        created=created, limit=100, expand=[f"data.{e}" for e in EXPAND]
+    ).auto_paging_iter()
+
+
+def receipt_for(charge):
+    """The receipt the webhook handlers would have sent for `charge`, if any"""
+    if not (charge.status == "succeeded" and charge.paid):
+        return None
+    if charge.invoice:
+        subscription = charge.invoice.subscription
+        metadata, message = (
+            subscription.metadata,
+            application.receipt_message(charge, subscription),
+        )
+    else:
+        payment_intent = charge.payment_intent
+        metadata = payment_intent.metadata if payment_intent else charge.metadata
+        message = application.receipt_message(charge)
+    if application.is_from_new_app(metadata):
+        return None
+    return message
+
+
+class Checkpoint:
+    """Charge ids that are done, one per line, so that a run can resume
+
+    >>> import os, tempfile
+    >>> path = os.path.join(tempfile.mkdtemp(), "resend.checkpoint")
+    >>> checkpoint = Checkpoint(path)
+    >>> checkpoint.add("ch_1")
+    >>> checkpoint.close()
+    >>> "ch_1" in Checkpoint(path), "ch_2" in Checkpoint(path)
+    (True, False)
+    """
+
+    def __init__(self, path):
+        self.path = path
+        self.done = set()
+        if os.path.exists(path):
+            with open(path) as f:
+                self.done.update(line.strip() for line in f if line.strip())
+        self._lock = threading.Lock()
+        self._file = open(path, "a")
+
+    def __contains__(self, charge_id):
+        return charge_id in self.done
+
+    def add(self, charge_id):
+        with self._lock:
+            self.done.add(charge_id)
+            self._file.write(charge_id + "\n")
+            self._file.flush()
+
+    def close(self):
+        self._file.close()
+
+
+class Resender:
+    """Sends one receipt per charge through `client`, at most `bucket.rate`/s"""
+
+    def __init__(
+        self, client, bucket, checkpoint, force=False, dry_run=False, max_attempts=5
+    ):
+        self.client = client
+        self.bucket = bucket
+        self.checkpoint = checkpoint
+        self.force = force
+        self.dry_run = dry_run
+        self.max_attempts = max_attempts
+        self._lock = threading.Lock()
+        self.counters = {
+            "sent": 0,
+            "skipped": 0,
+            "already_sent": 0,
+            "failed": 0,
+            "retries": 0,
+        }
+
+    def _count(self, name):
+        with self._lock:
+            self.counters[name] += 1
+
+    def _send(self, message):
+        for attempt in range(1, self.max_attempts + 1):
+            self.bucket.acquire()
+            try:
+                return self.client.send(message)
+            except RETRY_ERRORS:
+                if attempt == self.max_attempts:
+                    raise
+                self._count("retries")
+                time.sleep(backoff_delay(attempt, base=0.5, cap=30.0))
+
+    def resend(self, charge):
+        if charge.id in self.checkpoint:
+            return self._count("already_sent")
+        if not self.force and RECEIPT in application.receipt_log.kinds(charge.id):
+            self.checkpoint.add(charge.id)
+            return self._count("already_sent")
+        message = receipt_for(charge)
+        if message is None:
+            return self._count("skipped")
+        if self.dry_run:
+            return self._count("sent")
+        try:
+            self._send(message)
+        except Exception as e:
+            print(f"{charge.id}: {e!r}", file=sys.stderr)
+            return self._count("failed")
+        application.log_receipt(RECEIPT, charge)
+        self.checkpoint.add(charge.id)
+        self._count("sent")
+
+    def run(self, charges, workers):
+        """Resend receipts for `charges`, keeping at most a few per worker queued"""
+        slots = threading.BoundedSemaphore(workers * 4)
+
+        def task(charge):
+            try:
+                self.resend(charge)
+            except Exception as e:
+                print(f"{charge.id}: {e!r}", file=sys.stderr)
+                self._count("failed")
+            finally:
+                slots.release()
+
+        with ThreadPoolExecutor(workers, thread_name_prefix="resend") as executor:
+            for charge in charges:
+                slots.acquire()
+                executor.submit(task, charge)
+
+    def report(self, elapsed):
+        with self._lock:
+            counters = dict(self.counters)
+        done = sum(counters.values()) - counters["retries"]
+        return (
+            f"{done} charges in {elapsed:.1f}s ({done / max(elapsed, 1e-9):.1f}/s, "
+            f"{counters['sent'] / max(elapsed, 1e-9):.1f} sends/s): "
+            + ", ".join(f"{k} {v}" for k, v in counters.items())
+        )
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description=__doc__.split("\n", 1)[0])
+    parser.add_argument("charges", nargs="*", help="charge ids")
+    parser.add_argument("--charges-file", help="file of charge ids, one per line")
+    parser.add_argument("--since", help="YYYY-MM-DD, charges created on or after")
+    parser.add_argument("--until", help="YYYY-MM-DD, exclusive")
+    parser.add_argument("--rate", type=float, default=10, help="sends per second")
+    parser.add_argument("--burst", type=float, help="token bucket size (--rate)")
+    parser.add_argument("--workers", type=int, default=8)
+    parser.add_argument(
+        "--checkpoint",
+        default=os.path.join(application.app.instance_path, "resend_receipts.done"),
+    )
+    parser.add_argument("--force", action="store_true", help="ignore the receipt log")
+    parser.add_argument("--dry-run", action="store_true")
+    args = parser.parse_args(argv)
+
+    charge_ids = list(args.charges)
+    if args.charges_file:
+        with open(args.charges_file) as f:
+            charge_ids.extend(line.strip() for line in f if line.strip())
+    if not charge_ids and not args.since:
+        parser.error("pass charge ids, --charges-file or --since")
+
+    os.makedirs(os.path.dirname(os.path.abspath(args.checkpoint)), exist_ok=True)
+    checkpoint = Checkpoint(args.checkpoint)
+    resender = Resender(
+        application.sendgrid_client,
+        TokenBucket(args.rate, args.burst),
+        checkpoint,
+        force=args.force,
+        dry_run=args.dry_run,
+    )
+    charges = iter_charges(
+        charge_ids,
+        since=args.since and parse_date(args.since),
+        until=args.until and parse_date(args.until),
+    )
+    start = time.perf_counter()
+    finished = threading.Event()
+
+    def progress():
+        while not finished.wait(5):
+            print(resender.report(time.perf_counter() - start), file=sys.stderr)
+
+    threading.Thread(target=progress, daemon=True).start()
+    try:
+        resender.run(charges, args.workers)
+    finally:
+        finished.set()
+        checkpoint.close()
+        print(resender.report(time.perf_counter() - start))
+    return 1 if resender.counters["failed"] else 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
@@ -0,0 +1,201 @@
+"""Circuit breakers, request time budgets and jittered retries for upstream calls
+
+"""
+import random
+import threading
+import time
+
+__all__ = [
+    "BudgetExhausted",
+    "CircuitBreaker",
+    "backoff_delay",
+    "budgeted_timeout",
+    "clear_budget",
+    "retry_call",
+    "set_budget",
+]
+
+CLOSED = "closed"
+OPEN = "open"
+HALF_OPEN = "half_open"
+
+
+class CircuitBreaker:
+    """Stops calling an upstream after `failure_threshold` consecutive failures
+
+    While open every call is rejected without waiting on the upstream. After
+    `reset_timeout` seconds a single probe is let through (half open), and
+    its outcome closes or re-opens the breaker. Callers must `record` an
+    outcome for every call `allow` lets through, including ones that end in
+    an unexpected exception. A probe that hasn't after another
+    `reset_timeout` seconds is given up on and the next call probes instead.
+
+    >>> now = [0.0]
+    >>> breaker = CircuitBreaker("stripe", failure_threshold=2, reset_timeout=10,
+    ...                          clock=lambda: now[0])
+    >>> for _ in range(2):
+    ...     breaker.allow() and breaker.record(ok=False)
+    >>> breaker.state, breaker.allow()
+    ('open', False)
+    >>> now[0] = 10.0
+    >>> breaker.allow(), breaker.allow()
+    (True, False)
+    >>> breaker.record(ok=True)
+    >>> breaker.state
+    'closed'
+    >>> stats = breaker.stats()
+    >>> stats["trips"], stats["rejected"]
+    (1, 2)
+    >>> for _ in range(2):
+    ...     breaker.allow() and breaker.record(ok=False)
+    >>> now[0] = 20.0
+    >>> breaker.allow(), breaker.allow()
+    (True, False)
+    >>> now[0] = 30.0
+    >>> breaker.allow()
+    True
+    """
+
+    def __init__(
+        self, name, failure_threshold=5, reset_timeout=30.0, clock=time.monotonic
+    ):
+        self.name = name
+        self.failure_threshold = failure_threshold
+        self.reset_timeout = reset_timeout
+        self.clock = clock
+        self.state = CLOSED
+        self.consecutive_failures = 0
+        self.opened_at = None
+        self._probing = False
+        self._probe_started = None
+        self._lock = threading.Lock()
+        self.counters = {"successes": 0, "failures": 0, "rejected": 0, "trips": 0}
+
+    def allow(self) -> bool:
+        with self._lock:
+            if self.state == CLOSED:
+                return True
+            if self.state == OPEN:
+                if self.clock() - self.opened_at < self.reset_timeout:
+                    self.counters["rejected"] += 1
+                    return False
+                self.state = HALF_OPEN
+                self._probing = False
+            now = self.clock()
+            if self._probing and now - self._probe_started < self.reset_timeout:
+                self.counters["rejected"] += 1
+                return False
+            self._probing = True
+            self._probe_started = now
+            return True
+
+    def record(self, ok: bool) -> None:
+        with self._lock:
+            self._probing = False
+            if ok:
+                self.counters["successes"] += 1
+                self.consecutive_failures = 0
+                self.state = CLOSED
+                return
+            self.counters["failures"] += 1
+            self.consecutive_failures += 1
+            if (
+                self.state == HALF_OPEN
+                or self.consecutive_failures >= self.failure_threshold
+            ):
+                if self.state != OPEN:
+                    self.counters["trips"] += 1
+                self.state = OPEN
+                self.opened_at = self.clock()
+
+    def stats(self) -> dict:
+        with self._lock:
+            rval = dict(self.counters)
+            rval["state"] = self.state
+            rval["consecutive_failures"] = self.consecutive_failures
+        return rval
+
+
+def backoff_delay(attempts, base=1.0, cap=300.0, rand=random.random):
+    """Full-jitter exponential backoff in seconds after `attempts` failures
+
+    >>> backoff_delay(1, rand=lambda: 1.0)
+    2.0
+    >>> backoff_delay(20, rand=lambda: 1.0)
+    300.0
+    >>> backoff_delay(3, rand=lambda: 0.0)
+    0.0
+    """
+    return min(cap, base * 2 ** attempts) * rand()
+
+
+class BudgetExhausted(TimeoutError):
+    pass
+
+
+_budget = threading.local()
+
+
+def set_budget(seconds: float) -> None:
+    """Give upstream calls on this thread `seconds` in total, e.g. per request"""
+    _budget.deadline = time.monotonic() + seconds
+
+
+def clear_budget() -> None:
+    _budget.deadline = None
+
+
+def remaining_budget():
+    deadline = getattr(_budget, "deadline", None)
+    return None if deadline is None else deadline - time.monotonic()
+
+
+def budgeted_timeout(timeout):
+    """`timeout` capped to what is left of this thread's budget
+
+    >>> budgeted_timeout(30)
+    30
+    >>> set_budget(5)
+    >>> budgeted_timeout(30) <= 5
+    True
+    >>> set_budget(0)
+    >>> budgeted_timeout(30)
+    Traceback (most recent call last):
+      ...
+    resilience.BudgetExhausted: request time budget exhausted
+    >>> clear_budget()
+    """
+    remaining = remaining_budget()
+    if remaining is None:
+        return timeout
+    if remaining <= 0:
+        raise BudgetExhausted("request time budget exhausted")
+    return remaining if timeout is None else min(timeout, remaining)
+
+
+def retry_call(fn, retryable, attempts=3, base=0.1, cap=2.0, sleep=time.sleep):
+    """Call `fn`, retrying with jittered backoff while `retryable(error)`
+
+    Only use this for idempotent calls. No retry is started that would
+    sleep past this thread's budget.
+
+    >>> calls = []
+    >>> def flaky():
+    ...     calls.append(1)
+    ...     if len(calls) < 3:
+    ...         raise ConnectionError()
+    ...     return "ok"
+    >>> retry_call(flaky, lambda e: True, sleep=lambda s: None), len(calls)
+    ('ok', 3)
+    """
+    for attempt in range(1, attempts + 1):
+        try:
+            return fn()
+        except Exception as e:
+            if attempt == attempts or not retryable(e):
+                raise
+            delay = backoff_delay(attempt, base=base, cap=cap)
+            remaining = remaining_budget()
+            if remaining is not None and remaining <= delay:
+                raise
+            sleep(delay)
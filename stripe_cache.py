@@ -0,0 +1,222 @@
+"""Read-through cache for expanded Stripe object retrieves
+
+"""
+import json
+import threading
+import time
+import uuid
+
+import stripe
+
+from cache_backends import CacheError, MemoryBackend, TieredCache
+from caching import LRUCache
+from resilience import retry_call
+
+__all__ = ["StripeCache", "dumps_entry", "loads_entry", "related_objects"]
+
+
+def dumps_entry(entry) -> bytes:
+    """Serialize (fetched_at, Stripe object) for a shared cache tier
+
+    >>> data = dumps_entry((1571000000.0, stripe.Invoice.construct_from(
+    ...     {'id': 'in_1', 'object': 'invoice', 'subscription': {
+    ...         'id': 'sub_1', 'object': 'subscription'}}, 'sk_test')))
+    >>> fetched_at, invoice = loads_entry(data)
+    >>> fetched_at, type(invoice).__name__, type(invoice.subscription).__name__
+    (1571000000.0, 'Invoice', 'Subscription')
+    """
+    return json.dumps(entry, separators=(",", ":")).encode("utf-8")
+
+
+def loads_entry(data: bytes):
+    fetched_at, obj = json.loads(data.decode("utf-8"))
+    return fetched_at, stripe.util.convert_to_stripe_object(obj)
+
+
+def related_objects(obj):
+    """The (object type, id) pairs whose cached copies `obj` makes stale
+
+    >>> related_objects({'object': 'invoice', 'id': 'in_1', 'subscription': 'sub_1'})
+    [('invoice', 'in_1'), ('subscription', 'sub_1')]
+    >>> related_objects({'object': 'checkout.session', 'id': 'cs_1'})
+    [('checkout.session', 'cs_1')]
+    """
+    rval = [(obj["object"], obj["id"])]
+    for name in ("subscription", "payment_intent", "invoice"):
+        related = obj.get(name)
+        if isinstance(related, str):
+            rval.append((name, related))
+        elif related is not None and "id" in related:
+            rval.append((name, related["id"]))
+    return rval
+
+
+def retryable(e):
+    """Whether a failed retrieve is worth retrying
+
+    >>> retryable(stripe.error.APIError("boom", http_status=503))
+    True
+    >>> retryable(stripe.error.InvalidRequestError("no such invoice", "id"))
+    False
+    """
+    if isinstance(e, stripe.error.APIConnectionError):
+        return getattr(e, "should_retry", False)
+    return isinstance(e, (stripe.error.APIError, stripe.error.RateLimitError))
+
+
+def unavailable(e):
+    """Whether an error means Stripe couldn't answer, rather than said no"""
+    return isinstance(
+        e,
+        (
+            stripe.error.APIConnectionError,
+            stripe.error.APIError,
+            stripe.error.RateLimitError,
+        ),
+    )
+
+
+class StripeCache:
+    """Cache `resource.retrieve(id, expand=...)` by (object type, id, expand set)
+
+    Each expand variant is cached under its own key, which includes a
+    generation stored under the object's key. `invalidate` deletes the
+    generation when a webhook event says the object has changed, so every
+    variant cached under it is orphaned with one delete, including one
+    written by a retrieve that was already in flight. Entries live for at
+    most `ttl` seconds. With a `shared` backend (see cache_backends) other
+    workers and instances reuse each other's retrieves, and invalidations
+    reach them too, except for generations in their own memory tier, which
+    are capped at `local_ttl`.
+
+    Misses are retried with jittered backoff on connection and server errors.
+    The last copy of every object is also kept (up to `maxsize`) so that
+    callers passing `allow_stale=True` get it when Stripe is unreachable.
+    Entries carry the time they were fetched, and `stats` reports the mean
+    and maximum age of the copies served from the cache.
+
+    >>> class Invoice:
+    ...     OBJECT_NAME = "invoice"
+    ...     version = 0
+    ...     @classmethod
+    ...     def retrieve(cls, id, expand=()):
+    ...         cls.version += 1
+    ...         if cls.version == 1:
+    ...             # A webhook for the invoice arrives during the retrieve
+    ...             cache.invalidate("invoice", id)
+    ...         return {"id": id, "version": cls.version}
+    >>> cache = StripeCache()
+    >>> [cache.retrieve(Invoice, "in_1")["version"] for _ in range(3)]
+    [1, 2, 2]
+    >>> stats = cache.stats()
+    >>> stats["served"], stats["max_age"] < stats["ttl"]
+    (1, True)
+    """
+
+    def __init__(
+        self,
+        maxsize: int = 1024,
+        ttl: float = 300.0,
+        attempts: int = 3,
+        shared=None,
+        local_ttl: float = 10.0,
+        clock=time.time,
+    ):
+        tiers = [("memory", MemoryBackend(maxsize, local_ttl if shared else None))]
+        if shared is not None:
+            tiers.append(("shared", shared))
+        self.cache = TieredCache(tiers, ttl=ttl, dumps=dumps_entry, loads=loads_entry)
+        self.ttl = ttl
+        # Wall clock time, since entries in a shared tier come from other hosts
+        self.clock = clock
+        # The same backends, counted separately from object hits and misses
+        self.generations = TieredCache(
+            tiers,
+            ttl=ttl,
+            dumps=lambda generation: generation.encode("ascii"),
+            loads=lambda data: data.decode("ascii"),
+        )
+        self.stale = LRUCache(maxsize)
+        self.attempts = attempts
+        self._lock = threading.Lock()
+        self.counters = {"retrieve_errors": 0, "stale_served": 0}
+        self.served = 0
+        self.total_age = 0.0
+        self.max_age = 0.0
+
+    def _count(self, name):
+        with self._lock:
+            self.counters[name] += 1
+
+    def _served(self, fetched_at):
+        age = max(0.0, self.clock() - fetched_at)
+        with self._lock:
+            self.served += 1
+            self.total_age += age
+            if age > self.max_age:
+                self.max_age = age
+
+    def _generation(self, object_key):
+        generation = self.generations.get(object_key)
+        if generation is None:
+            generation = uuid.uuid4().hex
+            try:
+                if not self.generations.add(object_key, generation):
+                    # Another worker started one first
+                    generation = self.generations.get(object_key, generation)
+            except CacheError:
+                self.generations.set(object_key, generation)
+        return generation
+
+    def retrieve(self, resource, id, expand=(), allow_stale=False):
+        object_key = f"stripe:{resource.OBJECT_NAME}:{id}"
+        variant = ",".join(sorted(expand))
+        # Read before the retrieve, so an invalidation during it orphans the
+        # result instead of it replacing the invalidated copy
+        key = f"{object_key}:{self._generation(object_key)}:{variant}"
+        entry = self.cache.get(key)
+        if entry is not None:
+            fetched_at, obj = entry
+            self._served(fetched_at)
+        else:
+            try:
+                obj = retry_call(
+                    lambda: resource.retrieve(id, expand=list(expand)),
+                    retryable,
+                    attempts=self.attempts,
+                )
+            except stripe.error.StripeError as e:
+                self._count("retrieve_errors")
+                obj = None
+                if allow_stale and unavailable(e):
+                    obj = self.stale.get((object_key, variant))
+                if obj is None:
+                    raise
+                self._count("stale_served")
+                return obj
+            self.cache.set(key, (self.clock(), obj))
+            self.stale.set((object_key, variant), obj)
+        return obj
+
+    def invalidate(self, object_name: str, id: str) -> None:
+        self.generations.delete(f"stripe:{object_name}:{id}")
+
+    def invalidate_event_object(self, obj) -> None:
+        for object_name, id in related_objects(obj):
+            self.invalidate(object_name, id)
+
+    def stats(self) -> dict:
+        rval = self.cache.stats()
+        rval["generations"] = self.generations.stats()["tiers"]
+        with self._lock:
+            rval.update(self.counters)
+            rval.update(
+                {
+                    "ttl": self.ttl,
+                    "served": self.served,
+                    "mean_age": self.total_age / self.served if self.served else 0.0,
+                    "max_age": self.max_age,
+                }
+            )
+        rval["stale_size"] = len(self.stale)
+        return rval
@@ -0,0 +1,157 @@
+"""Buffered Application Insights events sent from a background thread
+
+"""
+import os
+import threading
+import time
+from collections import deque
+
+__all__ = ["TelemetrySink"]
+
+
+class TelemetrySink:
+    """A bounded ring buffer of custom events flushed off the request path
+
+    `track_event` never blocks on the telemetry client: events are appended
+    to a buffer of at most `capacity` entries and a daemon thread hands them
+    to the client in batches of `batch_size`, or every `flush_interval`
+    seconds. When the buffer is full the oldest event is dropped and counted.
+    An event's `on_sent()` is called once the client has flushed it, never
+    for an event that was dropped or failed.
+
+    >>> class FakeClient:
+    ...     def __init__(self):
+    ...         self.events, self.flushes = [], 0
+    ...     def track_event(self, name, properties=None, measurements=None):
+    ...         self.events.append((name, properties["id"]))
+    ...     def flush(self):
+    ...         self.flushes += 1
+    >>> client = FakeClient()
+    >>> sink = TelemetrySink(lambda: client, capacity=2, flush_interval=60)
+    >>> sent = []
+    >>> for i in range(3):
+    ...     sink.track_event("Donation", {"id": i}, {"amount": 100},
+    ...                      on_sent=lambda i=i: sent.append(i))
+    >>> sink.flush()
+    >>> client.events, client.flushes, sent
+    ([('Donation', 1), ('Donation', 2)], 1, [1, 2])
+    >>> stats = sink.stats()
+    >>> stats["sent"], stats["dropped"], stats["pending"]
+    (2, 1, 0)
+    >>> sink.stop()
+    """
+
+    def __init__(self, get_client, capacity=10000, batch_size=100, flush_interval=5.0):
+        self.get_client = get_client
+        self.capacity = capacity
+        self.batch_size = batch_size
+        self.flush_interval = flush_interval
+        self._cond = threading.Condition()
+        self._buffer = deque(maxlen=capacity)
+        # Serializes batches between the worker and explicit flushes
+        self._send_lock = threading.Lock()
+        self._pid = None
+        self._stopping = False
+        self._thread = None
+        self.counters = {
+            "queued": 0,
+            "sent": 0,
+            "dropped": 0,
+            "failed": 0,
+            "batches": 0,
+            "callback_errors": 0,
+        }
+
+    def track_event(
+        self, name, properties=None, measurements=None, on_sent=None
+    ) -> None:
+        self._start()
+        with self._cond:
+            if len(self._buffer) == self.capacity:
+                self.counters["dropped"] += 1
+            self._buffer.append((name, properties, measurements, on_sent))
+            self.counters["queued"] += 1
+            if len(self._buffer) >= self.batch_size:
+                self._cond.notify()
+
+    def _start(self):
+        if self._pid == os.getpid():
+            return
+        with self._cond:
+            if self._pid == os.getpid():
+                return
+            self._buffer.clear()
+            self._stopping = False
+            self._thread = threading.Thread(
+                target=self._run, name="telemetry-sink", daemon=True
+            )
+            self._thread.start()
+            self._pid = os.getpid()
+
+    def _take(self):
+        with self._cond:
+            n = min(len(self._buffer), self.batch_size)
+            return [self._buffer.popleft() for _ in range(n)]
+
+    def _send(self, batch) -> None:
+        client = self.get_client()
+        if client is None:
+            return
+        with self._send_lock:
+            try:
+                for name, properties, measurements, _ in batch:
+                    client.track_event(name, properties, measurements)
+                client.flush()
+            except Exception:
+                with self._cond:
+                    self.counters["failed"] += len(batch)
+                return
+        with self._cond:
+            self.counters["sent"] += len(batch)
+            self.counters["batches"] += 1
+        for _, _, _, on_sent in batch:
+            if on_sent is not None:
+                try:
+                    on_sent()
+                except Exception:
+                    with self._cond:
+                        self.counters["callback_errors"] += 1
+
+    def _run(self):
+        deadline = time.monotonic() + self.flush_interval
+        while True:
+            with self._cond:
+                while (
+                    len(self._buffer) < self.batch_size
+                    and not self._stopping
+                    and time.monotonic() < deadline
+                ):
+                    self._cond.wait(max(0.0, deadline - time.monotonic()))
+                stopping = self._stopping
+            self.flush()
+            deadline = time.monotonic() + self.flush_interval
+            if stopping:
+                return
+
+    def flush(self) -> None:
+        """Send everything buffered so far on the calling thread"""
+        while True:
+            batch = self._take()
+            if not batch:
+                return
+            self._send(batch)
+
+    def stop(self, timeout=None) -> None:
+        """Drain the buffer and stop the background thread"""
+        with self._cond:
+            self._stopping = True
+            self._cond.notify()
+        if self._thread is not None and self._pid == os.getpid():
+            self._thread.join(timeout)
+        self._pid = None
+
+    def stats(self) -> dict:
+        with self._cond:
+            rval = dict(self.counters)
+            rval["pending"] = len(self._buffer)
+        return rval
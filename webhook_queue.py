@@ -0,0 +1,482 @@
+"""Durable SQLite-backed work queue for verified Stripe webhook events
+
+The webhook endpoint enqueues the raw event payload and acknowledges Stripe
+immediately; a small pool of worker threads then runs the (slow) handlers
+with exponential backoff between attempts. Jobs that use up their attempts
+are kept as `dead` until they are put back in the queue:
+
+    $ python webhook_queue.py dead
+    $ python webhook_queue.py requeue [event_id ...]
+"""
+import argparse
+import collections
+import inspect
+import os
+import sqlite3
+import threading
+import time
+import sys
+import traceback
+from typing import Callable, Dict, Optional
+
+from resilience import backoff_delay
+
+__all__ = ["WebhookQueue"]
+
+# With full jitter, 25 attempts take about two days on average, in the same
+# range as the three days Stripe keeps retrying a failed delivery
+DEFAULT_MAX_ATTEMPTS = 25
+DEFAULT_RETRY_BASE = 60.0
+DEFAULT_RETRY_CAP = 6 * 60 * 60.0
+
+SCHEMA = """
+CREATE TABLE IF NOT EXISTS webhook_jobs (
+    id INTEGER PRIMARY KEY AUTOINCREMENT,
+    event_id TEXT NOT NULL,
+    event_type TEXT NOT NULL,
+    payload TEXT NOT NULL,
+    state TEXT NOT NULL DEFAULT 'pending',
+    attempts INTEGER NOT NULL DEFAULT 0,
+    enqueued_at REAL NOT NULL,
+    available_at REAL NOT NULL,
+    last_error TEXT
+);
+CREATE INDEX IF NOT EXISTS webhook_jobs_ready
+    ON webhook_jobs (state, available_at);
+"""
+
+
+class StageTimer:
+    """Running count/total/max of a latency measurement in seconds"""
+
+    __slots__ = ("count", "total", "max")
+
+    def __init__(self):
+        self.count = 0
+        self.total = 0.0
+        self.max = 0.0
+
+    def add(self, seconds):
+        self.count += 1
+        self.total += seconds
+        if seconds > self.max:
+            self.max = seconds
+
+    def as_dict(self):
+        return {
+            "count": self.count,
+            "mean_ms": 1000 * self.total / self.count if self.count else 0.0,
+            "max_ms": 1000 * self.max,
+        }
+
+
+class Job:
+    __slots__ = ("id", "event_id", "event_type", "attempts", "start", "steps")
+
+    def __init__(self, id, event_id, event_type, attempts):
+        self.id = id
+        self.event_id = event_id
+        self.event_type = event_type
+        self.attempts = attempts
+        self.start = time.perf_counter()
+        self.steps = None
+
+
+class WebhookQueue:
+    """A persistent queue of webhook events processed by background threads
+
+    `handler(event_type, payload)` is called for each job; any exception
+    schedules a retry after `backoff_delay(attempts, retry_base, retry_cap)`
+    seconds until `max_attempts` is reached, after which the job is kept in
+    the `dead` state for inspection and `requeue`. Jobs are claimed with a
+    lease so that several processes can safely share one database file and
+    jobs abandoned by a crashed worker are picked up again. Claiming a job
+    counts as an attempt, so a job that keeps killing its worker is also
+    dead once it runs out of attempts. `on_dead(event_id)` is called for
+    every job that becomes dead.
+
+    A handler that is a generator can yield a `concurrent.futures.Future`
+    to wait for it without holding a worker. The job is set aside and the
+    worker moves on to other jobs, until the future is done and a worker
+    resumes the generator with its result (or raises its exception in it).
+    At most `max_suspended` jobs are set aside at once. This lets more jobs
+    than there are workers share one batch of emails:
+
+    >>> import tempfile
+    >>> from email_batcher import EmailBatcher
+    >>> class FakeClient:
+    ...     sent = []
+    ...     def send(self, message):
+    ...         self.sent.append(len(message['personalizations']))
+    ...         return 202
+    >>> client = FakeClient()
+    >>> batcher = EmailBatcher(client, max_delay=0.2)
+    >>> def handler(event_type, payload):
+    ...     yield batcher.submit(
+    ...         {'template_id': 'd-1', 'personalizations': [{'to': payload}]})
+    >>> queue = WebhookQueue(
+    ...     os.path.join(tempfile.mkdtemp(), 'webhooks.sqlite3'), handler,
+    ...     workers=2)
+    >>> for i in range(10):
+    ...     queue.enqueue(f'evt_{i}', 'invoice.payment_succeeded', f'donor{i}')
+    >>> while queue.stats()['counters']['succeeded'] < 10:
+    ...     time.sleep(0.01)
+    >>> client.sent
+    [10]
+    >>> queue.stop(); batcher.stop()
+    """
+
+    def __init__(
+        self,
+        path: str,
+        handler: Callable[[str, str], None],
+        workers: int = 4,
+        max_attempts: int = DEFAULT_MAX_ATTEMPTS,
+        retry_base: float = DEFAULT_RETRY_BASE,
+        retry_cap: float = DEFAULT_RETRY_CAP,
+        lease_seconds: float = 300.0,
+        poll_interval: float = 1.0,
+        logger=None,
+        max_suspended: int = 1000,
+        on_dead: Optional[Callable[[str], None]] = None,
+    ):
+        self.path = path
+        self.handler = handler
+        self.workers = workers
+        self.max_attempts = max_attempts
+        self.retry_base = retry_base
+        self.retry_cap = retry_cap
+        self.lease_seconds = lease_seconds
+        self.poll_interval = poll_interval
+        self.logger = logger
+        self.max_suspended = max_suspended
+        self.on_dead = on_dead
+        self._local = threading.local()
+        self._wakeup = threading.Condition()
+        # Set aside jobs, and those whose future is done as (job, future)
+        self._suspended = 0
+        self._resumable = collections.deque()
+        self._stopping = threading.Event()
+        self._threads = []
+        self._pid = None
+        self._stats_lock = threading.Lock()
+        self._stages: Dict[str, StageTimer] = {}
+        self._counters = {"enqueued": 0, "succeeded": 0, "retried": 0, "dead": 0}
+        directory = os.path.dirname(os.path.abspath(path))
+        os.makedirs(directory, exist_ok=True)
+        self._connection().executescript(SCHEMA)
+
+    def _connection(self) -> sqlite3.Connection:
+        conn = getattr(self._local, "conn", None)
+        if conn is None or getattr(self._local, "pid", None) != os.getpid():
+            conn = sqlite3.connect(self.path, timeout=30, isolation_level=None)
+            conn.execute("PRAGMA journal_mode=WAL")
+            conn.execute("PRAGMA synchronous=NORMAL")
+            self._local.conn = conn
+            self._local.pid = os.getpid()
+        return conn
+
+    def _log(self, msg):
+        if self.logger is not None:
+            self.logger.warning(msg)
+        else:
+            print(msg)
+
+    def _record(self, stage, event_type, seconds):
+        with self._stats_lock:
+            for key in (stage, f"{stage}:{event_type}"):
+                timer = self._stages.get(key)
+                if timer is None:
+                    timer = self._stages[key] = StageTimer()
+                timer.add(seconds)
+
+    def _count(self, name):
+        with self._stats_lock:
+            self._counters[name] += 1
+
+    def enqueue(self, event_id: str, event_type: str, payload: str) -> None:
+        start = time.perf_counter()
+        now = time.time()
+        self._connection().execute(
+            "INSERT INTO webhook_jobs"
+            " (event_id, event_type, payload, enqueued_at, available_at)"
+            " VALUES (?, ?, ?, ?, ?)",
+            (event_id, event_type, payload, now, now),
+        )
+        self._count("enqueued")
+        self._record("enqueue", event_type, time.perf_counter() - start)
+        self.start()
+        with self._wakeup:
+            self._wakeup.notify()
+
+    def _claim(self):
+        conn = self._connection()
+        now = time.time()
+        dead = []
+        conn.execute("BEGIN IMMEDIATE")
+        try:
+            while True:
+                row = conn.execute(
+                    "SELECT id, event_id, event_type, payload, attempts, enqueued_at"
+                    " FROM webhook_jobs"
+                    " WHERE state IN ('pending', 'running') AND available_at <= ?"
+                    " ORDER BY available_at LIMIT 1",
+                    (now,),
+                ).fetchone()
+                if row is None or row[4] < self.max_attempts:
+                    break
+                # Its last attempt never finished, e.g. the worker was killed
+                conn.execute(
+                    "UPDATE webhook_jobs SET state = 'dead', last_error ="
+                    " coalesce(last_error, '') || ? WHERE id = ?",
+                    (f"\nlease expired on attempt {row[4]}", row[0]),
+                )
+                dead.append(row[1])
+            if row is not None:
+                conn.execute(
+                    "UPDATE webhook_jobs SET state = 'running', available_at = ?,"
+                    " attempts = attempts + 1 WHERE id = ?",
+                    (now + self.lease_seconds, row[0]),
+                )
+            conn.execute("COMMIT")
+        except BaseException:
+            conn.execute("ROLLBACK")
+            raise
+        for event_id in dead:
+            self._dead(event_id)
+        return row
+
+    def _complete(self, job_id):
+        self._connection().execute("DELETE FROM webhook_jobs WHERE id = ?", (job_id,))
+
+    def _dead(self, event_id):
+        self._count("dead")
+        if self.on_dead is not None:
+            try:
+                self.on_dead(event_id)
+            except Exception as e:
+                self._log(f"webhook {event_id} on_dead failed: {e!r}")
+
+    def _fail(self, job, error):
+        if job.attempts >= self.max_attempts:
+            self._connection().execute(
+                "UPDATE webhook_jobs SET state = 'dead', last_error = ? WHERE id = ?",
+                (error, job.id),
+            )
+            self._dead(job.event_id)
+        else:
+            delay = backoff_delay(
+                job.attempts, base=self.retry_base, cap=self.retry_cap
+            )
+            self._connection().execute(
+                "UPDATE webhook_jobs SET state = 'pending',"
+                " available_at = ?, last_error = ? WHERE id = ?",
+                (time.time() + delay, error, job.id),
+            )
+            self._count("retried")
+
+    def dead(self):
+        """(event_id, event_type, attempts, last_error) for every dead job"""
+        return self._connection().execute(
+            "SELECT event_id, event_type, attempts, last_error FROM webhook_jobs"
+            " WHERE state = 'dead' ORDER BY id"
+        )
+
+    def requeue(self, event_ids=None) -> int:
+        """Put dead jobs (all of them, or those for `event_ids`) back in the
+        queue with no attempts used, returning how many there were
+
+        A job whose worker dies every time is dead after `max_attempts`
+        claims, here with leases that expire at once:
+
+        >>> import tempfile
+        >>> queue = WebhookQueue(
+        ...     os.path.join(tempfile.mkdtemp(), 'webhooks.sqlite3'), None,
+        ...     max_attempts=2, lease_seconds=0, on_dead=print)
+        >>> _ = queue._connection().execute(
+        ...     "INSERT INTO webhook_jobs (event_id, event_type, payload,"
+        ...     " enqueued_at, available_at) VALUES ('evt_1', 'x', '', 0, 0)")
+        >>> [queue._claim() is not None for _ in range(3)]
+        evt_1
+        [True, True, False]
+        >>> [row[:3] for row in queue.dead()]
+        [('evt_1', 'x', 2)]
+        >>> queue.requeue(['evt_1']), queue.depth()
+        (1, {'pending': 1, 'running': 0, 'dead': 0})
+        """
+        query = (
+            "UPDATE webhook_jobs SET state = 'pending', attempts = 0,"
+            " available_at = ? WHERE state = 'dead'"
+        )
+        params = [time.time()]
+        if event_ids:
+            query += " AND event_id IN ({})".format(",".join("?" * len(event_ids)))
+            params.extend(event_ids)
+        count = self._connection().execute(query, params).rowcount
+        with self._wakeup:
+            self._wakeup.notify_all()
+        return count
+
+    def run_once(self) -> bool:
+        """Resume a set aside job whose future is done, or else process a
+        single ready job, returning False if there was neither
+        """
+        with self._wakeup:
+            if self._resumable:
+                job, future = self._resumable.popleft()
+                self._suspended -= 1
+            else:
+                job = None
+        if job is not None:
+            error = future.exception()
+            self._step(job, None if error else future.result(), error)
+            return True
+        if self._stopping.is_set() or self._suspended >= self.max_suspended:
+            return False
+        row = self._claim()
+        if row is None:
+            return False
+        job_id, event_id, event_type, payload, attempts, enqueued_at = row
+        if attempts == 0:
+            self._record("wait", event_type, time.time() - enqueued_at)
+        job = Job(job_id, event_id, event_type, attempts + 1)
+        self._step(job, payload)
+        return True
+
+    def _advance(self, job, value, error):
+        """The next future `job`'s handler yields, or None once it returns"""
+        try:
+            if job.steps is None:
+                job.steps = self.handler(job.event_type, value)
+                if not inspect.isgenerator(job.steps):
+                    return None
+                return next(job.steps)
+            if error is not None:
+                return job.steps.throw(error)
+            return job.steps.send(value)
+        except StopIteration:
+            return None
+
+    def _step(self, job, value, error=None):
+        """Run `job`'s handler until it finishes or yields a future"""
+        try:
+            future = self._advance(job, value, error)
+        except Exception:
+            error = traceback.format_exc()
+            self._log(f"webhook {job.event_id} ({job.event_type}) failed: {error}")
+            self._fail(job, error)
+        else:
+            if future is not None:
+                with self._wakeup:
+                    self._suspended += 1
+                future.add_done_callback(lambda f: self._resume(job, f))
+                return
+            self._complete(job.id)
+            self._count("succeeded")
+        self._record("handle", job.event_type, time.perf_counter() - job.start)
+
+    def _resume(self, job, future):
+        with self._wakeup:
+            self._resumable.append((job, future))
+            self._wakeup.notify()
+
+    def _worker(self):
+        # Jobs that were set aside are finished before stopping, so that
+        # they aren't handled again once their lease runs out
+        while not self._stopping.is_set() or self._suspended:
+            try:
+                if self.run_once():
+                    continue
+            except sqlite3.Error as e:
+                self._log(f"webhook queue error: {e!r}")
+            with self._wakeup:
+                self._wakeup.wait(self.poll_interval)
+
+    def start(self) -> None:
+        """Start the worker threads once per process (safe after fork)"""
+        if self._pid == os.getpid():
+            return
+        with self._wakeup:
+            if self._pid == os.getpid():
+                return
+            self._stopping.clear()
+            self._threads = [
+                threading.Thread(
+                    target=self._worker, name=f"webhook-worker-{i}", daemon=True
+                )
+                for i in range(self.workers)
+            ]
+            for t in self._threads:
+                t.start()
+            self._pid = os.getpid()
+
+    def stop(self, timeout: Optional[float] = None) -> None:
+        """Let in-flight and set aside jobs finish and stop the worker threads
+        """
+        self._stopping.set()
+        with self._wakeup:
+            self._wakeup.notify_all()
+        for t in self._threads:
+            t.join(timeout)
+        self._threads = []
+        self._pid = None
+
+    def depth(self) -> Dict[str, int]:
+        rows = (
+            self._connection()
+            .execute("SELECT state, COUNT(*) FROM webhook_jobs GROUP BY state")
+            .fetchall()
+        )
+        return merge_counts({"pending": 0, "running": 0, "dead": 0}, rows)
+
+    def stats(self) -> dict:
+        with self._stats_lock:
+            stages = {k: v.as_dict() for k, v in self._stages.items()}
+            counters = dict(self._counters)
+        with self._wakeup:
+            counters["suspended"] = self._suspended
+        return {"depth": self.depth(), "counters": counters, "latency": stages}
+
+
+def merge_counts(defaults, rows):
+    """
+    >>> merge_counts({'pending': 0, 'dead': 0}, [('pending', 3)])
+    {'pending': 3, 'dead': 0}
+    """
+    rval = dict(defaults)
+    rval.update(rows)
+    return rval
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description=__doc__.split("\n", 1)[0])
+    parser.add_argument(
+        "--db",
+        default=os.environ.get(
+            "WEBHOOK_QUEUE_PATH",
+            os.path.join(os.path.dirname(__file__), "instance", "webhooks.sqlite3"),
+        ),
+        help="webhook queue database, the app's WEBHOOK_QUEUE_PATH"
+        " (default: instance/webhooks.sqlite3)",
+    )
+    commands = parser.add_subparsers(dest="command")
+    commands.add_parser("dead", help="list dead jobs")
+    requeue = commands.add_parser(
+        "requeue", help="retry dead jobs from the first attempt"
+    )
+    requeue.add_argument("event_ids", nargs="*", help="default: every dead job")
+    args = parser.parse_args(argv)
+
+    queue = WebhookQueue(args.db, handler=None)
+    if args.command == "requeue":
+        count = queue.requeue(args.event_ids)
+        print(f"requeued {count} jobs", file=sys.stderr)
+    else:
+        for event_id, event_type, attempts, last_error in queue.dead():
+            last_line = (last_error or "").strip().rsplit("\n", 1)[-1]
+            print(f"{event_id}\t{event_type}\t{attempts}\t{last_line}")
+    return 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())